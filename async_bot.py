@@ -0,0 +1,650 @@
+import asyncio
+import contextlib
+import threading
+import time
+import weakref
+
+from config import (
+    BOT_TOKEN,
+    ADMIN_ID,
+    AI_CONCURRENCY,
+    AI_STREAMING,
+    STREAM_EDIT_INTERVAL,
+    UPDATES_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_WORKERS,
+    FAIR_MAX_QUEUE,
+    FAIR_MAX_PER_CHAT,
+    QUEUE_NOTIFY_POSITION,
+    PRIORITY_USERS,
+    OUTBOX_GLOBAL_RATE,
+    OUTBOX_CHAT_RATE,
+    OUTBOX_CHAT_BURST,
+    OUTBOX_WORKERS,
+    BROADCAST_RATE,
+    BROADCAST_WINDOW,
+    BROADCAST_CHUNK,
+    BROADCAST_PROGRESS_INTERVAL,
+)
+import config
+
+# запуск напрямую (python async_bot.py): настройки — до импорта db
+config.check()
+
+from functions import (
+    cached_response,
+    forget_chat,
+    get_ai_response_async,
+    md_to_html,
+    md_to_html_partial,
+    remember_turn,
+    stream_ai_response_async,
+    warm_up_model,
+)
+from broadcast import Broadcaster
+from db import db_manager
+from fairqueue import QUEUE_WAIT, SHED
+from outbox import AsyncOutbox, Outbox, retry_after
+from render import split_html
+import health
+import retention
+import metrics
+import startup
+import texts
+import telebot
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+# ==================== АСИНХРОННЫЙ РЕЖИМ ====================
+# Один процесс обслуживает сотни диалогов: пока Gemini думает,
+# event loop обрабатывает другие чаты. SQLite остаётся синхронным,
+# поэтому вызовы db_manager уходят в пул потоков (asyncio.to_thread).
+
+
+
+class Bot(AsyncTeleBot):
+    """
+    AsyncTeleBot с отметками для health (см. bot.Bot). Отправки идут
+    через outbox: лимиты Telegram и повтор после 429.
+    """
+
+    async def send_message(self, chat_id, *args, **kwargs):
+        # reply_to тоже приходит сюда
+        return await outbox.call(
+            chat_id, super().send_message, chat_id, *args, **kwargs
+        )
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None,
+                                *args, retries=None, **kwargs):
+        return await outbox.call(
+            chat_id, super().edit_message_text, text, chat_id, message_id,
+            *args, retries=retries, **kwargs
+        )
+
+    async def send_chat_action(self, chat_id, *args, **kwargs):
+        return await outbox.call(
+            chat_id, super().send_chat_action, chat_id, *args,
+            per_chat=False, retries=0, **kwargs
+        )
+
+    async def get_updates(self, *args, **kwargs):
+        updates = await super().get_updates(*args, **kwargs)
+        health.state.beat()
+        return updates
+
+    async def process_new_updates(self, updates):
+        if updates:
+            health.state.update_received()
+        await super().process_new_updates(updates)
+
+
+bot = Bot(BOT_TOKEN)
+
+# ответы async-бота: те же лимиты, что у bot.outbox
+outbox = AsyncOutbox(
+    global_rate=OUTBOX_GLOBAL_RATE,
+    chat_rate=OUTBOX_CHAT_RATE,
+    chat_burst=OUTBOX_CHAT_BURST,
+)
+
+# рассылка идёт в отдельном потоке: синхронный TeleBot и свой outbox.
+# С ответами async-бота она общих bucket'ов не делит, поэтому запас до
+# лимита Telegram обеспечивает BROADCAST_RATE, а случайный перебор
+# гасят повторы после 429
+broadcaster = Broadcaster(
+    telebot.TeleBot(BOT_TOKEN),
+    Outbox(
+        global_rate=BROADCAST_RATE,
+        chat_rate=OUTBOX_CHAT_RATE,
+        chat_burst=OUTBOX_CHAT_BURST,
+        workers=OUTBOX_WORKERS,
+    ),
+    db_manager,
+    rate=BROADCAST_RATE,
+    window=BROADCAST_WINDOW,
+    chunk=BROADCAST_CHUNK,
+    progress_interval=BROADCAST_PROGRESS_INTERVAL,
+)
+
+# глобальный лимит одновременных запросов к AI
+_ai_slots = asyncio.Semaphore(AI_CONCURRENCY)
+
+# блокировка на чат — ответы внутри одного чата идут строго по порядку.
+# WeakValueDictionary сам удаляет блокировки чатов, которые сейчас не заняты.
+_chat_locks = weakref.WeakValueDictionary()
+
+
+# Честность по чатам даёт сама связка «блокировка чата + семафор»: от
+# каждого чата семафор ждёт не больше одного сообщения, а будит он
+# по порядку — получается round-robin. Сверху — отказ при слишком
+# длинной очереди и админ вне очереди (без семафора).
+# В очереди сообщение числится от приёма до получения слота AI
+# (или до конца обработки, если AI не понадобился).
+_priority_ids = {ADMIN_ID, *PRIORITY_USERS}
+_waiting = {}       # chat_id -> сообщений, ещё не получивших слот AI
+_waiting_total = 0
+_slot_waiters = 0   # сообщений, ждущих семафор (не больше одного на чат)
+
+
+class _Waiting:
+    """
+    Место сообщения в очереди к AI. done() можно звать сколько угодно раз.
+    """
+
+    def __init__(self, chat_id):
+        global _waiting_total
+        self.chat_id = chat_id
+        self.active = True
+        self.enqueued = time.monotonic()
+        _waiting[chat_id] = _waiting.get(chat_id, 0) + 1
+        _waiting_total += 1
+
+    def done(self):
+        global _waiting_total
+        if not self.active:
+            return
+        self.active = False
+        _waiting_total -= 1
+        left = _waiting[self.chat_id] - 1
+        if left:
+            _waiting[self.chat_id] = left
+        else:
+            del _waiting[self.chat_id]
+
+
+@contextlib.asynccontextmanager
+async def _ai_slot(message, waiting):
+    """
+    Слот AI для сообщения; как только он получен, сообщение выходит из
+    очереди. Если ждать придётся, один раз сообщаем позицию (см. bot.py).
+    """
+    global _slot_waiters
+    chat_id = message.chat.id
+
+    if chat_id in _priority_ids:
+        waiting.done()
+        yield
+        return
+
+    if _ai_slots.locked():
+        position = _slot_waiters + 1
+        if (
+            QUEUE_NOTIFY_POSITION
+            and position >= QUEUE_NOTIFY_POSITION
+            and _waiting.get(chat_id) == 1
+        ):
+            try:
+                await bot.reply_to(message, texts.queue_position(position))
+            except Exception as e:
+                print("⚠️ Не удалось сообщить позицию в очереди:", e)
+
+    _slot_waiters += 1
+    try:
+        await _ai_slots.acquire()
+    finally:
+        _slot_waiters -= 1
+
+    QUEUE_WAIT.observe(time.monotonic() - waiting.enqueued)
+    waiting.done()
+    try:
+        yield
+    finally:
+        _ai_slots.release()
+
+
+def _chat_lock(chat_id):
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _chat_locks[chat_id] = lock
+    return lock
+
+
+async def db_call(func, *args):
+    return await asyncio.to_thread(func, *args)
+
+
+async def setup_commands():
+    commands = [
+        types.BotCommand(
+            command="start",
+            description="Начать работу с ботом"
+        ),
+        types.BotCommand(
+            command="nocache",
+            description="Вкл/выкл кэш готовых ответов"
+        ),
+        types.BotCommand(
+            command="new",
+            description="Начать новый диалог"
+        ),
+    ]
+    await bot.set_my_commands(commands)
+
+# ==================== /START ====================
+
+@bot.message_handler(commands=['start'])
+async def send_welcome(message):
+    async with _chat_lock(message.chat.id):
+        is_new_user = await db_call(db_manager.add_user, message.chat.id)
+
+        if is_new_user:
+            total_users = await db_call(db_manager.get_total_users)
+            await bot.send_message(
+                ADMIN_ID,
+                texts.new_user_notice(message.chat.id, total_users),
+                disable_notification=True
+            )
+
+        markup = types.InlineKeyboardMarkup(row_width=2)
+        markup.add(
+            types.InlineKeyboardButton("ℹ️ Помощь", callback_data="menu_help"),
+            types.InlineKeyboardButton("👨‍💻 О проекте", callback_data="menu_dev"),
+        )
+
+        await bot.send_message(
+            message.chat.id,
+            texts.build_greeting(is_new_user),
+            reply_markup=markup
+        )
+
+# ==================== КНОПКИ ====================
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("menu_"))
+async def menu_callback(call):
+    chat_id = call.message.chat.id
+
+    await outbox.call(
+        chat_id, bot.answer_callback_query, call.id, per_chat=False
+    )
+
+    if call.data == "menu_help":
+        await bot.send_message(chat_id, texts.HELP_TEXT)
+
+    elif call.data == "menu_dev":
+        await bot.send_message(chat_id, texts.ABOUT_TEXT)
+
+# ==================== /NOCACHE ====================
+
+@bot.message_handler(commands=['nocache'])
+async def toggle_cache(message):
+    opt_out = not await db_call(db_manager.is_cache_opt_out, message.chat.id)
+    await db_call(db_manager.set_cache_opt_out, message.chat.id, opt_out)
+
+    await bot.reply_to(
+        message,
+        texts.CACHE_DISABLED if opt_out else texts.CACHE_ENABLED
+    )
+
+# ==================== /NEW ====================
+
+@bot.message_handler(commands=['new'])
+async def new_dialog(message):
+    await db_call(forget_chat, message.chat.id)
+    await bot.reply_to(message, texts.MEMORY_CLEARED)
+
+# ==================== /STATS ====================
+
+@bot.message_handler(commands=['stats'])
+async def send_stats(message):
+    if message.chat.id != ADMIN_ID:
+        return
+
+    await bot.reply_to(message, texts.stats_report(
+        await db_call(db_manager.get_total_users),
+        await db_call(db_manager.get_total_requests),
+        await db_call(db_manager.get_daily_stats, 7),
+    ))
+
+# ==================== /BROADCAST ====================
+
+@bot.message_handler(commands=['broadcast'])
+async def broadcast_command(message):
+    if message.chat.id != ADMIN_ID:
+        return
+
+    answer = await asyncio.to_thread(
+        broadcaster.command,
+        message.chat.id, telebot.util.extract_arguments(message.text)
+    )
+    if answer:
+        await bot.reply_to(message, answer)
+
+# ==================== ОСНОВНОЙ ОБРАБОТЧИК ====================
+
+@bot.message_handler(func=lambda message: True)
+@metrics.timed("message", trace=True)
+async def handle_message(message):
+    chat_id = message.chat.id
+
+    if chat_id not in _priority_ids and (
+        _waiting.get(chat_id, 0) >= FAIR_MAX_PER_CHAT or _waiting_total >= FAIR_MAX_QUEUE
+    ):
+        # запрос ещё не списан — возвращать нечего
+        SHED.inc(reason="chat" if _waiting.get(chat_id, 0) >= FAIR_MAX_PER_CHAT else "global")
+        await bot.reply_to(message, texts.QUEUE_FULL)
+        return
+
+    waiting = _Waiting(chat_id)
+    try:
+        # блокировку берём до первого await, чтобы сохранить порядок сообщений
+        async with _chat_lock(chat_id):
+            await _answer(message, waiting)
+    finally:
+        # AI не понадобился, ошибка или задачу отменили в очереди
+        waiting.done()
+
+
+async def _answer(message, waiting):
+    print(f"📩 {message.chat.id}: {message.text[:50]}")
+
+    if not message.text:
+        return
+
+    if len(message.text) < texts.MIN_MESSAGE_LENGTH:
+        await bot.reply_to(message, texts.TOO_SHORT)
+        return
+
+    if len(message.text) > texts.MAX_MESSAGE_LENGTH:
+        await bot.reply_to(message, texts.TOO_LONG)
+        return
+
+    metrics.REQUESTS.inc()
+    metrics.log("message", chat_id=message.chat.id, length=len(message.text))
+
+    if not await db_call(db_manager.use_request, message.chat.id):
+        metrics.QUOTA_DENIED.inc()
+        await bot.send_message(message.chat.id, texts.LIMIT_EXHAUSTED)
+        return
+
+    use_cache = not await db_call(db_manager.is_cache_opt_out, message.chat.id)
+
+    if AI_STREAMING:
+        await _answer_streaming(message, use_cache, waiting)
+        return
+
+    # «печатает» не обязателен: как outbox.chat_action в bot.py
+    try:
+        await bot.send_chat_action(message.chat.id, "typing")
+    except Exception as e:
+        print("❌ Не удалось отправить сообщение:", e)
+
+    try:
+        async with _ai_slot(message, waiting):
+            response_text, _, _ = await get_ai_response_async(
+                message.text, use_cache, message.chat.id
+            )
+
+        await db_call(
+            db_manager.add_result,
+            message.chat.id,
+            message.text,
+            response_text
+        )
+
+        await _reply_html(message, response_text)
+
+    except Exception as e:
+        metrics.HANDLER_ERRORS.inc(handler="answer")
+        await db_call(db_manager.add_request_back, message.chat.id)
+        print("❌ AI error:", e)
+        await bot.reply_to(message, texts.AI_ERROR)
+
+
+@metrics.timed("telegram.reply")
+async def _reply_html(message, response_text):
+    parts = split_html(response_text)
+    await bot.reply_to(message, parts[0], parse_mode="HTML")
+    for part in parts[1:]:
+        await bot.send_message(message.chat.id, part, parse_mode="HTML")
+
+# ==================== STREAMING ====================
+
+async def _edit_text(sent, text, final=False):
+    """
+    См. bot._edit_text: промежуточная правка при любой ошибке только
+    пишется в лог, финальную outbox повторяет после retry_after.
+    """
+    try:
+        await bot.edit_message_text(
+            text, sent.chat.id, sent.message_id, parse_mode="HTML",
+            retries=None if final else 0,
+        )
+        return True
+    except Exception as e:
+        if "message is not modified" in str(getattr(e, "description", "")):
+            return True
+        if final:
+            raise
+        if retry_after(e) is None:
+            print("⚠️ Промежуточная правка не удалась:", e)
+        return False
+
+
+async def _sync_parts(chat_id, sent, shown, parts, final=False):
+    """
+    См. bot._sync_parts.
+    """
+    for i, part in enumerate(parts):
+        if i >= len(sent):
+            try:
+                sent.append(
+                    await bot.send_message(chat_id, part, parse_mode="HTML")
+                )
+            except Exception as e:
+                if final:
+                    raise
+                print("⚠️ Промежуточная отправка не удалась:", e)
+                return
+            shown.append(part)
+        elif part != shown[i] and await _edit_text(sent[i], part, final):
+            shown[i] = part
+
+
+async def _show_error(message, sent):
+    """
+    См. bot._show_error.
+    """
+    try:
+        if not sent:
+            await bot.reply_to(message, texts.AI_ERROR)
+            return
+
+        await bot.edit_message_text(
+            texts.AI_ERROR, sent[0].chat.id, sent[0].message_id
+        )
+        for part in sent[1:]:
+            await outbox.call(
+                part.chat.id, bot.delete_message, part.chat.id, part.message_id
+            )
+    except Exception as e:
+        print("❌ Не удалось показать ошибку:", e)
+
+
+async def _answer_streaming(message, use_cache, waiting):
+    cached = None
+    if use_cache:
+        cached = await db_call(cached_response, message.text, message.chat.id)
+    if cached:
+        await db_call(remember_turn, message.chat.id, message.text, cached)
+        response_text = md_to_html(cached)
+        await db_call(
+            db_manager.add_result, message.chat.id, message.text, response_text
+        )
+        await _reply_html(message, response_text)
+        return
+
+    sent = []
+    shown = [texts.STREAM_PLACEHOLDER]
+
+    try:
+        sent.append(await bot.reply_to(message, texts.STREAM_PLACEHOLDER))
+        text = ""
+        last_edit = 0.0
+
+        async with _ai_slot(message, waiting):
+            async for text in stream_ai_response_async(
+                message.text, message.chat.id, use_cache
+            ):
+                if time.monotonic() - last_edit < STREAM_EDIT_INTERVAL:
+                    continue
+
+                await _sync_parts(
+                    message.chat.id, sent, shown,
+                    split_html(md_to_html_partial(text))
+                )
+                last_edit = time.monotonic()
+
+        if not text.strip():
+            raise ValueError("пустой ответ от AI")
+
+        with metrics.stage("render"):
+            response_text = md_to_html(text)
+
+        await db_call(
+            db_manager.add_result,
+            message.chat.id,
+            message.text,
+            response_text
+        )
+
+        await _sync_parts(
+            message.chat.id, sent, shown, split_html(response_text), final=True
+        )
+
+    except Exception as e:
+        metrics.HANDLER_ERRORS.inc(handler="answer_streaming")
+        await db_call(db_manager.add_request_back, message.chat.id)
+        print("❌ AI error:", e)
+        await _show_error(message, sent)
+
+# ==================== НЕ-ТЕКСТ ====================
+
+@bot.message_handler(content_types=[
+    "photo", "video", "document", "sticker",
+    "voice", "audio", "video_note", "animation"
+])
+async def reject_non_text(message):
+    await bot.reply_to(message, texts.ONLY_TEXT)
+
+# ==================== ЗАПУСК ====================
+
+async def run_webhook():
+    from webhook import WebhookServer, webhook_secret
+
+    loop = asyncio.get_running_loop()
+    # апдейтов в обработке в event loop — не больше WEBHOOK_QUEUE_SIZE.
+    # Дальше рабочий поток ждёт здесь, очередь сервера заполняется,
+    # и Telegram получает 503 (повторит доставку позже)
+    inflight = threading.BoundedSemaphore(WEBHOOK_QUEUE_SIZE)
+
+    def dispatch(update):
+        # завершения обработчика не ждём (он ждёт ответ AI), только
+        # свободное место среди апдейтов в обработке
+        inflight.acquire()
+        try:
+            future = asyncio.run_coroutine_threadsafe(
+                bot.process_new_updates([types.Update.de_json(update)]), loop
+            )
+        except BaseException:
+            inflight.release()
+            raise
+        future.add_done_callback(lambda _: inflight.release())
+
+    secret = webhook_secret(WEBHOOK_SECRET, WEBHOOK_URL)
+    server = WebhookServer(
+        dispatch,
+        WEBHOOK_HOST,
+        WEBHOOK_PORT,
+        WEBHOOK_PATH,
+        secret,
+        WEBHOOK_QUEUE_SIZE,
+        WEBHOOK_WORKERS,
+        on_tick=health.state.beat,
+    )
+    health.state.register_queue("webhook", server.qsize)
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(url=WEBHOOK_URL, secret_token=secret or None)
+
+    server.start()
+    startup.ready()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.shutdown()
+
+
+def _report_setup_commands(task):
+    if not task.cancelled() and task.exception() is not None:
+        print("⚠️ setMyCommands при запуске:", task.exception())
+
+
+async def main():
+    health.start_server()
+    retention.start(db_manager)
+    health.state.register_queue("outbox", outbox.qsize)
+    health.state.register_queue("ai", lambda: _waiting_total)
+    if db_manager.results_writer is not None:
+        health.state.register_queue("results", db_manager.results_writer.qsize)
+
+    # долгие шаги запуска — в фоне, апдейты принимаются уже во время них;
+    # импорт google.generativeai тяжёлый — в потоке, вне event loop
+    startup.background("gemini", warm_up_model, True)
+    commands = asyncio.create_task(setup_commands())
+    commands.add_done_callback(_report_setup_commands)
+
+    print("🤖 Бот запущен в async-режиме")
+
+    try:
+        if UPDATES_MODE == "webhook":
+            await run_webhook()
+        else:
+            await bot.remove_webhook()
+            startup.ready()
+            await bot.infinity_polling(interval=0)
+    finally:
+        await asyncio.to_thread(broadcaster.stop)
+        await bot.close_session()
+        await asyncio.to_thread(retention.stop)
+        db_manager.close()
+
+
+def run():
+    """
+    Точка входа async-режима (python async_bot.py или bot.py с BOT_MODE=async).
+    """
+    import signal
+
+    # docker stop шлёт SIGTERM — завершаемся как по Ctrl+C (см. bot.py)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    run()
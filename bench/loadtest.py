@@ -0,0 +1,601 @@
+"""
+Нагрузочный тест бота целиком и без сети: обработчики bot.py (или
+async_bot.py) получают апдейты так же, как в webhook-режиме, а вместо
+Telegram и Gemini работают локальные заглушки с настраиваемыми
+задержками, стримингом и ошибками.
+
+    python bench/loadtest.py --messages 2000 --rate 50
+    python bench/loadtest.py --stream --gemini-latency 2 --tg-429 0.01
+    python bench/loadtest.py --mode async --messages 5000 --rate 200
+    python bench/loadtest.py --shards 4 --messages 5000 --rate 200
+
+Нагрузка — JSONL, по апдейту в строке: либо готовый Telegram update
+({"update_id": ..., "message": {...}}), либо короткая форма
+{"t": 0.25, "chat_id": 42, "text": "..."}, где t — секунда от начала
+(без t апдейты идут равномерно с частотой --rate):
+
+    python bench/loadtest.py --make-workload /tmp/workload.jsonl --messages 5000 --chats 300
+    python bench/loadtest.py --workload /tmp/workload.jsonl
+
+Отчёт: пропускная способность, p50/p95/p99 от апдейта до последнего
+исходящего сообщения по нему, время в БД на сообщение и самые дорогие
+этапы из metrics.py.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BOT_TOKEN = "123456:bench"
+
+REPLY_MARKDOWN = (
+    "# Ответ\n\n"
+    "Текст с **жирным**, *курсивом* и `кодом`, символы < > & тоже.\n\n"
+    "* первый пункт\n"
+    "* второй пункт\n\n"
+    "```python\n"
+    "def answer():\n"
+    "    return 42\n"
+    "```\n\n"
+)
+
+PROMPTS = (
+    "Объясни, как работает сборщик мусора в Python",
+    "Напиши функцию сортировки слиянием на Python",
+    "Чем отличается процесс от потока?",
+    "Как ускорить запросы к SQLite при большой нагрузке?",
+    "Что такое GIL и когда он мешает?",
+    "Приведи пример использования asyncio.gather",
+)
+
+
+# ==================== НАГРУЗКА ====================
+
+def make_update(update_id, chat_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "text": text,
+        },
+    }
+
+
+def make_workload(path, messages, chats, rate, seed=1):
+    """
+    Синтетическая нагрузка: пуассоновский поток, чаты по Zipf-подобному
+    распределению (несколько «болтливых» чатов и длинный хвост).
+    """
+    rng = random.Random(seed)
+    weights = [1 / (i + 1) for i in range(chats)]
+    t = 0.0
+
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(messages):
+            t += rng.expovariate(rate)
+            chat_id = 1000 + rng.choices(range(chats), weights)[0]
+            text = f"{rng.choice(PROMPTS)} (#{rng.randrange(1000)})"
+            f.write(json.dumps({"t": round(t, 4), "chat_id": chat_id, "text": text}, ensure_ascii=False) + "\n")
+
+    print(f"📝 {messages} апдейтов, {chats} чатов → {path}")
+
+
+def load_workload(path, rate):
+    schedule = []
+    with open(path, encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            update = item if "message" in item else make_update(
+                i + 1, item["chat_id"], item["text"]
+            )
+            schedule.append((item.get("t", i / rate), update))
+    schedule.sort(key=lambda entry: entry[0])
+    return schedule
+
+
+def synthetic_workload(messages, chats, rate, seed=1):
+    rng = random.Random(seed)
+    return [
+        (
+            i / rate,
+            make_update(i + 1, 1000 + rng.randrange(chats), f"{rng.choice(PROMPTS)} (#{i})"),
+        )
+        for i in range(messages)
+    ]
+
+
+# ==================== ЗАГЛУШКА TELEGRAM ====================
+
+class FakeTelegram:
+    """
+    Локальный Bot API: отвечает на sendMessage / editMessageText / ...
+    и запоминает, когда по каждому входящему сообщению ушёл первый
+    и последний ответ.
+    """
+
+    def __init__(self, latency=0.0, error_429=0.0, seed=1):
+        self.latency = latency
+        self.error_429 = error_429
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._message_id = 10 ** 6
+
+        self.sent_to_origin = {}   # message_id ответа -> (chat_id, message_id входящего)
+        self.pending = {}          # chat_id -> входящие без ответа (для send_message без reply)
+        self.first_out = {}        # origin -> perf_counter
+        self.last_out = {}
+        self.calls = {}            # метод -> количество
+        self.texts = {}            # chat_id -> тексты sendMessage / editMessageText
+        self.throttled = 0
+        self.last_activity = time.perf_counter()
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._httpd.daemon_threads = True
+
+    @property
+    def api_url(self):
+        host, port = self._httpd.server_address
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def incoming(self, chat_id, message_id):
+        with self._lock:
+            self.pending.setdefault(chat_id, deque()).append((chat_id, message_id))
+
+    def _record(self, method, params):
+        now = time.perf_counter()
+        chat_id = int(params.get("chat_id", 0) or 0)
+
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.last_activity = now
+
+            origin = None
+            result = True
+            if "text" in params:
+                self.texts.setdefault(chat_id, []).append(params["text"])
+
+            if method == "sendMessage":
+                self._message_id += 1
+                reply = params.get("reply_parameters") or params.get("reply_to_message_id")
+                if reply:
+                    reply = json.loads(reply) if reply.startswith("{") else {"message_id": reply}
+                    origin = (chat_id, int(reply["message_id"]))
+                elif self.pending.get(chat_id):
+                    origin = self.pending[chat_id][0]
+                if origin is not None:
+                    self.sent_to_origin[self._message_id] = origin
+                result = {
+                    "message_id": self._message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": params.get("text", ""),
+                }
+
+            elif method == "editMessageText":
+                message_id = int(params.get("message_id", 0))
+                origin = self.sent_to_origin.get(message_id)
+                result = {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": params.get("text", ""),
+                }
+
+            if origin is not None:
+                if origin not in self.first_out:
+                    self.first_out[origin] = now
+                    queue = self.pending.get(chat_id)
+                    if queue and origin in queue:
+                        queue.remove(origin)
+                self.last_out[origin] = now
+
+        return result
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                method = url.path.rsplit("/", 1)[-1]
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    body = self.rfile.read(length).decode()
+                    if self.headers.get("Content-Type", "").startswith("application/json"):
+                        params.update({k: v if isinstance(v, str) else json.dumps(v) for k, v in json.loads(body).items()})
+                    else:
+                        params.update({k: v[-1] for k, v in parse_qs(body).items()})
+
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+                if method in ("sendMessage", "editMessageText") and fake._rng.random() < fake.error_429:
+                    with fake._lock:
+                        fake.throttled += 1
+                    return self._reply(429, {
+                        "ok": False, "error_code": 429,
+                        "description": "Too Many Requests: retry after 1",
+                        "parameters": {"retry_after": 1},
+                    })
+
+                self._reply(200, {"ok": True, "result": fake._record(method, params)})
+
+            def _reply(self, code, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+# ==================== ЗАГЛУШКА GEMINI ====================
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    """
+    Вместо genai.GenerativeModel: та же пара generate_content /
+    generate_content_async, ответ — markdown заданной длины.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.2, error_rate=0.0, reply_chars=800, chunks=8, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.chunks = max(1, chunks)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+        repeats = max(1, reply_chars // len(REPLY_MARKDOWN))
+        self.text = REPLY_MARKDOWN * repeats
+
+    def _plan(self):
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self._rng.gauss(self.latency, self.jitter * self.latency))
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        return delay, fail
+
+    def _pieces(self):
+        size = -(-len(self.text) // self.chunks)
+        return [self.text[i:i + size] for i in range(0, len(self.text), size)]
+
+    def generate_content(self, prompt, stream=False):
+        delay, fail = self._plan()
+        if not stream:
+            time.sleep(delay)
+            if fail:
+                raise RuntimeError("fake Gemini: 500 Internal error")
+            return _Chunk(self.text)
+
+        # как в настоящем клиенте: вызов возвращается с первым чанком
+        step = delay / self.chunks
+        time.sleep(step)
+        if fail:
+            raise RuntimeError("fake Gemini: 500 Internal error")
+
+        def chunks():
+            for i, piece in enumerate(self._pieces()):
+                if i:
+                    time.sleep(step)
+                yield _Chunk(piece)
+
+        return chunks()
+
+    async def generate_content_async(self, prompt, stream=False):
+        import asyncio
+
+        delay, fail = self._plan()
+        if not stream:
+            await asyncio.sleep(delay)
+            if fail:
+                raise RuntimeError("fake Gemini: 500 Internal error")
+            return _Chunk(self.text)
+
+        step = delay / self.chunks
+        await asyncio.sleep(step)
+        if fail:
+            raise RuntimeError("fake Gemini: 500 Internal error")
+
+        async def chunks():
+            for i, piece in enumerate(self._pieces()):
+                if i:
+                    await asyncio.sleep(step)
+                yield _Chunk(piece)
+
+        return chunks()
+
+
+# ==================== ПРОГОН ====================
+
+def configure_env(args, db_dir):
+    # до первого импорта config: load_dotenv не перезаписывает заданные переменные
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "ADMIN_ID": "1",
+        "GEMINI_KEYS": "bench",
+        "DB_NAME": os.path.join(db_dir, "bench"),
+        "SYSTEM_PROMPT": os.environ.get("SYSTEM_PROMPT", "Ты полезный ассистент."),
+        "BOT_MODE": args.mode,
+        "AI_STREAMING": "1" if args.stream else "0",
+        "RESPONSE_CACHE": "1" if args.cache else "0",
+        "HEALTH_PORT": "0",
+        "METRICS": "1",
+    })
+
+
+def register_chats(db_manager, schedule):
+    # как после /start: у каждого чата есть строка в users и дневной лимит
+    for chat_id in {update["message"]["chat"]["id"] for _, update in schedule}:
+        db_manager.add_user(chat_id)
+
+
+def run_sync(schedule, fake, speed):
+    from telebot import apihelper, types
+
+    apihelper.API_URL = fake.api_url
+    import bot
+
+    register_chats(bot.db_manager, schedule)
+
+    started = time.perf_counter()
+    injected = {}
+    for at, update in schedule:
+        delay = started + at / speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        message = update["message"]
+        origin = (message["chat"]["id"], message["message_id"])
+        fake.incoming(*origin)
+        injected[origin] = time.perf_counter()
+        bot.bot.process_new_updates([types.Update.de_json(update)])
+
+    return injected, lambda: (bot.outbox.stop(), bot.db_manager.close())
+
+
+def _shard_setup():
+    # в рабочем процессе shards.py: те же заглушки, что и в run_sync
+    from telebot import apihelper
+    import functions
+
+    apihelper.API_URL = os.environ["BENCH_API_URL"]
+    functions._model = FakeModel(**json.loads(os.environ["BENCH_MODEL"]))
+
+
+def _shard_worker(index, shards, updates):
+    import shards as sharding
+
+    sharding.run_worker(index, shards, updates, setup=_shard_setup)
+
+
+def run_sharded(schedule, fake, speed, shards):
+    import shards as sharding
+    from db import db_manager
+
+    register_chats(db_manager, schedule)
+
+    os.environ["BENCH_API_URL"] = fake.api_url
+    dispatcher = sharding.Dispatcher(shards, worker=_shard_worker)
+    dispatcher.start()
+
+    started = time.perf_counter()
+    injected = {}
+    for at, update in schedule:
+        delay = started + at / speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        message = update["message"]
+        origin = (message["chat"]["id"], message["message_id"])
+        fake.incoming(*origin)
+        injected[origin] = time.perf_counter()
+        dispatcher.route(update)
+
+    return injected, lambda: (dispatcher.stop(), db_manager.close())
+
+
+def run_async(schedule, fake, speed, drain):
+    import asyncio
+    from telebot import asyncio_helper, types
+
+    asyncio_helper.API_URL = fake.api_url
+    import async_bot
+
+    register_chats(async_bot.db_manager, schedule)
+
+    injected = {}
+
+    async def main():
+        started = time.perf_counter()
+        tasks = []
+        for at, update in schedule:
+            delay = started + at / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            message = update["message"]
+            origin = (message["chat"]["id"], message["message_id"])
+            fake.incoming(*origin)
+            injected[origin] = time.perf_counter()
+            tasks.append(asyncio.create_task(
+                async_bot.bot.process_new_updates([types.Update.de_json(update)])
+            ))
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.to_thread(drain, injected)
+        await async_bot.bot.close_session()
+
+    asyncio.run(main())
+    return injected, async_bot.db_manager.close
+
+
+def wait_drained(fake, injected, timeout, idle=1.0):
+    """
+    Ждём, пока на каждое входящее придёт ответ и исходящий трафик затихнет.
+    """
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        done = all(origin in fake.last_out for origin in injected)
+        if done and time.perf_counter() - fake.last_activity > idle:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def report(args, fake, model, injected, elapsed):
+    import metrics
+
+    e2e = sorted(fake.last_out[o] - t for o, t in injected.items() if o in fake.last_out)
+    first = sorted(fake.first_out[o] - t for o, t in injected.items() if o in fake.first_out)
+    answered = len(e2e)
+    lost = len(injected) - answered
+
+    totals = metrics.STAGE_SECONDS.totals()
+    db_total = sum(total for (stage,), (total, _) in totals.items() if stage.startswith("db."))
+
+    print()
+    if args.shards > 1:
+        # Gemini и этапы считаются в рабочих процессах — здесь их не видно
+        print(f"процессов: {args.shards} (Gemini и этапы ниже — только диспетчер)")
+    print(f"режим: {args.mode}, стриминг: {'да' if args.stream else 'нет'}, кэш: {'да' if args.cache else 'нет'}")
+    print(f"сообщений: {len(injected)}, с ответом: {answered}, без ответа: {lost}")
+    print(f"время: {elapsed:.2f} с, пропускная способность: {answered / elapsed:.1f} сообщ/с")
+    print()
+    print("                 p50       p95       p99       max")
+    for name, values in (("до ответа", e2e), ("первый ответ", first)):
+        row = "".join(f"{percentile(values, p) * 1000:8.1f}мс" for p in (50, 95, 99, 100))
+        print(f"{name:<13}{row}")
+    print()
+    print(f"БД на сообщение: {db_total / max(1, len(injected)) * 1000:.3f} мс")
+    print(f"Gemini: вызовов {model.calls}, ошибок {model.errors}")
+    print(f"Telegram: {sum(fake.calls.values())} вызовов, 429: {fake.throttled}, {fake.calls}")
+    print(
+        f"отказов по лимиту: {metrics.QUOTA_DENIED.value()}, "
+        f"ошибок AI: {metrics.AI_ERRORS.value()}, "
+        f"ответов с ошибкой: "
+        f"{sum(metrics.HANDLER_ERRORS.value(handler=h) for h in ('answer', 'answer_streaming'))}"
+    )
+
+    print()
+    print(f"{'этап':<32}{'вызовов':>9}{'всего, с':>11}{'среднее, мс':>14}")
+    for (stage,), (total, count) in sorted(totals.items(), key=lambda item: -item[1][0])[:args.top]:
+        print(f"{stage:<32}{count:>9}{total:>11.3f}{total / count * 1000:>14.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота без сети")
+    parser.add_argument("--mode", choices=("sync", "async"), default="sync")
+    parser.add_argument("--workload", help="JSONL с апдейтами")
+    parser.add_argument("--make-workload", metavar="PATH", help="сгенерировать нагрузку и выйти")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=50, help="апдейтов в секунду")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение времени из workload")
+    parser.add_argument("--stream", action="store_true", help="AI_STREAMING=1")
+    parser.add_argument("--cache", action="store_true", help="RESPONSE_CACHE=1")
+    parser.add_argument("--gemini-latency", type=float, default=0.5)
+    parser.add_argument("--gemini-jitter", type=float, default=0.2, help="доля от задержки")
+    parser.add_argument("--gemini-errors", type=float, default=0.0, help="доля ошибок")
+    parser.add_argument("--reply-chars", type=int, default=800)
+    parser.add_argument("--tg-latency", type=float, default=0.01)
+    parser.add_argument("--tg-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--timeout", type=float, default=120, help="ожидание хвоста, с")
+    parser.add_argument("--shards", type=int, default=1, help="процессов shards.py (только sync)")
+    parser.add_argument("--top", type=int, default=12, help="сколько этапов показать")
+    args = parser.parse_args()
+
+    if args.make_workload:
+        make_workload(args.make_workload, args.messages, args.chats, args.rate)
+        return
+
+    db_dir = tempfile.mkdtemp(prefix="aibotik-bench-")
+    configure_env(args, db_dir)
+
+    if args.workload:
+        schedule = load_workload(args.workload, args.rate)
+    else:
+        schedule = synthetic_workload(args.messages, args.chats, args.rate)
+
+    fake = FakeTelegram(args.tg_latency, args.tg_429)
+    fake.start()
+
+    model = FakeModel(
+        args.gemini_latency, args.gemini_jitter, args.gemini_errors, args.reply_chars
+    )
+    import functions
+    functions._model = model
+    os.environ["BENCH_MODEL"] = json.dumps({
+        "latency": args.gemini_latency, "jitter": args.gemini_jitter,
+        "error_rate": args.gemini_errors, "reply_chars": args.reply_chars,
+    })
+
+    print(f"▶️ {len(schedule)} апдейтов, БД: {db_dir}")
+    started = time.perf_counter()
+
+    if args.mode == "async":
+        injected, close = run_async(
+            schedule, fake, args.speed,
+            lambda injected: wait_drained(fake, injected, args.timeout),
+        )
+    else:
+        if args.shards > 1:
+            injected, close = run_sharded(schedule, fake, args.speed, args.shards)
+        else:
+            injected, close = run_sync(schedule, fake, args.speed)
+        if not wait_drained(fake, injected, args.timeout):
+            print("⚠️ не все сообщения получили ответ за --timeout")
+
+    elapsed = fake.last_activity - started
+    close()
+    fake.shutdown()
+
+    report(args, fake, model, injected, elapsed)
+
+
+if __name__ == "__main__":
+    main()
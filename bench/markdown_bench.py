@@ -0,0 +1,66 @@
+"""
+Микро-бенчмарк рендера Markdown → Telegram HTML:
+старая реализация (пять re.sub) против однопроходной из render.py.
+
+    python bench/markdown_bench.py
+"""
+import html
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from render import md_to_html, split_html  # noqa: E402
+
+
+def legacy_md_to_html(md: str) -> str:
+    # functions.md_to_html до перехода на render.py
+    md = html.escape(md)
+
+    def block_code(match):
+        return f"<pre><code>{match.group(2)}</code></pre>"
+
+    md = re.sub(r"```([a-zA-Z0-9_-]+)?\n([\s\S]*?)```", block_code, md)
+    md = re.sub(r"`([^`]+)`", r"<code>\1</code>", md)
+    md = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", md)
+    md = re.sub(r"\*(.*?)\*", r"<i>\1</i>", md)
+    md = re.sub(r"^#+\s*(.*)$", r"<b>\1</b>", md, flags=re.MULTILINE)
+
+    return md
+
+
+SAMPLE = (
+    "# Заголовок ответа\n\n"
+    "Обычный текст с **жирным**, *курсивом* и `inline code`, "
+    "а также символами < > & в тексте.\n\n"
+    "* первый пункт списка\n"
+    "* второй пункт с **выделением**\n\n"
+    "```python\n"
+    "def f(x):\n"
+    "    return x ** 2 * 3  # звёздочки внутри кода\n"
+    "```\n\n"
+    "Ссылка: [документация](https://example.com/docs?a=1&b=2)\n\n"
+)
+
+
+def bench(size_kb):
+    text = SAMPLE * max(1, size_kb * 1024 // len(SAMPLE))
+    number = max(1, 2000 // size_kb)
+
+    legacy = timeit.timeit(lambda: legacy_md_to_html(text), number=number) / number
+    current = timeit.timeit(lambda: md_to_html(text), number=number) / number
+    split = timeit.timeit(lambda: split_html(md_to_html(text)), number=number) / number
+
+    print(
+        f"{len(text) // 1024:>5} КБ | legacy {legacy * 1e3:8.3f} мс"
+        f" | render {current * 1e3:8.3f} мс"
+        f" | render+split {split * 1e3:8.3f} мс"
+        f" | частей {len(split_html(md_to_html(text)))}"
+    )
+
+
+if __name__ == "__main__":
+    for size_kb in (1, 4, 16, 64, 256):
+        bench(size_kb)
@@ -1,30 +1,167 @@
-from config import BOT_TOKEN, ADMIN_ID
-from functions import get_ai_response
-from db import db_manager
-import telebot
-from telebot import types
+import startup  # первым: от него считается время запуска
+import time
+
+import config
+from config import (
+    BOT_TOKEN,
+    ADMIN_ID,
+    BOT_MODE,
+    SHARDS,
+    AI_CONCURRENCY,
+    AI_STREAMING,
+    STREAM_EDIT_INTERVAL,
+    UPDATES_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_WORKERS,
+    OUTBOX_GLOBAL_RATE,
+    OUTBOX_CHAT_RATE,
+    OUTBOX_CHAT_BURST,
+    OUTBOX_WORKERS,
+    FAIR_PER_CHAT_INFLIGHT,
+    FAIR_MAX_QUEUE,
+    FAIR_MAX_PER_CHAT,
+    PRIORITY_USERS,
+    QUEUE_NOTIFY_POSITION,
+    BROADCAST_RATE,
+    BROADCAST_WINDOW,
+    BROADCAST_CHUNK,
+    BROADCAST_PROGRESS_INTERVAL,
+)
 
 # ==================== ПРОВЕРКИ ====================
+# до импорта db: с пустым DB_NAME база создалась бы как None.db
+config.check()
+startup.mark("config")
 
-if not BOT_TOKEN:
-    raise ValueError("BOT_TOKEN не найден в .env файле")
-if not ADMIN_ID:
-    raise ValueError("ADMIN_ID не найден в .env файле")
+# BOT_MODE=async: bot.py только передаёт управление async_bot.py, до
+# создания синхронных outbox, очереди к AI и рассылки — в async-режиме
+# они не нужны и остались бы висеть лишними потоками
+if __name__ == "__main__" and BOT_MODE == "async":
+    import async_bot
+
+    startup.mark("async_bot")
+    async_bot.run()
+    raise SystemExit
+
+# схема базы — при импорте db (DatabaseManager.migrate)
+from db import db_manager
+startup.mark("db")
+
+from functions import (
+    cached_response,
+    forget_chat,
+    get_ai_response,
+    md_to_html,
+    md_to_html_partial,
+    remember_turn,
+    stream_ai_response,
+    warm_up_model,
+)
+from broadcast import Broadcaster
+from fairqueue import FairScheduler
+from outbox import Outbox, PRIORITY_REPLY, PRIORITY_ACTION, PRIORITY_ADMIN, retry_after
+from render import split_html
+import health
+import retention
+import metrics
+import texts
+import telebot
+from telebot import types
 
-bot = telebot.TeleBot(BOT_TOKEN)
+startup.mark("imports")
+
+
+class Bot(telebot.TeleBot):
+    """
+    TeleBot, который отмечает в health каждый оборот цикла getUpdates
+    и каждый полученный апдейт (polling и webhook).
+    """
+
+    def get_updates(self, *args, **kwargs):
+        updates = super().get_updates(*args, **kwargs)
+        health.state.beat()
+        return updates
+
+    def process_new_updates(self, updates):
+        if updates:
+            health.state.update_received()
+        super().process_new_updates(updates)
+
+
+bot = Bot(BOT_TOKEN)
+
+# все исходящие сообщения идут через планировщик с лимитами Telegram
+outbox = Outbox(
+    global_rate=OUTBOX_GLOBAL_RATE,
+    chat_rate=OUTBOX_CHAT_RATE,
+    chat_burst=OUTBOX_CHAT_BURST,
+    workers=OUTBOX_WORKERS,
+)
+
+# запросы к AI: round-robin по чатам, админ вне очереди
+ai_queue = FairScheduler(
+    workers=AI_CONCURRENCY,
+    per_chat_inflight=FAIR_PER_CHAT_INFLIGHT,
+    max_queue=FAIR_MAX_QUEUE,
+    max_per_chat=FAIR_MAX_PER_CHAT,
+    priority_ids=[ADMIN_ID, *PRIORITY_USERS],
+)
+
+# рассылка админа — через тот же outbox, с низшим приоритетом
+broadcaster = Broadcaster(
+    bot,
+    outbox,
+    db_manager,
+    rate=BROADCAST_RATE,
+    window=BROADCAST_WINDOW,
+    chunk=BROADCAST_CHUNK,
+    progress_interval=BROADCAST_PROGRESS_INTERVAL,
+)
+
+health.state.register_queue("outbox", outbox.qsize)
+health.state.register_queue("ai", ai_queue.qsize)
+if db_manager.results_writer is not None:
+    health.state.register_queue("results", db_manager.results_writer.qsize)
+
+
+def reply(message, text, **kwargs):
+    """
+    Короткий служебный ответ пользователю без ожидания отправки.
+    """
+    return outbox.post(
+        PRIORITY_REPLY, message.chat.id, bot.reply_to, message, text, **kwargs
+    )
 
 def setup_commands():
     commands = [
         telebot.types.BotCommand(
             command="start",
             description="Начать работу с ботом"
-        )
+        ),
+        telebot.types.BotCommand(
+            command="nocache",
+            description="Вкл/выкл кэш готовых ответов"
+        ),
+        telebot.types.BotCommand(
+            command="new",
+            description="Начать новый диалог"
+        ),
     ]
     bot.set_my_commands(commands)
-# создаём таблицы при запуске
-db_manager.create_tables()
 
-print("🤖 Бот запущен и готов к работе")
+
+def warm_up(commands=True):
+    """
+    Долгие шаги запуска — в фоне: апдейты принимаются уже во время них.
+    """
+    if commands:
+        startup.background("setMyCommands", setup_commands)
+    startup.background("gemini", warm_up_model)
 
 # ==================== /START ====================
 
@@ -33,34 +170,18 @@ def send_welcome(message):
     # добавляем пользователя (если новый)
     is_new_user = db_manager.add_user(message.chat.id)
 
-    # проверяем дневной сброс
-    db_manager.reset_daily_requests_if_needed(message.chat.id)
-
-    greeting = "👋 Привет. Я — ассистент с искусственным интеллектом.\n\n"
-
     if is_new_user:
-        greeting += (
-            "У вас есть 150 запросов в сутки. Лимит обновляется автоматически в полночь.\n"
-            "Чтобы начать диалог, просто напишите сообщение не менее 10 символов\n"
-            "Лимит обновляется автоматически каждый день.\n\n"
-        )
-
         total_users = db_manager.get_total_users()
-        bot.send_message(
+        outbox.post(
+            PRIORITY_ADMIN,
+            ADMIN_ID,
+            bot.send_message,
             ADMIN_ID,
-            f"Новый пользователь: {message.chat.id}\nВсего пользователей: {total_users}",
+            texts.new_user_notice(message.chat.id, total_users),
             disable_notification=True
         )
-    else:
-        greeting += (
-            "Вы уже пользовались ботом ранее.\n\n"
-        )
 
-    greeting += (
-        "Просто напишите сообщение (минимум 10 символов), "
-        "и я постараюсь помочь.\n\n"
-        "Используйте кнопки ниже 👇"
-    )
+    greeting = texts.build_greeting(is_new_user)
 
     # инлайн-кнопки (БЕЗ баланса)
     markup = types.InlineKeyboardMarkup(row_width=2)
@@ -69,73 +190,142 @@ def send_welcome(message):
         types.InlineKeyboardButton("👨‍💻 О проекте", callback_data="menu_dev"),
     )
 
-    bot.send_message(message.chat.id, greeting, reply_markup=markup)
+    outbox.post(
+        PRIORITY_REPLY,
+        message.chat.id,
+        bot.send_message,
+        message.chat.id,
+        greeting,
+        reply_markup=markup
+    )
 
 # ==================== КНОПКИ ====================
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("menu_"))
 def menu_callback(call):
-    bot.answer_callback_query(call.id)
-
     chat_id = call.message.chat.id
-    user_id = call.from_user.id
 
-    db_manager.reset_daily_requests_if_needed(user_id)
+    outbox.post(
+        PRIORITY_ACTION, chat_id, bot.answer_callback_query, call.id, per_chat=False
+    )
 
     if call.data == "menu_help":
-        bot.send_message(
-            chat_id,
-            "ℹ️ Помощь\n\n"
-            "Этот Ai-бот — простой и быстрый способ получать ответы.\n"
-            "Интерфейс минималистичен, ответы — мгновенны. За каждым диалогом стоит отлаженный код, написанный с принципами простоты и надёжности. Редкий инструмент, который делает свою работу хорошо: предоставляет информацию быстро и без лишних деталей.\n\n"
-            "• До 150 запросов в сутки\n"
-            "• 1 сообщение = 1 запрос\n"
-            "• Лимит обновляется автоматически\n\n"
-            "Просто напишите свой вопрос текстом."
-        )
+        outbox.post(PRIORITY_REPLY, chat_id, bot.send_message, chat_id, texts.HELP_TEXT)
 
     elif call.data == "menu_dev":
-        bot.send_message(
-            chat_id,
-            "👨‍💻 свежий Telegram AI-бот\n"
-            "✅ Абсолютно бесплатный доступ\n"
-             "🔹 Бот не сохраняет личную информацию, но быстро обучается и подстраивается под вас"
-            "🔹 Никакой рекламы, просто вставляешь запрос\n"
-        )
+        outbox.post(PRIORITY_REPLY, chat_id, bot.send_message, chat_id, texts.ABOUT_TEXT)
+
+# ==================== /NOCACHE ====================
+
+@bot.message_handler(commands=['nocache'])
+def toggle_cache(message):
+    opt_out = not db_manager.is_cache_opt_out(message.chat.id)
+    db_manager.set_cache_opt_out(message.chat.id, opt_out)
+
+    reply(message, texts.CACHE_DISABLED if opt_out else texts.CACHE_ENABLED)
+
+# ==================== /NEW ====================
+
+@bot.message_handler(commands=['new'])
+def new_dialog(message):
+    forget_chat(message.chat.id)
+    reply(message, texts.MEMORY_CLEARED)
+
+# ==================== /STATS ====================
+
+@bot.message_handler(commands=['stats'])
+def send_stats(message):
+    # только для админа; остальным команда не отвечает
+    if message.chat.id != ADMIN_ID:
+        return
+
+    reply(message, texts.stats_report(
+        db_manager.get_total_users(),
+        db_manager.get_total_requests(),
+        db_manager.get_daily_stats(7),
+    ))
+
+# ==================== /BROADCAST ====================
+
+@bot.message_handler(commands=['broadcast'])
+def broadcast_command(message):
+    if message.chat.id != ADMIN_ID:
+        return
+
+    answer = broadcaster.command(
+        message.chat.id, telebot.util.extract_arguments(message.text)
+    )
+    if answer:
+        reply(message, answer)
 
 # ==================== ОСНОВНОЙ ОБРАБОТЧИК ====================
 
 @bot.message_handler(func=lambda message: True)
+@metrics.timed("message", trace=True)
 def handle_message(message):
     print(f"📩 {message.chat.id}: {message.text[:50]}")
 
     if not message.text:
         return
 
-    if len(message.text) < 10:
-        bot.reply_to(message, "⚠️ Пожалуйста, напишите не менее 10 символов.")
+    if len(message.text) < texts.MIN_MESSAGE_LENGTH:
+        reply(message, texts.TOO_SHORT)
         return
 
-    if len(message.text) > 4000:
-        bot.reply_to(message, "⚠️ Максимум 4000 символов.")
+    if len(message.text) > texts.MAX_MESSAGE_LENGTH:
+        reply(message, texts.TOO_LONG)
         return
 
-    # 🔄 дневной сброс
-    db_manager.reset_daily_requests_if_needed(message.chat.id)
+    metrics.REQUESTS.inc()
+    metrics.log("message", chat_id=message.chat.id, length=len(message.text))
 
-    # ❗ СРАЗУ пытаемся списать запрос
+    # ❗ СРАЗУ пытаемся списать запрос (дневной сброс — в том же UPDATE)
     if not db_manager.use_request(message.chat.id):
-        bot.send_message(
+        metrics.QUOTA_DENIED.inc()
+        outbox.post(
+            PRIORITY_REPLY,
+            message.chat.id,
+            bot.send_message,
             message.chat.id,
-            "❌ Дневной лимит исчерпан.\nПопробуйте снова завтра."
+            texts.LIMIT_EXHAUSTED
         )
         return
 
-    # ✅ запрос успешно списан — идём в AI
-    bot.send_chat_action(message.chat.id, "typing")
+    use_cache = not db_manager.is_cache_opt_out(message.chat.id)
+
+    # ✅ запрос успешно списан — в очередь к AI
+    position = ai_queue.submit(message.chat.id, _answer, message, use_cache)
+
+    if position is None:
+        # очередь переполнена — сразу отказываем и возвращаем запрос
+        db_manager.add_request_back(message.chat.id)
+        reply(message, texts.QUEUE_FULL)
+        return
+
+    # о позиции сообщаем один раз, а не на каждое сообщение в очереди
+    if (
+        QUEUE_NOTIFY_POSITION
+        and position >= QUEUE_NOTIFY_POSITION
+        and ai_queue.pending(message.chat.id) == 1
+    ):
+        reply(message, texts.queue_position(position))
+
+
+@metrics.timed("answer")
+def _answer(message, use_cache):
+    """
+    Выполняется в потоке ai_queue, когда подошла очередь чата.
+    """
+    if AI_STREAMING:
+        _answer_streaming(message, use_cache)
+        return
+
+    outbox.chat_action(bot, message.chat.id, "typing")
 
     try:
-        response_text, _, _ = get_ai_response(message.text)
+        response_text, _, _ = get_ai_response(
+            message.text, use_cache, message.chat.id
+        )
 
         db_manager.add_result(
             message.chat.id,
@@ -143,15 +333,153 @@ def handle_message(message):
             response_text
         )
 
-        bot.reply_to(message, response_text, parse_mode="HTML")
+        _reply_html(message, response_text)
 
     except Exception as e:
         # 🔄 если AI упал — возвращаем запрос
+        metrics.HANDLER_ERRORS.inc(handler="answer")
         db_manager.add_request_back(message.chat.id)
         print("❌ AI error:", e)
-        bot.reply_to(message, "❌ Произошла ошибка. Попробуйте позже.")
+        reply(message, texts.AI_ERROR)
+
+
+def _reply_html(message, response_text):
+    """
+    Длинный ответ уходит несколькими сообщениями (лимит Telegram — 4096).
+    """
+    parts = split_html(response_text)
+    outbox.call(
+        PRIORITY_REPLY, message.chat.id,
+        bot.reply_to, message, parts[0], parse_mode="HTML"
+    )
+    for part in parts[1:]:
+        outbox.call(
+            PRIORITY_REPLY, message.chat.id,
+            bot.send_message, message.chat.id, part, parse_mode="HTML"
+        )
+
+# ==================== STREAMING ====================
+
+def _edit_text(sent, text, final=False):
+    """
+    Правит сообщение с ответом. Промежуточная правка не обязана дойти:
+    при любой ошибке (429, сеть, сообщение удалено) пишем в лог и
+    возвращаем False — следующая всё равно придёт. Финальную outbox
+    повторяет после retry_after, её ошибка пробрасывается.
+    """
+    try:
+        outbox.call(
+            PRIORITY_REPLY, sent.chat.id,
+            bot.edit_message_text, text, sent.chat.id, sent.message_id,
+            parse_mode="HTML",
+            retries=None if final else 0,
+        )
+        return True
+    except Exception as e:
+        if "message is not modified" in str(getattr(e, "description", "")):
+            return True
+        if final:
+            raise
+        if retry_after(e) is None:
+            print("⚠️ Промежуточная правка не удалась:", e)
+        return False
+
+
+def _sync_parts(chat_id, sent, shown, parts, final=False):
+    """
+    Приводит уже отправленные части ответа к parts:
+    правит изменившиеся и досылает новые сообщения. Промежуточную
+    досылку при ошибке откладываем до следующего раза.
+    """
+    for i, part in enumerate(parts):
+        if i >= len(sent):
+            try:
+                sent.append(outbox.call(
+                    PRIORITY_REPLY, chat_id,
+                    bot.send_message, chat_id, part, parse_mode="HTML"
+                ))
+            except Exception as e:
+                if final:
+                    raise
+                print("⚠️ Промежуточная отправка не удалась:", e)
+                return
+            shown.append(part)
+        elif part != shown[i] and _edit_text(sent[i], part, final):
+            shown[i] = part
+
+
+def _show_error(message, sent):
+    """
+    Ошибка вместо ответа: первая часть становится текстом ошибки,
+    остальные части удаляются. Без заглушки — обычный ответ.
+    """
+    if not sent:
+        reply(message, texts.AI_ERROR)
+        return
+
+    outbox.post(
+        PRIORITY_REPLY, message.chat.id,
+        bot.edit_message_text, texts.AI_ERROR, sent[0].chat.id, sent[0].message_id
+    )
+    for part in sent[1:]:
+        outbox.post(
+            PRIORITY_REPLY, message.chat.id,
+            bot.delete_message, part.chat.id, part.message_id
+        )
+
+
+def _answer_streaming(message, use_cache):
+    # готовый ответ из кэша отдаём сразу, без заглушки и правок
+    cached = cached_response(message.text, message.chat.id) if use_cache else None
+    if cached:
+        remember_turn(message.chat.id, message.text, cached)
+        response_text = md_to_html(cached)
+        db_manager.add_result(message.chat.id, message.text, response_text)
+        _reply_html(message, response_text)
+        return
+
+    # длинный ответ по мере роста расползается на несколько сообщений
+    sent = []
+    shown = [texts.STREAM_PLACEHOLDER]
+
+    try:
+        sent.append(outbox.call(
+            PRIORITY_REPLY, message.chat.id,
+            bot.reply_to, message, texts.STREAM_PLACEHOLDER
+        ))
+        text = ""
+        last_edit = 0.0
+
+        for text in stream_ai_response(message.text, message.chat.id, use_cache):
+            if time.monotonic() - last_edit < STREAM_EDIT_INTERVAL:
+                continue
+
+            _sync_parts(
+                message.chat.id, sent, shown, split_html(md_to_html_partial(text))
+            )
+            last_edit = time.monotonic()
 
+        if not text.strip():
+            raise ValueError("пустой ответ от AI")
 
+        with metrics.stage("render"):
+            response_text = md_to_html(text)
+
+        db_manager.add_result(
+            message.chat.id,
+            message.text,
+            response_text
+        )
+
+        _sync_parts(
+            message.chat.id, sent, shown, split_html(response_text), final=True
+        )
+
+    except Exception as e:
+        metrics.HANDLER_ERRORS.inc(handler="answer_streaming")
+        db_manager.add_request_back(message.chat.id)
+        print("❌ AI error:", e)
+        _show_error(message, sent)
 
 # ==================== НЕ-ТЕКСТ ====================
 
@@ -160,11 +488,71 @@ def handle_message(message):
     "voice", "audio", "video_note", "animation"
 ])
 def reject_non_text(message):
-    bot.reply_to(message, "❌ Бот принимает только текстовые сообщения.")
+    reply(message, texts.ONLY_TEXT)
+
+startup.mark("handlers")
 
 # ==================== ЗАПУСК ====================
 
+def run_webhook():
+    from webhook import WebhookServer, webhook_secret
+
+    # обработчики выполняются прямо в потоках сервера, без пула TeleBot
+    # (его очередь не ограничена): в работе не больше WEBHOOK_QUEUE_SIZE
+    # апдейтов в очереди и WEBHOOK_WORKERS в обработке, дальше — 503
+    bot.threaded = False
+
+    secret = webhook_secret(WEBHOOK_SECRET, WEBHOOK_URL)
+    server = WebhookServer(
+        lambda update: bot.process_new_updates([types.Update.de_json(update)]),
+        WEBHOOK_HOST,
+        WEBHOOK_PORT,
+        WEBHOOK_PATH,
+        secret,
+        WEBHOOK_QUEUE_SIZE,
+        WEBHOOK_WORKERS,
+        on_tick=health.state.beat,
+    )
+    health.state.register_queue("webhook", server.qsize)
+
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=secret or None)
+
+    startup.ready()
+    server.serve_forever()
+
+
+def run_polling():
+    # если раньше был включён webhook, getUpdates вернёт 409
+    bot.remove_webhook()
+    startup.ready()
+    bot.infinity_polling(interval=0)
+
 
 if __name__ == "__main__":
-    setup_commands()
-    bot.infinity_polling(interval=0)
\ No newline at end of file
+    import signal
+
+    # docker stop шлёт SIGTERM — завершаемся как по Ctrl+C,
+    # чтобы отработали finally и сбросились фоновые записи в БД
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    if SHARDS > 1:
+        # bot.py здесь уже инициализирован — рабочие процессы должны
+        # импортировать его сами, поэтому диспетчер запускается отдельно
+        raise SystemExit("SHARDS > 1: запускайте python shards.py")
+
+    health.start_server()
+    retention.start(db_manager)
+    warm_up()
+    try:
+        if UPDATES_MODE == "webhook":
+            run_webhook()
+        else:
+            run_polling()
+    finally:
+        ai_queue.stop()
+        # рассылка встаёт на паузу, /broadcast resume продолжит
+        broadcaster.stop()
+        outbox.stop()
+        retention.stop()
+        db_manager.close()
@@ -0,0 +1,265 @@
+import threading
+import time
+from collections import deque
+
+from telebot.apihelper import ApiTelegramException
+
+from outbox import PRIORITY_ADMIN, PRIORITY_BROADCAST
+from ratelimit import TokenBucket
+import metrics
+import texts
+
+# ==================== РАССЫЛКА ====================
+# /broadcast от админа — сообщение всем пользователям:
+# - получатели читаются из users порциями по tg_id (keyset-пагинация),
+#   вся таблица в память не загружается
+# - отправка идёт через outbox с PRIORITY_BROADCAST и своим лимитом
+#   ниже глобального: ответы живым пользователям уходят первыми,
+#   и на них всегда остаётся запас из лимита Telegram
+# - одновременно в полёте не больше window сообщений; 429 по чату
+#   outbox переживает сам (пауза retry_after и повтор)
+# - прогресс сохраняется в broadcasts: пауза, остановка или падение
+#   бота — рассылка продолжается с последнего отправленного tg_id
+# - 403 (бот заблокирован, аккаунт удалён) и «chat not found» помечают
+#   пользователя users.blocked = 1, следующие рассылки его пропускают
+
+RESULTS = metrics.Counter(
+    "bot_broadcast_messages_total", "Сообщения рассылки по результату", ("result",)
+)
+
+
+def _is_unreachable(error):
+    if not isinstance(error, ApiTelegramException):
+        return False
+    if error.error_code == 403:
+        return True
+    return error.error_code == 400 and "chat not found" in str(error.description).lower()
+
+
+class Broadcaster:
+    def __init__(self, bot, outbox, store, rate=20, window=50, chunk=500, progress_interval=5):
+        """
+        bot — синхронный TeleBot, outbox — его очередь исходящих,
+        store — db_manager.
+        """
+        self.bot = bot
+        self.outbox = outbox
+        self.store = store
+        self.rate = rate
+        self.window = window
+        self.chunk = chunk
+        self.progress_interval = progress_interval
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pause = threading.Event()
+        self._cancel = threading.Event()
+
+    # ==================== ПУБЛИЧНОЕ API ====================
+    # Методы возвращают текст ответа админу.
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def command(self, admin_id, argument):
+        """
+        /broadcast <текст | pause | resume | cancel>. None — ответа не нужно,
+        админ получит сообщение с прогрессом.
+        """
+        argument = (argument or "").strip()
+        action = argument.lower()
+
+        if not argument:
+            return texts.BROADCAST_USAGE
+        if action == "pause":
+            return self.pause()
+        if action == "resume":
+            return self.resume(admin_id)
+        if action == "cancel":
+            return self.cancel()
+        return self.start(admin_id, argument)
+
+    def start(self, admin_id, text):
+        with self._lock:
+            if self.running():
+                return texts.BROADCAST_RUNNING
+            if self.store.get_unfinished_broadcast() is not None:
+                return texts.BROADCAST_UNFINISHED
+
+            self.store.create_broadcast(text)
+            self._launch(admin_id, self.store.get_unfinished_broadcast())
+        return None
+
+    def resume(self, admin_id):
+        with self._lock:
+            if self.running():
+                return texts.BROADCAST_RUNNING
+
+            row = self.store.get_unfinished_broadcast()
+            if row is None:
+                return texts.BROADCAST_NONE
+            self._launch(admin_id, row)
+        return None
+
+    def pause(self):
+        if not self.running():
+            return texts.BROADCAST_NONE
+        self._pause.set()
+        return texts.BROADCAST_PAUSING
+
+    def cancel(self):
+        with self._lock:
+            if self.running():
+                self._cancel.set()
+                self._pause.set()
+                return texts.BROADCAST_CANCELLING
+
+            row = self.store.get_unfinished_broadcast()
+            if row is None:
+                return texts.BROADCAST_NONE
+            broadcast_id, _, last_tg_id, sent, failed, blocked = row
+            self.store.save_broadcast(broadcast_id, "cancelled", last_tg_id, sent, failed, blocked)
+        return texts.BROADCAST_CANCELLED
+
+    def stop(self, timeout=30):
+        """
+        Останавливает рассылку при выключении бота: прогресс сохраняется,
+        /broadcast resume продолжит после перезапуска.
+        """
+        if self.running():
+            self._pause.set()
+            self._thread.join(timeout)
+
+    # ==================== ОТПРАВКА ====================
+
+    def _launch(self, admin_id, row):
+        # вызывается под self._lock
+        self._pause.clear()
+        self._cancel.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(admin_id, *row), name="broadcast", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, admin_id, broadcast_id, text, last_tg_id, sent, failed, blocked):
+        state = {"last_tg_id": last_tg_id, "sent": sent, "failed": failed, "blocked": blocked}
+        blocked_ids = []
+        inflight = deque()  # (tg_id, future) в порядке tg_id
+        # без всплеска: рассылка не должна разом съесть глобальный лимит
+        bucket = TokenBucket(self.rate, 1)
+
+        started = time.monotonic()
+        sent_before = sent
+        progress = self._progress_message(admin_id, texts.broadcast_progress("running", **state))
+        next_report = started + self.progress_interval
+
+        after = last_tg_id
+        try:
+            while not self._pause.is_set():
+                recipients = self.store.get_broadcast_recipients(after, self.chunk)
+                if not recipients:
+                    break
+
+                for tg_id in recipients:
+                    if self._pause.is_set():
+                        break
+
+                    self._settle(inflight, state, blocked_ids, self.window - 1)
+
+                    wait = bucket.wait_time()
+                    if wait > 0:
+                        time.sleep(wait)
+                    bucket.take()
+
+                    inflight.append((tg_id, self.outbox.submit(
+                        PRIORITY_BROADCAST, tg_id, self.bot.send_message, tg_id, text
+                    )))
+
+                    now = time.monotonic()
+                    if now >= next_report:
+                        self._settle(inflight, state, blocked_ids, len(inflight))
+                        self._checkpoint(broadcast_id, "running", state, blocked_ids)
+                        rate = (state["sent"] - sent_before) / (now - started)
+                        self._report(admin_id, progress, texts.broadcast_progress(
+                            "running", rate=rate, **state
+                        ))
+                        next_report = now + self.progress_interval
+
+                after = recipients[-1]
+
+        except Exception as e:
+            # например, ошибка БД — оставляем рассылку на паузе
+            print("❌ Рассылка прервана:", e)
+            self._pause.set()
+
+        finally:
+            # уже поставленные в outbox сообщения всё равно уйдут — дожидаемся
+            self._settle(inflight, state, blocked_ids, 0)
+
+            if self._cancel.is_set():
+                status = "cancelled"
+            elif self._pause.is_set():
+                status = "paused"
+            else:
+                status = "done"
+            self._checkpoint(broadcast_id, status, state, blocked_ids)
+
+            elapsed = time.monotonic() - started
+            rate = (state["sent"] - sent_before) / elapsed if elapsed > 0 else 0
+            self._report(admin_id, progress, texts.broadcast_progress(status, rate=rate, **state))
+            print(f"📣 Рассылка {broadcast_id}: {status}, отправлено {state['sent']}")
+
+    def _settle(self, inflight, state, blocked_ids, limit):
+        """
+        Забирает результаты завершённых отправок по порядку; пока в полёте
+        больше limit сообщений — ждёт самое старое. last_tg_id двигается
+        только по непрерывно завершённому префиксу, поэтому после
+        возобновления никто не получает сообщение дважды (кроме окна в полёте
+        при падении процесса).
+        """
+        while inflight:
+            tg_id, future = inflight[0]
+            if len(inflight) <= limit and not future.done():
+                break
+
+            try:
+                future.result()
+                state["sent"] += 1
+                RESULTS.inc(result="sent")
+            except Exception as e:
+                if _is_unreachable(e):
+                    state["blocked"] += 1
+                    blocked_ids.append(tg_id)
+                    RESULTS.inc(result="blocked")
+                else:
+                    state["failed"] += 1
+                    RESULTS.inc(result="failed")
+                    print(f"❌ Рассылка: {tg_id}: {e}")
+
+            inflight.popleft()
+            state["last_tg_id"] = tg_id
+
+    def _checkpoint(self, broadcast_id, status, state, blocked_ids):
+        if self.store.save_broadcast(broadcast_id, status, blocked_ids=blocked_ids, **state):
+            blocked_ids.clear()
+
+    def _progress_message(self, admin_id, text):
+        try:
+            progress = self.outbox.call(PRIORITY_ADMIN, admin_id, self.bot.send_message, admin_id, text)
+            progress.shown = text
+            return progress
+        except Exception as e:
+            print("❌ Рассылка: не удалось отправить прогресс:", e)
+            return None
+
+    def _report(self, admin_id, progress, text):
+        # Telegram отвечает ошибкой на правку без изменений
+        if progress is None or text == getattr(progress, "shown", None):
+            return
+        progress.shown = text
+        # per_chat=False: правки прогресса не занимают лимит чата админа
+        self.outbox.post(
+            PRIORITY_ADMIN, admin_id,
+            self.bot.edit_message_text, text, admin_id, progress.message_id,
+            per_chat=False, retries=0,
+        )
@@ -0,0 +1,185 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# ==================== КЭШ ОТВЕТОВ ====================
+# Два уровня: LRU/TTL в памяти процесса и (опционально) таблица
+# response_cache в SQLite. Одинаковые одновременные запросы склеиваются:
+# к Gemini идёт один вызов, остальные ждут его результат (single-flight).
+
+
+def normalize_prompt(text):
+    """
+    «Привет,  как дела?» и «привет, как дела» — один и тот же вопрос.
+    """
+    return " ".join(text.lower().split()).rstrip(" ?!.")
+
+
+def make_key(message, system_prompt, model_name):
+    raw = "\0".join((model_name, system_prompt or "", normalize_prompt(message)))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class _LeaderCancelled(Exception):
+    """
+    Ведущий async-запрос отменили: ведомые не отменяются вслед за ним,
+    а один из них считает значение сам.
+    """
+
+
+class ResponseCache:
+    # раз в столько записей из SQLite удаляются устаревшие строки
+    PURGE_EVERY = 1000
+
+    def __init__(self, max_size=1000, ttl=86400, store=None):
+        """
+        store — объект с get_cached_response / put_cached_response /
+        purge_cached_responses (db_manager) или None, если нужен только
+        кэш в памяти.
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._store = store
+
+        self._memory = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._inflight = {}           # key -> Future (потоки)
+        self._inflight_async = {}     # key -> asyncio.Future (event loop)
+        self._puts = 0
+
+        self.hits_memory = 0
+        self.hits_db = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    # ==================== GET / PUT ====================
+
+    def get(self, key):
+        now = time.monotonic()
+
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                if item[0] > now:
+                    self._memory.move_to_end(key)
+                    self.hits_memory += 1
+                    return item[1]
+                del self._memory[key]
+
+        if self._store is not None:
+            value = self._store.get_cached_response(key, self._ttl)
+            if value is not None:
+                self._remember(key, value)
+                self.hits_db += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if not value:
+            return
+
+        self._remember(key, value)
+
+        if self._store is not None:
+            self._store.put_cached_response(key, value)
+            self._puts += 1
+            if self._puts % self.PURGE_EVERY == 0:
+                self._store.purge_cached_responses(self._ttl)
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._memory[key] = (time.monotonic() + self._ttl, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self._max_size:
+                self._memory.popitem(last=False)
+
+    # ==================== SINGLE-FLIGHT ====================
+
+    def get_or_compute(self, key, compute):
+        """
+        Значение из кэша или compute(). Пока compute() выполняется,
+        остальные потоки с тем же ключом ждут его результат.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return flight.result()
+
+        try:
+            value = compute()
+            self.put(key, value)
+            flight.set_result(value)
+            return value
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    async def get_or_compute_async(self, key, compute):
+        """
+        То же для event loop: compute — функция без аргументов,
+        возвращающая корутину. SQLite-уровень читается в пуле потоков.
+        """
+        # asyncio нужен только async-режиму — sync-бот его не импортирует
+        import asyncio
+
+        value = await asyncio.to_thread(self.get, key)
+        if value is not None:
+            return value
+
+        flight = self._inflight_async.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        while flight is not None:
+            try:
+                return await asyncio.shield(flight)
+            except _LeaderCancelled:
+                # первый разбуженный ведомый станет ведущим, остальные — ждут его
+                flight = self._inflight_async.get(key)
+
+        flight = self._inflight_async[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await compute()
+            await asyncio.to_thread(self.put, key, value)
+            flight.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            flight.set_exception(_LeaderCancelled())
+            flight.exception()
+            raise
+        except Exception as e:
+            flight.set_exception(e)
+            # исключение уже получили ведомые; помечаем как прочитанное
+            flight.exception()
+            raise
+        finally:
+            self._inflight_async.pop(key, None)
+
+    # ==================== STATS ====================
+
+    def stats(self):
+        with self._lock:
+            size = len(self._memory)
+        return {
+            "size": size,
+            "hits_memory": self.hits_memory,
+            "hits_db": self.hits_db,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
@@ -3,8 +3,251 @@ import os
 
 load_dotenv()
 
+
+def _flag(name, default="0"):
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+# ошибки разбора копятся здесь и выводятся все сразу в check(),
+# а не падением int() на первой же
+_errors = []
+
+
+def _number(cast, name, default, kind):
+    value = os.getenv(name, '').strip()
+    if not value:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        _errors.append(f"{name}={value!r}: ожидается {kind}")
+        return default
+
+
+def _int(name, default=None):
+    return _number(int, name, default, "целое число")
+
+
+def _float(name, default=None):
+    return _number(float, name, default, "число")
+
+
+def _ids(name):
+    # Telegram id через запятую
+    ids = []
+    for value in os.getenv(name, '').replace(' ', '').split(','):
+        if value:
+            try:
+                ids.append(int(value))
+            except ValueError:
+                _errors.append(f"{name}: {value!r} — не число")
+    return ids
+
+
 AI_TOKEN   		= os.getenv("AI_TOKEN")
 BOT_TOKEN  		= os.getenv('BOT_TOKEN')
-ADMIN_ID   		= int(os.getenv('ADMIN_ID'))
+ADMIN_ID   		= _int('ADMIN_ID')
 DB_NAME    		= os.getenv('DB_NAME')
-SYSTEM_PROMPT   = os.getenv('SYSTEM_PROMPT')
\ No newline at end of file
+SYSTEM_PROMPT   = os.getenv('SYSTEM_PROMPT')
+
+# ==================== РЕЖИМ РАБОТЫ ====================
+
+# sync — TeleBot + пул потоков, async — AsyncTeleBot + asyncio (async_bot.py)
+BOT_MODE        = os.getenv('BOT_MODE', 'sync').lower()
+# число рабочих процессов (shards.py); 1 — всё в одном процессе
+SHARDS          = _int('SHARDS', 1)
+# апдейтов в очереди одного процесса, дальше диспетчер ждёт
+SHARD_QUEUE_SIZE = _int('SHARD_QUEUE_SIZE', 1000)
+# сколько секунд ждать места в полной очереди, потом апдейт отбрасывается
+SHARD_PUT_TIMEOUT = _float('SHARD_PUT_TIMEOUT', 1)
+# глобальный лимит одновременных запросов к AI
+# (async — семафор, sync — потоки честной очереди fairqueue.py)
+AI_CONCURRENCY  = _int('AI_CONCURRENCY', 32)
+
+
+# ==================== КВОТЫ ====================
+
+# держать дневные квоты в памяти и сбрасывать в SQLite раз в N секунд
+QUOTA_CACHE          = _flag('QUOTA_CACHE')
+QUOTA_FLUSH_INTERVAL = _float('QUOTA_FLUSH_INTERVAL', 5)
+
+
+# ==================== ЗАПИСЬ РЕЗУЛЬТАТОВ ====================
+
+# результаты пишутся в фоне пачками (executemany в одной транзакции)
+RESULTS_WRITE_BEHIND   = _flag('RESULTS_WRITE_BEHIND', '1')
+RESULTS_BATCH_SIZE     = _int('RESULTS_BATCH_SIZE', 100)
+RESULTS_FLUSH_INTERVAL = _float('RESULTS_FLUSH_INTERVAL', 1)
+RESULTS_QUEUE_SIZE     = _int('RESULTS_QUEUE_SIZE', 10000)
+
+
+# ==================== СТРИМИНГ ====================
+
+# ответ приходит частями: бот правит одно сообщение по мере генерации
+AI_STREAMING         = _flag('AI_STREAMING')
+# не чаще одной правки сообщения за N секунд (лимиты Telegram)
+STREAM_EDIT_INTERVAL = _float('STREAM_EDIT_INTERVAL', 1.5)
+
+
+# ==================== КЭШ ОТВЕТОВ ====================
+
+RESPONSE_CACHE       = _flag('RESPONSE_CACHE', '1')
+RESPONSE_CACHE_SIZE  = _int('RESPONSE_CACHE_SIZE', 1000)
+RESPONSE_CACHE_TTL   = _int('RESPONSE_CACHE_TTL', 86400)
+# второй уровень кэша в SQLite (переживает перезапуск)
+RESPONSE_CACHE_DB    = _flag('RESPONSE_CACHE_DB')
+
+
+# ==================== ПОЛУЧЕНИЕ АПДЕЙТОВ ====================
+
+# polling (по умолчанию) или webhook
+UPDATES_MODE        = os.getenv('UPDATES_MODE', 'polling').lower()
+# публичный https-адрес, который регистрируется в Telegram (setWebhook);
+# пусто — сервер просто слушает порт (локальная проверка, ручная настройка)
+WEBHOOK_URL         = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_HOST        = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT        = _int('WEBHOOK_PORT', 8443)
+WEBHOOK_PATH        = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET      = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_QUEUE_SIZE  = _int('WEBHOOK_QUEUE_SIZE', 1000)
+WEBHOOK_WORKERS     = _int('WEBHOOK_WORKERS', 1)
+
+
+# ==================== ИСХОДЯЩИЕ СООБЩЕНИЯ ====================
+
+# лимиты Telegram: ~30 сообщений/с на бота и ~1 сообщение/с в чат
+OUTBOX_GLOBAL_RATE  = _float('OUTBOX_GLOBAL_RATE', 30)
+OUTBOX_CHAT_RATE    = _float('OUTBOX_CHAT_RATE', 1)
+OUTBOX_CHAT_BURST   = _int('OUTBOX_CHAT_BURST', 3)
+OUTBOX_WORKERS      = _int('OUTBOX_WORKERS', 8)
+
+# рассылка (/broadcast): свой лимит ниже OUTBOX_GLOBAL_RATE — остаток
+# лимита Telegram остаётся на ответы пользователям
+BROADCAST_RATE              = _float('BROADCAST_RATE', 20)
+# сколько сообщений рассылки одновременно в очереди outbox
+BROADCAST_WINDOW            = _int('BROADCAST_WINDOW', 50)
+# сколько получателей читать из БД за раз
+BROADCAST_CHUNK             = _int('BROADCAST_CHUNK', 500)
+BROADCAST_PROGRESS_INTERVAL = _float('BROADCAST_PROGRESS_INTERVAL', 5)
+
+
+
+# ==================== HEALTH ====================
+
+# GET http://HEALTH_HOST:HEALTH_PORT/health; HEALTH_PORT=0 — выключено
+HEALTH_HOST              = os.getenv('HEALTH_HOST', '127.0.0.1')
+HEALTH_PORT              = _int('HEALTH_PORT', 8080)
+# цикл получения апдейтов молчит дольше N секунд — процесс нездоров
+HEALTH_MAX_HEARTBEAT_AGE = _float('HEALTH_MAX_HEARTBEAT_AGE', 120)
+# запрос к AI висит дольше N секунд — считаем его зависшим
+HEALTH_MAX_AI_CALL_AGE   = _float('HEALTH_MAX_AI_CALL_AGE', 300)
+
+
+
+# ==================== МЕТРИКИ ====================
+
+# гистограммы этапов и счётчики, GET /metrics на health-сервере
+METRICS             = _flag('METRICS', '1')
+# JSON-строка в лог на каждый этап с trace id сообщения
+TRACE_LOG           = _flag('TRACE_LOG')
+
+
+
+# ==================== ОЧЕРЕДЬ К AI ====================
+
+# одновременных запросов к AI от одного чата
+FAIR_PER_CHAT_INFLIGHT = _int('FAIR_PER_CHAT_INFLIGHT', 1)
+# сверх этого запрос сразу отклоняется (и не списывается)
+FAIR_MAX_QUEUE         = _int('FAIR_MAX_QUEUE', 500)
+FAIR_MAX_PER_CHAT      = _int('FAIR_MAX_PER_CHAT', 5)
+# вне очереди, через запятую (ADMIN_ID — всегда)
+PRIORITY_USERS         = _ids('PRIORITY_USERS')
+# сообщать позицию в очереди, если она не меньше N (0 — не сообщать)
+QUEUE_NOTIFY_POSITION  = _int('QUEUE_NOTIFY_POSITION', 1)
+
+
+
+# ==================== GEMINI ====================
+
+def _list(name, default=''):
+    return [x.strip() for x in os.getenv(name, default).split(',') if x.strip()]
+
+
+# несколько ключей через запятую; по умолчанию — один GOOGLE_API_KEY
+GEMINI_KEYS      = _list('GEMINI_KEYS') or _list('GOOGLE_API_KEY')
+# первая — основная, остальные — запасные по порядку;
+# по умолчанию — одна GEMINI_MODEL (или gemini-pro)
+GEMINI_MODELS    = _list('GEMINI_MODELS') or _list('GEMINI_MODEL', 'gemini-pro')
+# лимиты на каждую пару «ключ + модель»
+GEMINI_RPM       = _int('GEMINI_RPM', 15)
+GEMINI_TPM       = _int('GEMINI_TPM', 1000000)
+# пауза для ключа после 429 / ResourceExhausted
+GEMINI_COOLDOWN  = _float('GEMINI_COOLDOWN', 60)
+# сколько ждать свободный ключ, прежде чем вернуть ошибку
+GEMINI_MAX_WAIT  = _float('GEMINI_MAX_WAIT', 10)
+
+
+
+# ==================== ПАМЯТЬ ДИАЛОГА ====================
+
+MEMORY                   = _flag('MEMORY', '1')
+# бюджет токенов на последние реплики; старые сворачиваются в summary
+MEMORY_TOKENS            = _int('MEMORY_TOKENS', 2000)
+MEMORY_SUMMARY_TOKENS    = _int('MEMORY_SUMMARY_TOKENS', 400)
+# история забывается после стольких секунд тишины (0 — никогда):
+# первый вопрос нового разговора снова может взять ответ из кэша
+MEMORY_IDLE_TTL          = _int('MEMORY_IDLE_TTL', 3600)
+# системный промпт в кэше контекста Gemini (если модель и размер позволяют)
+GEMINI_CONTEXT_CACHE     = _flag('GEMINI_CONTEXT_CACHE')
+GEMINI_CONTEXT_CACHE_TTL = _int('GEMINI_CONTEXT_CACHE_TTL', 3600)
+
+
+
+# ==================== ХРАНЕНИЕ RESULTS ====================
+
+# строки results старше N дней переносятся в ARCHIVE_DIR (gzip JSONL по месяцам);
+# 0 — хранить всё в базе
+RETENTION_DAYS     = _int('RETENTION_DAYS', 0)
+RETENTION_INTERVAL = _float('RETENTION_INTERVAL', 3600)
+RETENTION_BATCH    = _int('RETENTION_BATCH', 1000)
+ARCHIVE_DIR        = os.getenv('ARCHIVE_DIR', 'archive')
+# сколько страниц возвращать файлу базы за один шаг incremental_vacuum
+VACUUM_PAGES       = _int('VACUUM_PAGES', 1000)
+
+
+
+# ==================== ПРОВЕРКА ====================
+
+def check():
+    """
+    Проверка настроек при запуске бота — до базы и сети. Все ошибки
+    выводятся сразу, с именем переменной, и бот не запускается.
+    """
+    errors = list(_errors)
+
+    if not BOT_TOKEN:
+        errors.append("BOT_TOKEN не задан — токен от @BotFather")
+    if ADMIN_ID is None and not any(e.startswith("ADMIN_ID=") for e in errors):
+        errors.append("ADMIN_ID не задан — ваш Telegram id числом")
+    if not DB_NAME:
+        errors.append("DB_NAME не задан — имя файла базы без .db")
+    if not GEMINI_KEYS:
+        errors.append("GEMINI_KEYS / GOOGLE_API_KEY не задан")
+    if BOT_MODE not in ("sync", "async"):
+        errors.append(f"BOT_MODE={BOT_MODE!r}: sync или async")
+    if UPDATES_MODE not in ("polling", "webhook"):
+        errors.append(f"UPDATES_MODE={UPDATES_MODE!r}: polling или webhook")
+    # с WEBHOOK_URL секрет генерируется и регистрируется сам (webhook_secret);
+    # без него сервер принял бы поддельный апдейт от кого угодно — хоть от «админа»
+    if UPDATES_MODE == "webhook" and not WEBHOOK_SECRET and not WEBHOOK_URL:
+        errors.append("UPDATES_MODE=webhook без WEBHOOK_URL: задайте WEBHOOK_SECRET")
+    if SHARDS < 1:
+        errors.append(f"SHARDS={SHARDS}: нужно 1 и больше")
+    # рабочие процессы shards.py — только sync (bot.py)
+    if SHARDS > 1 and BOT_MODE == "async":
+        errors.append(f"BOT_MODE=async и SHARDS={SHARDS}: процессы работают только в sync")
+
+    if errors:
+        raise SystemExit(
+            "❌ Ошибки в настройках (.env):\n" + "\n".join(f"  - {e}" for e in errors)
+        )
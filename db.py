@@ -1,17 +1,123 @@
+import atexit
+import queue
 import sqlite3
+import threading
+import time
 from contextlib import contextmanager
 from datetime import date
-from config import DB_NAME
+
+import metrics
+from config import (
+    DB_NAME,
+    QUOTA_CACHE,
+    QUOTA_FLUSH_INTERVAL,
+    RESULTS_WRITE_BEHIND,
+    RESULTS_BATCH_SIZE,
+    RESULTS_FLUSH_INTERVAL,
+    RESULTS_QUEUE_SIZE,
+)
 
 DB_PATH = f"{DB_NAME}.db"
 DEFAULT_DAILY_LIMIT = 150
 
+# день квоты хранится числом: дней с 1970-01-01 (по локальной дате)
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# WAL: читатели не блокируют писателя и наоборот.
+# synchronous=NORMAL в WAL безопасен при падении процесса (теряется
+# максимум последняя транзакция при потере питания).
+SQLITE_PRAGMAS = (
+    # свободные страницы возвращаются файлу через PRAGMA incremental_vacuum
+    # (retention.py). Должно идти до journal_mode: на новой базе тот создаёт
+    # файл, а у существующей auto_vacuum меняется только после VACUUM
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",      # ~16 МБ страничного кэша
+    "PRAGMA mmap_size=134217728",    # 128 МБ
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=10000",
+)
+
+# сколько подготовленных выражений держит каждое соединение
+STATEMENT_CACHE_SIZE = 128
+
+# версия схемы (PRAGMA user_version), см. DatabaseManager.migrate
+SCHEMA_VERSION = 7
+
+# меньше любого tg_id: с него начинается рассылка (id групп отрицательные)
+FIRST_TG_ID = -2 ** 63
+
+# то же, что today_epoch(), но внутри SQLite (для триггеров статистики)
+SQL_TODAY = "CAST(julianday('now', 'localtime') - 2440587.5 AS INTEGER)"
+
+
+def _sql_day(column):
+    # день записи по её created_at (CURRENT_TIMESTAMP хранится в UTC)
+    return f"CAST(julianday({column}, 'localtime') - 2440587.5 AS INTEGER)"
+
+
+# ==================== CONNECTIONS ====================
+# Одно постоянное соединение на поток: sqlite3-соединение нельзя
+# безопасно делить между потоками без внешней блокировки, а открывать
+# новое на каждый запрос — это open + чтение схемы + close каждый раз.
+
+_local = threading.local()
+_connections = {}  # thread -> connection, чтобы закрыть всё при остановке
+_connections_lock = threading.Lock()
+_generation = 0    # растёт при close_connections(), старые соединения сбрасываются
+
+
+def _connect():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=10,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        # закрывается из close_connections() в другом потоке;
+        # для запросов соединение используется только своим потоком
+        check_same_thread=False,
+    )
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.generation == _generation:
+        return conn
+
+    conn = _connect()
+    _local.conn = conn
+    _local.generation = _generation
+
+    with _connections_lock:
+        # заодно закрываем соединения завершившихся потоков
+        for thread in [t for t in _connections if not t.is_alive()]:
+            _connections.pop(thread).close()
+        _connections[threading.current_thread()] = conn
+
+    return conn
+
+
+def close_connections():
+    global _generation
+
+    with _connections_lock:
+        _generation += 1
+        for conn in _connections.values():
+            try:
+                conn.close()
+            except Exception as e:
+                print(f"Ошибка при закрытии соединения: {e}")
+        _connections.clear()
+
 
 # ==================== DB CONTEXT ====================
 
 @contextmanager
 def get_db():
-    conn = sqlite3.connect(DB_PATH, timeout=10)
+    conn = get_connection()
     try:
         yield conn
         conn.commit()
@@ -19,52 +125,574 @@ def get_db():
         conn.rollback()
         print(f"Database error: {e}")
         raise
-    finally:
-        conn.close()
+
+
+# ==================== QUOTA ====================
+
+def today_epoch():
+    return date.today().toordinal() - EPOCH_ORDINAL
+
+
+def epoch_to_iso(day):
+    return date.fromordinal(day + EPOCH_ORDINAL).isoformat()
+
+
+# сброс по новому дню и списание — одним UPDATE, без отдельного SELECT.
+# В SET все выражения видят старые значения строки.
+USE_REQUEST_SQL = """
+    UPDATE users
+    SET requests_left = CASE WHEN reset_day = :day
+                             THEN requests_left ELSE daily_limit END - 1,
+        last_reset    = CASE WHEN reset_day = :day
+                             THEN last_reset ELSE :today END,
+        reset_day     = :day
+    WHERE tg_id = :tg_id
+      AND CASE WHEN reset_day = :day
+               THEN requests_left ELSE daily_limit END > 0
+"""
+
+# применение накопленной в QuotaCache дельты (used может быть < 0 при возвратах)
+APPLY_QUOTA_DELTA_SQL = """
+    UPDATE users
+    SET requests_left = MAX(0, MIN(daily_limit,
+                            CASE WHEN reset_day = :day
+                                 THEN requests_left ELSE daily_limit END - :used)),
+        last_reset    = CASE WHEN reset_day = :day
+                             THEN last_reset ELSE :today END,
+        reset_day     = :day
+    WHERE tg_id = :tg_id AND reset_day <= :day
+"""
+
+
+class QuotaCache:
+    """
+    Дневная квота в памяти процесса: разрешить/отказать без похода в SQLite.
+    Списания и возвраты копятся дельтами и сбрасываются в БД раз в
+    flush_interval секунд и при остановке.
+
+    Считает, что квотой конкретного пользователя управляет только этот процесс.
+    """
+
+    # через сколько секунд простоя «чистая» запись выкидывается из памяти
+    IDLE_TTL = 3600
+
+    def __init__(self, load, flush_interval=QUOTA_FLUSH_INTERVAL):
+        # load(tg_id, day) -> (daily_limit, requests_left) | None
+        self._load = load
+        self._flush_interval = flush_interval
+        # tg_id -> [day, left, limit, used, last_access]
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="quota-flush", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self._flush_interval + 5)
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self._flush_interval):
+            self.flush()
+
+    def _entry(self, tg_id, day):
+        """
+        Вызывается под self._lock. Возвращает запись на текущий день или None.
+        """
+        entry = self._entries.get(tg_id)
+        if entry is not None and entry[0] != day:
+            # новый день: дельта прошлого дня больше не важна
+            entry[0], entry[1], entry[3] = day, entry[2], 0
+        return entry
+
+    def _prime(self, tg_id, day):
+        """
+        Загружает запись из БД. False — пользователя нет в базе.
+        """
+        # читаем без блокировки, чтобы не тормозить остальных
+        row = self._load(tg_id, day)
+        if row is None:
+            return False
+
+        daily_limit, requests_left = row
+        with self._lock:
+            self._entries.setdefault(
+                tg_id, [day, requests_left, daily_limit, 0, time.monotonic()]
+            )
+        return True
+
+    def use(self, tg_id):
+        day = today_epoch()
+
+        # вторая попытка — если запись вытеснили между загрузкой и списанием
+        for _ in range(2):
+            with self._lock:
+                entry = self._entry(tg_id, day)
+                if entry is not None:
+                    entry[4] = time.monotonic()
+                    if entry[1] <= 0:
+                        return False
+                    entry[1] -= 1
+                    entry[3] += 1
+                    return True
+
+            if not self._prime(tg_id, day):
+                return False
+
+        return False
+
+    def refund(self, tg_id):
+        with self._lock:
+            entry = self._entry(tg_id, today_epoch())
+            if entry is None or entry[1] >= entry[2]:
+                return False
+            entry[1] += 1
+            entry[3] -= 1
+            return True
+
+    def left(self, tg_id):
+        with self._lock:
+            entry = self._entry(tg_id, today_epoch())
+            return None if entry is None else entry[1]
+
+    def flush(self):
+        now = time.monotonic()
+        rows = []
+
+        with self._lock:
+            for tg_id, entry in list(self._entries.items()):
+                day, _, _, used, last_access = entry
+                if used:
+                    rows.append({
+                        "tg_id": tg_id,
+                        "day": day,
+                        "today": epoch_to_iso(day),
+                        "used": used,
+                    })
+                    entry[3] = 0
+                elif now - last_access > self.IDLE_TTL:
+                    del self._entries[tg_id]
+
+        if not rows:
+            return
+
+        try:
+            with get_db() as conn:
+                conn.executemany(APPLY_QUOTA_DELTA_SQL, rows)
+        except Exception as e:
+            print(f"Ошибка при сохранении квот: {e}")
+            # возвращаем дельты, чтобы не потерять их до следующей попытки
+            with self._lock:
+                for row in rows:
+                    entry = self._entries.get(row["tg_id"])
+                    if entry is not None and entry[0] == row["day"]:
+                        entry[3] += row["used"]
+
+
+# ==================== RESULTS WRITER ====================
+
+INSERT_RESULT_SQL = """
+    INSERT INTO results (tg_id, prompt, result)
+    VALUES (?, ?, ?)
+"""
+
+
+class ResultsWriter:
+    """
+    Фоновая запись результатов: строки копятся в ограниченной очереди и
+    пишутся одной транзакцией через executemany — по достижении batch_size
+    или раз в flush_interval секунд. Ответ пользователю не ждёт fsync.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        batch_size=RESULTS_BATCH_SIZE,
+        flush_interval=RESULTS_FLUSH_INTERVAL,
+        max_queue=RESULTS_QUEUE_SIZE,
+    ):
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._closed = False
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="results-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """
+        Дописывает всё, что накопилось в очереди, и останавливает поток.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(self._STOP)
+        if self._thread is not None:
+            self._thread.join()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def put(self, row):
+        if not self._closed:
+            try:
+                self._queue.put_nowait(row)
+                return
+            except queue.Full:
+                # очередь переполнена — пишем сами (естественный backpressure)
+                pass
+
+        self._write([row])
+
+    def _run(self):
+        stopping = False
+
+        while not stopping:
+            batch = []
+            deadline = None
+
+            while len(batch) < self._batch_size:
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+
+                try:
+                    row = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                if row is self._STOP:
+                    stopping = True
+                    break
+
+                batch.append(row)
+                if deadline is None:
+                    deadline = time.monotonic() + self._flush_interval
+
+            if batch:
+                self._write(batch)
+
+        # после STOP в очереди могли остаться строки от put() в гонке с stop()
+        rest = []
+        while True:
+            try:
+                rest.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if rest:
+            self._write(rest)
+
+    def _write(self, rows):
+        try:
+            with get_db() as conn:
+                conn.executemany(INSERT_RESULT_SQL, rows)
+        except Exception as e:
+            print(f"Ошибка при сохранении результатов ({len(rows)} шт.): {e}")
 
 
 # ==================== DATABASE MANAGER ====================
 
+@metrics.timed_methods("db")
 class DatabaseManager:
     def __init__(self):
-        self.create_tables()
+        self.migrate()
+
+        self.quota_cache = None
+        if QUOTA_CACHE:
+            self.quota_cache = QuotaCache(self._load_quota)
+            self.quota_cache.start()
+
+        # кто уже упёрся в лимит сегодня: (day, {tg_id}) —
+        # в daily_stats каждый пользователь попадает один раз за день
+        self._exhausted = (None, set())
+        self._exhausted_lock = threading.Lock()
+
+        # пользователи, отказавшиеся от кэша ответов (загружаются лениво)
+        self._cache_opt_out = None
+        self._cache_opt_out_lock = threading.Lock()
+
+        self.results_writer = None
+        if RESULTS_WRITE_BEHIND:
+            self.results_writer = ResultsWriter()
+            self.results_writer.start()
+
+    def close(self):
+        """
+        Сбрасывает накопленные данные и закрывает все соединения с БД.
+        Вызывается при остановке бота.
+        """
+        if self.results_writer is not None:
+            self.results_writer.stop()
+        if self.quota_cache is not None:
+            self.quota_cache.stop()
+        close_connections()
 
     # ==================== TABLES ====================
+    # Версия схемы хранится в самой базе (PRAGMA user_version). Обычный
+    # запуск читает только её; миграции выполняются, когда база старее
+    # кода. Изменение схемы — новый метод _migrate_N и SCHEMA_VERSION = N,
+    # старые шаги не меняются. Шаги идемпотентны: базы, созданные до
+    # user_version (версия 0), могли уже пройти часть из них.
+
+    def migrate(self):
+        """
+        Приводит схему к SCHEMA_VERSION. Возвращает версию базы до миграции.
+        """
+        conn = get_connection()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return version
 
-    def create_tables(self):
         with get_db() as conn:
+            # все шаги и новая версия — одной транзакцией; IMMEDIATE:
+            # одновременно стартующие процессы (shards.py) ждут друг друга
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+
             cursor = conn.cursor()
+            for step in range(version + 1, SCHEMA_VERSION + 1):
+                getattr(self, f"_migrate_{step}")(cursor)
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    tg_id INTEGER UNIQUE NOT NULL,
+        if version < SCHEMA_VERSION:
+            print(f"🗃 Схема базы обновлена: версия {version} → {SCHEMA_VERSION}")
+        return version
 
-                    daily_limit INTEGER NOT NULL DEFAULT 150,
-                    requests_left INTEGER NOT NULL DEFAULT 150,
-                    last_reset DATE NOT NULL,
+    def create_tables(self):
+        """
+        Прежнее имя migrate() — для кода, который вызывает его сам.
+        """
+        self.migrate()
 
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS results (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    tg_id INTEGER NOT NULL,
-                    prompt TEXT NOT NULL,
-                    result TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+    @staticmethod
+    def _columns(cursor, table):
+        return {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
 
+    def _migrate_1(self, cursor):
+        """
+        Исходная схема. Новые столбцы добавляют свои шаги (reset_day — 2,
+        cache_opt_out — 3, blocked — 6): новая база проходит ту же историю,
+        что и обновлённая.
+        """
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tg_id INTEGER UNIQUE NOT NULL,
+
+                daily_limit INTEGER NOT NULL DEFAULT 150,
+                requests_left INTEGER NOT NULL DEFAULT 150,
+                last_reset DATE NOT NULL,
+
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tg_id INTEGER NOT NULL,
+                prompt TEXT NOT NULL,
+                result TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_tg_id ON users(tg_id);"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_results_tg_id ON results(tg_id);"
+        )
+
+    def _migrate_2(self, cursor):
+        # старые базы: день сброса хранился только датой в last_reset
+        if "reset_day" not in self._columns(cursor, "users"):
             cursor.execute(
-                "CREATE INDEX IF NOT EXISTS idx_users_tg_id ON users(tg_id);"
+                "ALTER TABLE users ADD COLUMN reset_day INTEGER NOT NULL DEFAULT 0"
             )
             cursor.execute(
-                "CREATE INDEX IF NOT EXISTS idx_results_tg_id ON results(tg_id);"
+                "UPDATE users SET reset_day = "
+                "CAST(julianday(last_reset) - julianday('1970-01-01') AS INTEGER)"
             )
 
+    def _migrate_3(self, cursor):
+        if "cache_opt_out" not in self._columns(cursor, "users"):
+            cursor.execute(
+                "ALTER TABLE users ADD COLUMN cache_opt_out INTEGER NOT NULL DEFAULT 0"
+            )
+
+        # кэш ответов AI: ключ — sha256 от модели, системного промпта и вопроса
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS response_cache (
+                prompt_hash TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+
+    def _migrate_4(self, cursor):
+        # память диалога: краткое содержание + последние реплики (JSON)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chat_memory (
+                tg_id INTEGER PRIMARY KEY,
+                summary TEXT NOT NULL DEFAULT '',
+                turns TEXT NOT NULL DEFAULT '[]',
+                updated_at INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+
+    def _migrate_5(self, cursor):
+        """
+        Счётчики и дневные агрегаты для /stats. Их ведут триггеры
+        на users и results, поэтому статистика читается без COUNT(*)
+        по растущим таблицам.
+        """
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        """)
+
+        # day — дней с 1970-01-01 по локальной дате, как reset_day
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                day INTEGER PRIMARY KEY,
+                new_users INTEGER NOT NULL DEFAULT 0,
+                requests INTEGER NOT NULL DEFAULT 0,
+                active_users INTEGER NOT NULL DEFAULT 0,
+                quota_exhausted INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+        # кто уже считался активным в этот день
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS daily_active (
+                day INTEGER NOT NULL,
+                tg_id INTEGER NOT NULL,
+                PRIMARY KEY (day, tg_id)
+            ) WITHOUT ROWID
+        """)
+
+        # переносим то, что уже есть в базе. Делается до создания
+        # триггеров, чтобы не посчитать дважды
+        if cursor.execute("SELECT 1 FROM counters WHERE name = 'users'").fetchone() is None:
+            self._backfill_stats(cursor)
+
+        # results не уменьшает счётчик при удалении: архивирование старых
+        # результатов не должно менять число запросов за всё время.
+        # По одному execute, не executescript: тот сначала делает COMMIT
+        # и вывел бы шаги из транзакции миграции
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS stats_user_added
+            AFTER INSERT ON users
+            BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'users';
+                INSERT INTO daily_stats (day, new_users) VALUES ({SQL_TODAY}, 1)
+                ON CONFLICT(day) DO UPDATE SET new_users = new_users + 1;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS stats_user_removed
+            AFTER DELETE ON users
+            BEGIN
+                UPDATE counters SET value = value - 1 WHERE name = 'users';
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS stats_result_added
+            AFTER INSERT ON results
+            BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'requests';
+                INSERT INTO daily_stats (day, requests) VALUES ({SQL_TODAY}, 1)
+                ON CONFLICT(day) DO UPDATE SET requests = requests + 1;
+                INSERT OR IGNORE INTO daily_active (day, tg_id)
+                VALUES ({SQL_TODAY}, NEW.tg_id);
+            END
+        """)
+        # срабатывает только на первый запрос пользователя за день
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS stats_active_added
+            AFTER INSERT ON daily_active
+            BEGIN
+                INSERT INTO daily_stats (day, active_users) VALUES (NEW.day, 1)
+                ON CONFLICT(day) DO UPDATE SET active_users = active_users + 1;
+            END
+        """)
+
+    def _backfill_stats(self, cursor):
+        # один раз за жизнь базы — полные проходы здесь допустимы
+        cursor.execute("""
+            INSERT OR REPLACE INTO counters (name, value)
+            SELECT 'users', COUNT(*) FROM users
+            UNION ALL
+            SELECT 'requests', COUNT(*) FROM results
+        """)
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO daily_active (day, tg_id)
+            SELECT DISTINCT {_sql_day('created_at')}, tg_id FROM results
+        """)
+        cursor.execute(f"""
+            INSERT INTO daily_stats (day, requests, active_users)
+            SELECT {_sql_day('created_at')} AS d, COUNT(*), COUNT(DISTINCT tg_id)
+            FROM results GROUP BY d
+        """)
+        cursor.execute(f"""
+            INSERT INTO daily_stats (day, new_users)
+            SELECT {_sql_day('created_at')} AS d, COUNT(*) FROM users GROUP BY d
+            ON CONFLICT(day) DO UPDATE SET new_users = excluded.new_users
+        """)
+
+    def _migrate_6(self, cursor):
+        # бот заблокирован пользователем / аккаунт удалён — рассылка пропускает
+        if "blocked" not in self._columns(cursor, "users"):
+            cursor.execute(
+                "ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0"
+            )
+
+        # рассылки: last_tg_id — до какого пользователя включительно отправлено
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                last_tg_id INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+    def _migrate_7(self, cursor):
+        """
+        Рассылка начинается с FIRST_TG_ID, а не с 0: группы (отрицательные
+        id) больше не пропускаются. Ещё не начатые рассылки (last_tg_id = 0:
+        положительных id они не прошли) переводим на начало.
+        """
+        cursor.execute(
+            """
+            UPDATE broadcasts SET last_tg_id = ?
+            WHERE last_tg_id = 0 AND status IN ('running', 'paused')
+            """,
+            (FIRST_TG_ID,)
+        )
+
     # ==================== USERS ====================
 
     def add_user(self, tg_id, daily_limit=DEFAULT_DAILY_LIMIT):
@@ -76,68 +704,128 @@ class DatabaseManager:
                 cursor.execute(
                     """
                     INSERT OR IGNORE INTO users
-                    (tg_id, daily_limit, requests_left, last_reset)
-                    VALUES (?, ?, ?, ?)
+                    (tg_id, daily_limit, requests_left, last_reset, reset_day)
+                    VALUES (?, ?, ?, ?, ?)
                     """,
-                    (tg_id, daily_limit, daily_limit, today)
+                    (tg_id, daily_limit, daily_limit, today, today_epoch())
                 )
-                return cursor.rowcount > 0
+                if cursor.rowcount > 0:
+                    return True
+
+                # пользователь вернулся после блокировки бота
+                cursor.execute(
+                    "UPDATE users SET blocked = 0 WHERE tg_id = ? AND blocked = 1",
+                    (tg_id,)
+                )
+                return False
         except Exception as e:
             print(f"Ошибка при добавлении пользователя: {e}")
             return False
 
     def get_user_requests(self, tg_id):
+        if self.quota_cache is not None:
+            left = self.quota_cache.left(tg_id)
+            if left is not None:
+                return left
+
+        row = self._load_quota(tg_id, today_epoch())
+        return row[1] if row else 0
+
+    def _load_quota(self, tg_id, day):
+        """
+        Возвращает (daily_limit, requests_left) с учётом сброса по дню.
+        """
         try:
             with get_db() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT requests_left FROM users WHERE tg_id = ?",
-                    (tg_id,)
-                )
-                row = cursor.fetchone()
-                return row[0] if row else 0
+                return conn.execute(
+                    """
+                    SELECT daily_limit,
+                           CASE WHEN reset_day = ?
+                                THEN requests_left ELSE daily_limit END
+                    FROM users
+                    WHERE tg_id = ?
+                    """,
+                    (day, tg_id)
+                ).fetchone()
         except Exception as e:
             print(f"Ошибка при получении баланса: {e}")
-            return 0
+            return None
 
     # ==================== LIMIT LOGIC ====================
 
     def use_request(self, tg_id):
         """
         Списывает 1 запрос, если они ещё есть.
+        Дневной сброс выполняется в том же UPDATE.
         Возвращает True, если списание прошло успешно.
         """
+        if self.quota_cache is not None:
+            used = self.quota_cache.use(tg_id)
+        else:
+            used = self._use_request_db(tg_id)
+
+        if not used:
+            self._note_exhausted(tg_id)
+        return used
+
+    def _use_request_db(self, tg_id):
+        day = today_epoch()
+
         try:
             with get_db() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """
-                    UPDATE users
-                    SET requests_left = requests_left - 1
-                    WHERE tg_id = ? AND requests_left > 0
-                    """,
-                    (tg_id,)
+                cursor = conn.execute(
+                    USE_REQUEST_SQL,
+                    {"tg_id": tg_id, "day": day, "today": epoch_to_iso(day)}
                 )
                 return cursor.rowcount > 0
         except Exception as e:
             print(f"Ошибка при списании запроса: {e}")
             return False
 
+    def _note_exhausted(self, tg_id):
+        """
+        Отмечает в daily_stats, что пользователь сегодня исчерпал лимит.
+        Повторные отказы того же дня в БД не пишутся.
+        """
+        day = today_epoch()
+        with self._exhausted_lock:
+            if self._exhausted[0] != day:
+                self._exhausted = (day, set())
+            seen = self._exhausted[1]
+            if tg_id in seen:
+                return
+            seen.add(tg_id)
+
+        try:
+            with get_db() as conn:
+                conn.execute(
+                    """
+                    INSERT INTO daily_stats (day, quota_exhausted) VALUES (?, 1)
+                    ON CONFLICT(day) DO UPDATE SET quota_exhausted = quota_exhausted + 1
+                    """,
+                    (day,)
+                )
+        except Exception as e:
+            print(f"Ошибка при сохранении статистики: {e}")
+
     def add_request_back(self, tg_id):
         """
         Возвращает 1 запрос пользователю.
         Используется, если AI упал после списания.
         """
+        if self.quota_cache is not None:
+            return self.quota_cache.refund(tg_id)
+
         try:
             with get_db() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     """
                     UPDATE users
-                    SET requests_left = requests_left + 1
-                    WHERE tg_id = ?
+                    SET requests_left = MIN(requests_left + 1, daily_limit)
+                    WHERE tg_id = ? AND reset_day = ?
                     """,
-                    (tg_id,)
+                    (tg_id, today_epoch())
                 )
                 return cursor.rowcount > 0
         except Exception as e:
@@ -145,71 +833,347 @@ class DatabaseManager:
             return False
 
     def reset_daily_requests_if_needed(self, tg_id):
-        today = date.today().isoformat()
+        """
+        Явный дневной сброс. use_request и get_user_requests
+        учитывают новый день сами, поэтому на горячем пути не нужен.
+        """
+        day = today_epoch()
 
         try:
             with get_db() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
+                conn.execute(
                     """
-                    SELECT daily_limit, last_reset
-                    FROM users
-                    WHERE tg_id = ?
+                    UPDATE users
+                    SET requests_left = daily_limit, last_reset = ?, reset_day = ?
+                    WHERE tg_id = ? AND reset_day != ?
                     """,
-                    (tg_id,)
+                    (epoch_to_iso(day), day, tg_id, day)
                 )
-                row = cursor.fetchone()
+        except Exception as e:
+            print(f"Ошибка при дневном сбросе: {e}")
+
+    # ==================== RESULTS ====================
+
+    def add_result(self, tg_id, prompt, result):
+        if self.results_writer is not None:
+            self.results_writer.put((tg_id, prompt, result))
+            return
 
-                if not row:
-                    return
+        try:
+            with get_db() as conn:
+                conn.execute(INSERT_RESULT_SQL, (tg_id, prompt, result))
+        except Exception as e:
+            print(f"Ошибка при сохранении результата: {e}")
 
-                daily_limit, last_reset = row
+    # ==================== RESPONSE CACHE ====================
 
-                if last_reset == today:
-                    return
+    def get_cached_response(self, prompt_hash, max_age):
+        try:
+            with get_db() as conn:
+                row = conn.execute(
+                    """
+                    SELECT response FROM response_cache
+                    WHERE prompt_hash = ? AND created_at >= ?
+                    """,
+                    (prompt_hash, int(time.time() - max_age))
+                ).fetchone()
+                return row[0] if row else None
+        except Exception as e:
+            print(f"Ошибка при чтении кэша ответов: {e}")
+            return None
 
-                cursor.execute(
+    def put_cached_response(self, prompt_hash, response):
+        try:
+            with get_db() as conn:
+                conn.execute(
                     """
-                    UPDATE users
-                    SET requests_left = ?, last_reset = ?
-                    WHERE tg_id = ?
+                    INSERT OR REPLACE INTO response_cache
+                    (prompt_hash, response, created_at)
+                    VALUES (?, ?, ?)
                     """,
-                    (daily_limit, today, tg_id)
+                    (prompt_hash, response, int(time.time()))
                 )
         except Exception as e:
-            print(f"Ошибка при дневном сбросе: {e}")
+            print(f"Ошибка при сохранении кэша ответов: {e}")
 
-    # ==================== RESULTS ====================
+    def purge_cached_responses(self, max_age):
+        try:
+            with get_db() as conn:
+                conn.execute(
+                    "DELETE FROM response_cache WHERE created_at < ?",
+                    (int(time.time() - max_age),)
+                )
+        except Exception as e:
+            print(f"Ошибка при очистке кэша ответов: {e}")
 
-    def add_result(self, tg_id, prompt, result):
+    def is_cache_opt_out(self, tg_id):
+        with self._cache_opt_out_lock:
+            if self._cache_opt_out is None:
+                with get_db() as conn:
+                    self._cache_opt_out = {
+                        row[0] for row in conn.execute(
+                            "SELECT tg_id FROM users WHERE cache_opt_out = 1"
+                        )
+                    }
+            return tg_id in self._cache_opt_out
+
+    def set_cache_opt_out(self, tg_id, opt_out):
         try:
             with get_db() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
+                conn.execute(
+                    "UPDATE users SET cache_opt_out = ? WHERE tg_id = ?",
+                    (int(opt_out), tg_id)
+                )
+        except Exception as e:
+            print(f"Ошибка при изменении настройки кэша: {e}")
+            return
+
+        # прогреваем множество, чтобы дальше изменять его на месте
+        self.is_cache_opt_out(tg_id)
+        with self._cache_opt_out_lock:
+            if opt_out:
+                self._cache_opt_out.add(tg_id)
+            else:
+                self._cache_opt_out.discard(tg_id)
+
+    # ==================== CHAT MEMORY ====================
+
+    def get_memory(self, tg_id, max_age=0):
+        """
+        (summary, turns) или None. max_age — не старше стольких секунд
+        с последней реплики (0 — без ограничения).
+        """
+        with get_db() as conn:
+            return conn.execute(
+                "SELECT summary, turns FROM chat_memory WHERE tg_id = ? AND updated_at >= ?",
+                (tg_id, self._memory_since(max_age))
+            ).fetchone()
+
+    def has_memory(self, tg_id, max_age=0):
+        """
+        Есть ли у чата история — без чтения и разбора JSON.
+        """
+        with get_db() as conn:
+            return bool(conn.execute(
+                "SELECT EXISTS(SELECT 1 FROM chat_memory WHERE tg_id = ? AND updated_at >= ?)",
+                (tg_id, self._memory_since(max_age))
+            ).fetchone()[0])
+
+    @staticmethod
+    def _memory_since(max_age):
+        return int(time.time() - max_age) if max_age else 0
+
+    def save_memory(self, tg_id, summary, turns):
+        try:
+            with get_db() as conn:
+                conn.execute(
                     """
-                    INSERT INTO results (tg_id, prompt, result)
-                    VALUES (?, ?, ?)
+                    INSERT OR REPLACE INTO chat_memory
+                    (tg_id, summary, turns, updated_at)
+                    VALUES (?, ?, ?, ?)
                     """,
-                    (tg_id, prompt, result)
+                    (tg_id, summary, turns, int(time.time()))
                 )
         except Exception as e:
-            print(f"Ошибка при сохранении результата: {e}")
+            print(f"Ошибка при сохранении истории диалога: {e}")
 
-    # ==================== STATS ====================
+    def clear_memory(self, tg_id):
+        with get_db() as conn:
+            conn.execute("DELETE FROM chat_memory WHERE tg_id = ?", (tg_id,))
 
-    def get_total_users(self):
+    # ==================== BROADCASTS ====================
+
+    def create_broadcast(self, text):
         with get_db() as conn:
             return conn.execute(
-                "SELECT COUNT(*) FROM users"
-            ).fetchone()[0]
+                "INSERT INTO broadcasts (text, last_tg_id) VALUES (?, ?)",
+                (text, FIRST_TG_ID)
+            ).lastrowid
 
-    def get_total_requests(self):
+    def get_unfinished_broadcast(self):
+        """
+        Последняя незавершённая рассылка (на паузе или прерванная
+        остановкой бота): (id, text, last_tg_id, sent, failed, blocked) или None.
+        """
         with get_db() as conn:
             return conn.execute(
-                "SELECT COUNT(*) FROM results"
-            ).fetchone()[0]
+                """
+                SELECT id, text, last_tg_id, sent, failed, blocked
+                FROM broadcasts
+                WHERE status IN ('running', 'paused')
+                ORDER BY id DESC LIMIT 1
+                """
+            ).fetchone()
+
+    def get_broadcast_recipients(self, after_tg_id, limit):
+        """
+        Следующая порция получателей по возрастанию tg_id (keyset-пагинация
+        по уникальному индексу: без OFFSET и без чтения всей таблицы).
+        """
+        with get_db() as conn:
+            return [
+                row[0] for row in conn.execute(
+                    """
+                    SELECT tg_id FROM users
+                    WHERE tg_id > ? AND blocked = 0
+                    ORDER BY tg_id
+                    LIMIT ?
+                    """,
+                    (after_tg_id, limit)
+                )
+            ]
+
+    def save_broadcast(self, broadcast_id, status, last_tg_id, sent, failed, blocked, blocked_ids=()):
+        """
+        Чекпоинт рассылки; заодно помечает недоступных пользователей.
+        """
+        try:
+            with get_db() as conn:
+                conn.execute(
+                    """
+                    UPDATE broadcasts
+                    SET status = ?, last_tg_id = ?, sent = ?, failed = ?, blocked = ?,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                    """,
+                    (status, last_tg_id, sent, failed, blocked, broadcast_id)
+                )
+                conn.executemany(
+                    "UPDATE users SET blocked = 1 WHERE tg_id = ?",
+                    [(tg_id,) for tg_id in blocked_ids]
+                )
+                return True
+        except Exception as e:
+            print(f"Ошибка при сохранении рассылки: {e}")
+            return False
+
+    # ==================== RETENTION ====================
+    # Старые results переносятся в архив (retention.py); archived_results_id
+    # в counters — id последней перенесённой строки.
+
+    def get_results_after(self, after_id, limit):
+        """
+        (id, tg_id, prompt, result, created_at) с id > after_id по возрастанию.
+        """
+        with get_db() as conn:
+            return conn.execute(
+                """
+                SELECT id, tg_id, prompt, result, created_at
+                FROM results
+                WHERE id > ?
+                ORDER BY id
+                LIMIT ?
+                """,
+                (after_id, limit)
+            ).fetchall()
+
+    def iter_results(self, after_id=0, tg_id=None):
+        """
+        Все строки results по возрастанию id — курсором, без загрузки в память.
+        """
+        sql = "SELECT id, tg_id, prompt, result, created_at FROM results WHERE id > ?"
+        params = [after_id]
+        if tg_id is not None:
+            sql += " AND tg_id = ?"
+            params.append(tg_id)
+
+        conn = get_connection()
+        yield from conn.execute(sql + " ORDER BY id", params)
+
+    def get_archive_watermark(self):
+        return self._counter("archived_results_id")
+
+    def delete_archived_results(self, first_id, last_id):
+        """
+        Удаляет строки, уже записанные в архив, и сдвигает отметку —
+        в одной транзакции.
+        """
+        with get_db() as conn:
+            conn.execute(
+                "DELETE FROM results WHERE id BETWEEN ? AND ?", (first_id, last_id)
+            )
+            conn.execute(
+                """
+                INSERT INTO counters (name, value) VALUES ('archived_results_id', ?)
+                ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)
+                """,
+                (last_id,)
+            )
+
+    def incremental_vacuum(self, pages):
+        """
+        Возвращает файлу до pages свободных страниц. Возвращает, сколько
+        свободных страниц осталось.
+        """
+        conn = get_connection()
+        # через execute() pragma делает только первый шаг (одну страницу),
+        # executescript выполняет её до конца
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def get_db_size(self):
+        """
+        (страниц всего, свободных страниц, размер страницы, auto_vacuum).
+        """
+        conn = get_connection()
+        return tuple(
+            conn.execute(f"PRAGMA {name}").fetchone()[0]
+            for name in ("page_count", "freelist_count", "page_size", "auto_vacuum")
+        )
+
+    def vacuum(self):
+        """
+        Полный VACUUM: переписывает файл целиком и включает auto_vacuum
+        на старой базе. Блокирует запись на всё время — только вручную.
+        """
+        conn = get_connection()
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+
+    # ==================== STATS ====================
+
+    # Счётчики ведут триггеры (см. _migrate_5): чтение — поиск по ключу
+
+    def _counter(self, name):
+        with get_db() as conn:
+            row = conn.execute(
+                "SELECT value FROM counters WHERE name = ?", (name,)
+            ).fetchone()
+            return row[0] if row else 0
+
+    def get_total_users(self):
+        return self._counter("users")
+
+    def get_total_requests(self):
+        return self._counter("requests")
+
+    def get_daily_stats(self, days=7):
+        """
+        Дневные агрегаты за последние days дней, начиная с сегодняшнего:
+        [("2024-05-01", new_users, requests, active_users, quota_exhausted), ...].
+        Дни без активности возвращаются нулями.
+        """
+        today = today_epoch()
+        with get_db() as conn:
+            rows = {
+                row[0]: row for row in conn.execute(
+                    """
+                    SELECT day, new_users, requests, active_users, quota_exhausted
+                    FROM daily_stats
+                    WHERE day > ?
+                    """,
+                    (today - days,)
+                )
+            }
+        return [
+            (epoch_to_iso(day), *rows.get(day, (day, 0, 0, 0, 0))[1:])
+            for day in range(today, today - days, -1)
+        ]
 
 
 # ==================== INSTANCE ====================
 
 db_manager = DatabaseManager()
+
+# на случай выхода без явного db_manager.close()
+atexit.register(db_manager.close)
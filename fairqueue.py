@@ -0,0 +1,194 @@
+import contextvars
+import threading
+import time
+from collections import deque
+
+import metrics
+
+# ==================== ЧЕСТНАЯ ОЧЕРЕДЬ К AI ====================
+# Между обработчиком сообщения и запросом к Gemini:
+# - round-robin по чатам: пока один пользователь ждёт ответ на десятое
+#   сообщение, первое сообщение другого пользователя уходит раньше
+# - не больше per_chat_inflight запросов одного чата одновременно
+#   (при 1 — ответы внутри чата идут строго по порядку)
+# - чаты из priority_ids (админ) обслуживаются вне очереди
+# - при слишком глубокой очереди submit сразу отказывает —
+#   обработчик возвращает запрос (add_request_back) и отвечает пользователю
+
+QUEUE_WAIT = metrics.Histogram(
+    "bot_ai_queue_wait_seconds", "Ожидание в очереди к AI"
+)
+SHED = metrics.Counter(
+    "bot_ai_queue_shed_total", "Запросы, отклонённые из-за переполненной очереди", ("reason",)
+)
+
+
+class _Job:
+    __slots__ = ("chat_id", "func", "args", "enqueued", "context")
+
+    def __init__(self, chat_id, func, args):
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.enqueued = time.monotonic()
+        self.context = contextvars.copy_context()
+
+
+class FairScheduler:
+    def __init__(self, workers=32, per_chat_inflight=1, max_queue=500, max_per_chat=5, priority_ids=()):
+        self._per_chat_inflight = per_chat_inflight
+        self._max_queue = max_queue
+        self._max_per_chat = max_per_chat
+        self._priority_ids = set(priority_ids)
+
+        self._cond = threading.Condition()
+        self._queues = {}           # chat_id -> deque[_Job]
+        self._inflight = {}         # chat_id -> сколько запросов сейчас у AI
+        self._ring = deque()        # чаты с ожидающими запросами по кругу
+        self._priority_ring = deque()
+        self._ringed = set()        # какие чаты сейчас стоят в одном из колец
+        self._pending = 0
+        self._idle = 0
+        self._stopped = False
+
+        self._threads = [
+            threading.Thread(target=self._run, name=f"ai-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    # ==================== ПУБЛИЧНОЕ API ====================
+
+    def submit(self, chat_id, func, *args):
+        """
+        Ставит func(*args) в очередь чата. Возвращает позицию в очереди
+        (0 — запрос уходит сразу) или None, если очередь переполнена.
+        """
+        priority = chat_id in self._priority_ids
+
+        with self._cond:
+            if self._stopped:
+                return None
+
+            queue = self._queues.get(chat_id)
+            if not priority:
+                if queue is not None and len(queue) >= self._max_per_chat:
+                    SHED.inc(reason="chat")
+                    return None
+                if self._pending >= self._max_queue:
+                    SHED.inc(reason="global")
+                    return None
+
+            if queue is None:
+                queue = self._queues[chat_id] = deque()
+            queue.append(_Job(chat_id, func, args))
+            self._pending += 1
+
+            position = self._position(chat_id, len(queue) - 1, priority)
+            self._schedule(chat_id)
+            self._cond.notify()
+
+        return position
+
+    def qsize(self):
+        return self._pending
+
+    def pending(self, chat_id):
+        queue = self._queues.get(chat_id)
+        return len(queue) if queue else 0
+
+    def stop(self, timeout=30):
+        """
+        Дожидается выполнения очереди (не дольше timeout) и останавливает потоки.
+        """
+        deadline = time.monotonic() + timeout
+        # опрашиваем без cond.wait, чтобы не перехватить notify у рабочих потоков
+        while (self._pending or self._inflight) and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+        with self._cond:
+            if self._pending:
+                print(f"⚠️ Очередь к AI: {self._pending} запросов не выполнено")
+            self._stopped = True
+            self._cond.notify_all()
+
+    # ==================== ПЛАНИРОВЩИК ====================
+
+    def _position(self, chat_id, index, priority):
+        # вызывается под self._cond; оценка для round-robin:
+        # впереди index своих запросов и до index + 1 от каждого другого чата
+        ahead = index
+        for other, queue in self._queues.items():
+            if other == chat_id:
+                continue
+            other_priority = other in self._priority_ids
+            if other_priority and not priority:
+                ahead += len(queue)
+            elif other_priority == priority:
+                ahead += min(len(queue), index + 1)
+
+        can_start = self._inflight.get(chat_id, 0) < self._per_chat_inflight
+        if can_start and ahead < self._idle:
+            return 0
+        return ahead + 1
+
+    def _schedule(self, chat_id):
+        # вызывается под self._cond: чат встаёт в кольцо, если ему есть
+        # что отправить и он не упёрся в лимит одновременных запросов
+        if chat_id in self._ringed or not self._queues.get(chat_id):
+            return
+        if self._inflight.get(chat_id, 0) >= self._per_chat_inflight:
+            return
+        ring = self._priority_ring if chat_id in self._priority_ids else self._ring
+        ring.append(chat_id)
+        self._ringed.add(chat_id)
+
+    def _next_job(self):
+        # вызывается под self._cond
+        for ring in (self._priority_ring, self._ring):
+            if not ring:
+                continue
+
+            chat_id = ring.popleft()
+            self._ringed.discard(chat_id)
+
+            queue = self._queues[chat_id]
+            job = queue.popleft()
+            if not queue:
+                del self._queues[chat_id]
+
+            self._pending -= 1
+            self._inflight[chat_id] = self._inflight.get(chat_id, 0) + 1
+            # в конец кольца — следующий запрос этого чата после остальных
+            self._schedule(chat_id)
+            return job
+
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    if self._stopped:
+                        return
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                    job = self._next_job()
+
+            QUEUE_WAIT.observe(time.monotonic() - job.enqueued)
+            try:
+                job.context.run(job.func, *job.args)
+            except Exception as e:
+                print("❌ Ошибка в очереди к AI:", e)
+            finally:
+                with self._cond:
+                    left = self._inflight[job.chat_id] - 1
+                    if left:
+                        self._inflight[job.chat_id] = left
+                    else:
+                        del self._inflight[job.chat_id]
+                    self._schedule(job.chat_id)
+                    self._cond.notify()
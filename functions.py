@@ -1,79 +1,313 @@
-from config import SYSTEM_PROMPT
-import os
-import re
-import html
+import threading
+
+from config import (
+    SYSTEM_PROMPT,
+    RESPONSE_CACHE,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_DB,
+    GEMINI_KEYS,
+    GEMINI_MODELS,
+    GEMINI_RPM,
+    GEMINI_TPM,
+    GEMINI_COOLDOWN,
+    GEMINI_MAX_WAIT,
+    GEMINI_CONTEXT_CACHE,
+    GEMINI_CONTEXT_CACHE_TTL,
+    MEMORY,
+    MEMORY_TOKENS,
+    MEMORY_SUMMARY_TOKENS,
+    MEMORY_IDLE_TTL,
+)
+from cache import ResponseCache, make_key
+from memory import ChatMemory
+from render import md_to_html
+from health import state as health
+import metrics
 
 # ==================== НАСТРОЙКИ ====================
 
-DEFAULT_MODEL = "gemini-pro"
+GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "max_output_tokens": 1024,
+}
 _model = None
+# первый запрос и фоновый прогрев не должны создать пул дважды
+_model_lock = threading.Lock()
 
 
 # ==================== MODEL INIT ====================
 
+def _model_name():
+    # основная модель; запасные из GEMINI_MODELS в ключ кэша не входят
+    return GEMINI_MODELS[0]
+
+
 def _get_model():
     """
-    Лениво создаёт модель Gemini.
+    Лениво создаёт пул ключей Gemini (gemini_pool.py). Снаружи он
+    выглядит как GenerativeModel: generate_content / generate_content_async.
     """
     global _model
 
     if _model is not None:
         return _model
 
-    api_key = os.getenv("GOOGLE_API_KEY")
-    if not api_key:
-        raise ValueError("GOOGLE_API_KEY не найден в .env файле")
-
-    import google.generativeai as genai
+    with _model_lock:
+        if _model is None:
+            _model = _create_model()
+    return _model
 
-    genai.configure(api_key=api_key)
 
-    model_name = os.getenv("GEMINI_MODEL", DEFAULT_MODEL)
+def _create_model():
+    from gemini_pool import GeminiPool
 
-    _model = genai.GenerativeModel(
-        model_name,
-        generation_config={
-            "temperature": 0.7,
-            "max_output_tokens": 1024,
-        }
+    pool = GeminiPool(
+        GEMINI_KEYS,
+        GEMINI_MODELS,
+        rpm=GEMINI_RPM,
+        tpm=GEMINI_TPM,
+        generation_config=GENERATION_CONFIG,
+        cooldown=GEMINI_COOLDOWN,
+        max_wait=GEMINI_MAX_WAIT,
+        # системный промпт уходит один раз, а не в каждом запросе
+        system_instruction=SYSTEM_PROMPT,
+        context_cache_ttl=GEMINI_CONTEXT_CACHE_TTL if GEMINI_CONTEXT_CACHE else 0,
     )
 
-    return _model
+    # тяжёлый импорт google.generativeai — сейчас, а не на первом запросе
+    import google.generativeai  # noqa: F401
+
+    return pool
+
+
+def warm_up_model(is_async=False):
+    """
+    Прогрев при запуске (в фоне): импорт google.generativeai, пул ключей
+    и клиенты основной модели — первый вопрос их уже не ждёт.
+    """
+    model = _get_model()
+    # у заглушки модели в bench/loadtest.py прогревать нечего
+    warm_up = getattr(model, "warm_up", None)
+    if warm_up is not None:
+        warm_up(is_async)
 
 
 # ==================== MARKDOWN → HTML ====================
+# Рендер и разбиение на сообщения живут в render.py.
+
+def md_to_html_partial(md: str) -> str:
+    """
+    Рендер недописанного ответа во время стриминга. Незакрытый блок
+    кода render.md_to_html сам закрывает в конце, так что HTML валиден.
+    """
+    return md_to_html(md)
+
+
+# ==================== RESPONSE CACHE ====================
+
+response_cache = None
+if RESPONSE_CACHE:
+    _store = None
+    if RESPONSE_CACHE_DB:
+        from db import db_manager as _store
+
+    response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, _store)
+
+    metrics.Callback(
+        "bot_response_cache_total", "Кэш ответов: попадания и промахи", "counter", "result",
+        lambda: {k: v for k, v in response_cache.stats().items() if k != "size"},
+    )
+
+
+def cache_key(message: str) -> str:
+    return make_key(message, SYSTEM_PROMPT, _model_name())
+
+
+def cached_response(message: str, chat_id=None):
+    """
+    Готовый markdown-ответ из кэша или None.
+    Если у чата есть история, ответ зависит от неё — кэш не используется.
+    """
+    if response_cache is None:
+        return None
+    if chat_id is not None and chat_memory is not None and chat_memory.has_history(chat_id):
+        return None
+    return response_cache.get(cache_key(message))
+
 
-def md_to_html(md: str) -> str:
-    md = html.escape(md)
+def remember_response(message: str, text: str):
+    if response_cache is not None:
+        response_cache.put(cache_key(message), text)
 
-    def block_code(match):
-        return f"<pre><code>{match.group(2)}</code></pre>"
 
-    md = re.sub(r"```([a-zA-Z0-9_-]+)?\n([\s\S]*?)```", block_code, md)
-    md = re.sub(r"`([^`]+)`", r"<code>\1</code>", md)
-    md = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", md)
-    md = re.sub(r"\*(.*?)\*", r"<i>\1</i>", md)
-    md = re.sub(r"^#+\s*(.*)$", r"<b>\1</b>", md, flags=re.MULTILINE)
+# ==================== ПАМЯТЬ ДИАЛОГА ====================
 
-    return md
+chat_memory = None
+if MEMORY:
+    from db import db_manager as _memory_store
+
+    chat_memory = ChatMemory(
+        _memory_store, MEMORY_TOKENS, MEMORY_SUMMARY_TOKENS, MEMORY_IDLE_TTL
+    )
+
+
+def remember_turn(chat_id, message: str, text: str):
+    if chat_memory is not None and chat_id is not None:
+        chat_memory.remember(chat_id, message, text)
+
+
+def forget_chat(chat_id):
+    if chat_memory is not None:
+        chat_memory.clear(chat_id)
 
 
 # ==================== MAIN FUNCTION ====================
 
-def get_ai_response(message: str):
+def _build_contents(message: str, chat_id=None):
+    """
+    Сообщения для Gemini: история чата (если включена память) и новый вопрос.
+    Системный промпт сюда не входит — он задан у модели.
+    Второе значение — была ли у чата история.
+    """
+    if chat_memory is None or chat_id is None:
+        return [{"role": "user", "parts": [message]}], False
+    return chat_memory.contents(chat_id, message)
+
+
+def _generate(contents) -> str:
+    model = _get_model()  # 🔑 КЛЮЧЕВАЯ СТРОКА
+
     try:
-        model = _get_model()  # 🔑 КЛЮЧЕВАЯ СТРОКА
+        with health.ai_call(), metrics.stage("ai.generate"):
+            response = model.generate_content(contents)
+        return response.text or ""
+    except Exception:
+        metrics.AI_ERRORS.inc()
+        raise
 
-        prompt = (
-            f"{SYSTEM_PROMPT}\n\n"
-            f"Пользователь:\n{message}"
+
+async def _generate_async(contents) -> str:
+    model = _get_model()
+
+    try:
+        with health.ai_call(), metrics.stage("ai.generate"):
+            response = await model.generate_content_async(contents)
+        return response.text or ""
+    except Exception:
+        metrics.AI_ERRORS.inc()
+        raise
+
+
+def get_ai_response(message: str, use_cache: bool = True, chat_id=None):
+    """
+    Ответ AI в HTML. Ошибки (Gemini, PoolExhausted) не перехватываются:
+    обработчик возвращает запрос и отвечает texts.AI_ERROR.
+    """
+    contents, has_history = _build_contents(message, chat_id)
+
+    if use_cache and not has_history and response_cache is not None:
+        text = response_cache.get_or_compute(
+            cache_key(message), lambda: _generate(contents)
         )
+    else:
+        text = _generate(contents)
 
-        response = model.generate_content(prompt)
-        text = response.text or ""
+    remember_turn(chat_id, message, text)
 
+    with metrics.stage("render"):
         return md_to_html(text), 0, 0
 
-    except Exception as e:
-        print("❌ ОШИБКА AI:", e)
-        return f"Ошибка при обращении к AI: {e}", 0, 0
+
+async def get_ai_response_async(message: str, use_cache: bool = True, chat_id=None):
+    """
+    То же, что get_ai_response, но не блокирует event loop:
+    запрос к Gemini идёт через generate_content_async,
+    история чата читается и пишется в отдельном потоке.
+    """
+    import asyncio
+
+    contents, has_history = await asyncio.to_thread(_build_contents, message, chat_id)
+
+    if use_cache and not has_history and response_cache is not None:
+        text = await response_cache.get_or_compute_async(
+            cache_key(message), lambda: _generate_async(contents)
+        )
+    else:
+        text = await _generate_async(contents)
+
+    await asyncio.to_thread(remember_turn, chat_id, message, text)
+
+    with metrics.stage("render"):
+        return md_to_html(text), 0, 0
+
+
+# ==================== STREAMING ====================
+
+def _chunk_text(chunk) -> str:
+    # служебные чанки (например, с finish_reason) не содержат текста
+    try:
+        return chunk.text or ""
+    except ValueError:
+        return ""
+
+
+def stream_ai_response(message: str, chat_id=None, use_cache: bool = True):
+    """
+    Генератор: отдаёт накопленный markdown-текст ответа по мере прихода чанков.
+    Дописанный ответ попадает в историю чата и (если истории не было) в кэш.
+    Ошибки не перехватываются — их обрабатывает вызывающий код.
+    """
+    model = _get_model()
+    contents, has_history = _build_contents(message, chat_id)
+
+    text = ""
+    try:
+        with health.ai_call():
+            # generate_content(stream=True) возвращается с первым чанком
+            with metrics.stage("ai.first_chunk"):
+                response = model.generate_content(contents, stream=True)
+
+            for chunk in response:
+                piece = _chunk_text(chunk)
+                if piece:
+                    text += piece
+                    yield text
+    except Exception:
+        metrics.AI_ERRORS.inc()
+        raise
+
+    if text:
+        if use_cache and not has_history:
+            remember_response(message, text)
+        remember_turn(chat_id, message, text)
+
+
+async def stream_ai_response_async(message: str, chat_id=None, use_cache: bool = True):
+    """
+    Асинхронная версия stream_ai_response.
+    """
+    import asyncio
+
+    model = _get_model()
+    contents, has_history = await asyncio.to_thread(_build_contents, message, chat_id)
+
+    text = ""
+    try:
+        with health.ai_call():
+            with metrics.stage("ai.first_chunk"):
+                response = await model.generate_content_async(contents, stream=True)
+
+            async for chunk in response:
+                piece = _chunk_text(chunk)
+                if piece:
+                    text += piece
+                    yield text
+    except Exception:
+        metrics.AI_ERRORS.inc()
+        raise
+
+    if text:
+        if use_cache and not has_history:
+            await asyncio.to_thread(remember_response, message, text)
+        await asyncio.to_thread(remember_turn, chat_id, message, text)
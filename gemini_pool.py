@@ -0,0 +1,356 @@
+import asyncio
+import datetime
+import threading
+import time
+
+from ratelimit import TokenBucket
+import metrics
+
+# ==================== ПУЛ КЛЮЧЕЙ GEMINI ====================
+# Несколько API-ключей и моделей вместо одного GenerativeModel.
+# Лимиты Gemini считаются на пару «ключ + модель», поэтому у каждой
+# пары свои token bucket'ы: запросы в минуту (RPM) и токены в минуту (TPM).
+#
+# - запрос уходит на самую свободную пару основной модели
+# - все пары основной модели исчерпаны — берём следующую модель из списка
+#   (обычно более быструю / дешёвую)
+# - ключ получил 429 / ResourceExhausted — пара «остывает» cooldown секунд,
+#   запрос повторяется на другой паре
+# - свободных пар нет — ждём не дольше max_wait, потом ошибка
+#
+# Системный промпт передаётся один раз как system_instruction модели,
+# а при context_cache_ttl > 0 — через кэш контекста Gemini (на каждую пару
+# свой: кэш привязан к ключу). Если модель или размер промпта кэш не
+# поддерживают, остаётся system_instruction.
+#
+# Снаружи пул выглядит как модель: generate_content / generate_content_async.
+
+CALLS = metrics.Counter(
+    "bot_gemini_calls_total", "Запросы к Gemini по ключам и моделям", ("key", "model")
+)
+COOLDOWNS = metrics.Counter(
+    "bot_gemini_cooldowns_total", "Ключ упёрся в квоту и отправлен остывать", ("key", "model")
+)
+FALLBACKS = metrics.Counter(
+    "bot_gemini_fallbacks_total", "Запрос ушёл не на основную модель", ("model",)
+)
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class _Slot:
+    """
+    Пара «ключ + модель» со своими лимитами.
+    """
+
+    def __init__(self, key, label, model_name, rpm, tpm):
+        self.key = key
+        self.label = label  # key1, key2… — сам ключ в метрики и логи не пишем
+        self.model_name = model_name
+        self.rpm = TokenBucket(rpm / 60, rpm)
+        self.tpm = TokenBucket(tpm / 60, tpm)
+        self.inflight = 0
+        self._model = None
+        self._async_model = None
+        self._cache_expires = 0.0
+        self._cache_failed = False
+        # модель и кэш контекста создаются один раз, даже если первые
+        # запросы пришли одновременно
+        self._build_lock = threading.Lock()
+
+    def wait_time(self, tokens, now):
+        return max(self.rpm.wait_time(1, now), self.tpm.wait_time(tokens, now))
+
+    def load(self, now):
+        # 0 — свободна, 1 — всё израсходовано
+        return 1 - min(self.rpm.fill_ratio(now), self.tpm.fill_ratio(now))
+
+    def model(self, pool, is_async=False):
+        """
+        GenerativeModel, привязанный к ключу этого слота: у genai один
+        глобальный configure(), поэтому клиент подставляем свой.
+        """
+        import google.ai.generativelanguage as glm
+
+        with self._build_lock:
+            if (
+                pool.context_cache_ttl and not self._cache_failed
+                and time.monotonic() > self._cache_expires
+            ):
+                # кэш контекста истёк — модели пересоздаются с новым
+                self._model = self._async_model = None
+
+            if is_async:
+                if self._async_model is None:
+                    model = self._build(pool)
+                    model._async_client = glm.GenerativeServiceAsyncClient(
+                        client_options={"api_key": self.key}
+                    )
+                    self._async_model = model
+                return self._async_model
+
+            if self._model is None:
+                model = self._build(pool)
+                model._client = glm.GenerativeServiceClient(client_options={"api_key": self.key})
+                self._model = model
+            return self._model
+
+    def _build(self, pool):
+        import google.generativeai as genai
+
+        cache_name = self._cached_content(pool)
+        if cache_name:
+            model = genai.GenerativeModel(self.model_name, generation_config=pool.generation_config)
+            # как GenerativeModel.from_cached_content, но без глобального клиента
+            model._cached_content = cache_name
+            return model
+
+        return genai.GenerativeModel(
+            self.model_name,
+            generation_config=pool.generation_config,
+            system_instruction=pool.system_instruction,
+        )
+
+    def _cached_content(self, pool):
+        if not pool.context_cache_ttl or not pool.system_instruction or self._cache_failed:
+            return None
+
+        import google.ai.generativelanguage as glm
+        from google.generativeai import protos
+
+        try:
+            client = glm.CacheServiceClient(client_options={"api_key": self.key})
+            cached = client.create_cached_content(
+                cached_content=protos.CachedContent(
+                    model=f"models/{self.model_name}",
+                    system_instruction=protos.Content(
+                        parts=[protos.Part(text=pool.system_instruction)]
+                    ),
+                    ttl=datetime.timedelta(seconds=pool.context_cache_ttl),
+                )
+            )
+        except Exception as e:
+            # например, промпт короче минимального размера кэша
+            self._cache_failed = True
+            print(f"⚠️ Кэш контекста для {self.label}/{self.model_name} недоступен: {e}")
+            return None
+
+        # обновляем с запасом, чтобы не попасть на истёкший кэш
+        self._cache_expires = time.monotonic() + pool.context_cache_ttl * 0.9
+        return cached.name
+
+
+def _is_quota_error(error):
+    from google.api_core import exceptions
+
+    return isinstance(error, exceptions.TooManyRequests)
+
+
+def _estimate_tokens(contents, max_output_tokens):
+    # грубо: ~4 символа на токен плюс максимум ответа; уточняется по usage_metadata
+    if isinstance(contents, str):
+        size = len(contents)
+    else:
+        size = sum(len(part) for item in contents for part in item["parts"])
+    return size // 4 + max_output_tokens
+
+
+class GeminiPool:
+    def __init__(
+        self, keys, models, rpm=15, tpm=1_000_000, generation_config=None,
+        cooldown=60, max_wait=10, system_instruction=None, context_cache_ttl=0,
+    ):
+        if not keys:
+            raise ValueError("GEMINI_KEYS / GOOGLE_API_KEY не найден в .env файле")
+
+        self.models = list(models)
+        self.generation_config = generation_config or {}
+        self.system_instruction = system_instruction or None
+        self.context_cache_ttl = context_cache_ttl
+        self.cooldown = cooldown
+        self.max_wait = max_wait
+
+        self._lock = threading.Lock()
+        # model_name -> [_Slot по ключам]
+        self._slots = {
+            model_name: [
+                _Slot(key, f"key{i + 1}", model_name, rpm, tpm)
+                for i, key in enumerate(keys)
+            ]
+            for model_name in self.models
+        }
+
+        metrics.Callback(
+            "bot_gemini_load", "Загрузка пар ключ/модель (0 — свободна, 1 — лимит)", "gauge", "slot",
+            self.loads,
+        )
+
+    def loads(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                f"{slot.label}/{slot.model_name}": round(slot.load(now), 3)
+                for slots in self._slots.values() for slot in slots
+            }
+
+    # ==================== ВЫБОР КЛЮЧА ====================
+
+    def _acquire(self, tokens, exclude):
+        """
+        Берёт лимиты у самой свободной пары. Возвращает (slot, None)
+        или (None, сколько ждать до освобождения).
+        """
+        now = time.monotonic()
+        wait = None
+
+        with self._lock:
+            for model_name in self.models:
+                best = None
+                for slot in self._slots[model_name]:
+                    if slot in exclude:
+                        continue
+                    slot_wait = slot.wait_time(tokens, now)
+                    if slot_wait > 0:
+                        wait = slot_wait if wait is None else min(wait, slot_wait)
+                        continue
+                    if best is None or (slot.load(now), slot.inflight) < (best.load(now), best.inflight):
+                        best = slot
+
+                if best is not None:
+                    best.rpm.take(1, now)
+                    best.tpm.take(tokens, now)
+                    best.inflight += 1
+                    return best, None
+
+        return None, wait
+
+    def _release(self, slot, estimated, response=None):
+        # response — ответ или чанк с usage_metadata; без него оценка остаётся
+        used = None
+        if response is not None:
+            usage = getattr(response, "usage_metadata", None)
+            used = getattr(usage, "total_token_count", None) if usage else None
+
+        with self._lock:
+            slot.inflight -= 1
+            if used:
+                # оценка была с запасом — возвращаем разницу (или доплачиваем)
+                if used < estimated:
+                    slot.tpm.give_back(estimated - used)
+                else:
+                    slot.tpm.charge(used - estimated)
+
+    def _cool_down(self, slot):
+        with self._lock:
+            slot.rpm.block(self.cooldown)
+            slot.tpm.block(self.cooldown)
+        COOLDOWNS.inc(key=slot.label, model=slot.model_name)
+        print(f"🧊 Gemini {slot.label}/{slot.model_name}: квота исчерпана, пауза {self.cooldown} с")
+
+    def _picked(self, slot):
+        CALLS.inc(key=slot.label, model=slot.model_name)
+        if slot.model_name != self.models[0]:
+            FALLBACKS.inc(model=slot.model_name)
+
+    def warm_up(self, is_async=False):
+        """
+        Создаёт клиентов (и кэш контекста) основной модели заранее, без
+        запросов к генерации. Async-клиенты привязаны к event loop —
+        их создаёт первый запрос.
+        """
+        if is_async:
+            return
+        for slot in self._slots[self.models[0]]:
+            slot.model(self)
+
+    def _max_output_tokens(self):
+        return int(self.generation_config.get("max_output_tokens", 1024))
+
+    # ==================== ЗАПРОСЫ ====================
+
+    def generate_content(self, prompt, stream=False):
+        tokens = _estimate_tokens(prompt, self._max_output_tokens())
+        deadline = time.monotonic() + self.max_wait
+        tried = set()
+
+        while True:
+            slot, wait = self._acquire(tokens, tried)
+            if slot is None:
+                if wait is None or time.monotonic() + wait > deadline:
+                    raise PoolExhausted("все ключи Gemini упёрлись в лимиты")
+                time.sleep(wait)
+                continue
+
+            self._picked(slot)
+            try:
+                response = slot.model(self).generate_content(prompt, stream=stream)
+            except BaseException as e:
+                self._release(slot, tokens)
+                if not isinstance(e, Exception) or not _is_quota_error(e):
+                    raise
+                self._cool_down(slot)
+                tried.add(slot)
+                continue
+
+            if stream:
+                return self._stream(slot, tokens, response)
+            self._release(slot, tokens, response)
+            return response
+
+    async def generate_content_async(self, prompt, stream=False):
+        tokens = _estimate_tokens(prompt, self._max_output_tokens())
+        deadline = time.monotonic() + self.max_wait
+        tried = set()
+
+        while True:
+            slot, wait = self._acquire(tokens, tried)
+            if slot is None:
+                if wait is None or time.monotonic() + wait > deadline:
+                    raise PoolExhausted("все ключи Gemini упёрлись в лимиты")
+                await asyncio.sleep(wait)
+                continue
+
+            self._picked(slot)
+            try:
+                model = slot.model(self, is_async=True)
+                response = await model.generate_content_async(prompt, stream=stream)
+            except BaseException as e:
+                # в том числе CancelledError: слот не должен остаться занятым
+                self._release(slot, tokens)
+                if not isinstance(e, Exception) or not _is_quota_error(e):
+                    raise
+                self._cool_down(slot)
+                tried.add(slot)
+                continue
+
+            if stream:
+                return self._stream_async(slot, tokens, response)
+            self._release(slot, tokens, response)
+            return response
+
+    # ==================== STREAMING ====================
+    # Слот занят, пока ответ не дочитан (или не брошен), — иначе пул
+    # считал бы длинные стримы завершёнными и перегружал ключ. Токены
+    # списываются по usage_metadata: её несёт последний чанк.
+
+    def _stream(self, slot, tokens, response):
+        last = None
+        try:
+            for chunk in response:
+                if getattr(chunk, "usage_metadata", None):
+                    last = chunk
+                yield chunk
+        finally:
+            self._release(slot, tokens, last)
+
+    async def _stream_async(self, slot, tokens, response):
+        last = None
+        try:
+            async for chunk in response:
+                if getattr(chunk, "usage_metadata", None):
+                    last = chunk
+                yield chunk
+        finally:
+            self._release(slot, tokens, last)
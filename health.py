@@ -0,0 +1,195 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import HEALTH_HOST, HEALTH_PORT, HEALTH_MAX_HEARTBEAT_AGE, HEALTH_MAX_AI_CALL_AGE
+from db import get_db
+import metrics
+
+# ==================== HEALTH ====================
+# Состояние живого процесса бота, которое нельзя проверить снаружи
+# через SQLite: крутится ли цикл получения апдейтов, когда пришёл
+# последний апдейт, сколько запросов к AI сейчас в полёте и не
+# зависли ли они, глубина очередей и задержка БД.
+#
+#   GET /health  — JSON, 200 если всё хорошо, 503 если нет
+#   GET /metrics — метрики в формате Prometheus (metrics.py)
+#
+# healthcheck.py (docker) и watchdog.py только опрашивают этот адрес.
+
+
+class HealthState:
+    def __init__(self, max_heartbeat_age=120, max_ai_call_age=300):
+        self.max_heartbeat_age = max_heartbeat_age
+        self.max_ai_call_age = max_ai_call_age
+
+        self.started_at = time.monotonic()
+        self.heartbeat_at = None     # последний оборот polling / webhook-сервера
+        self.last_update_at = None   # последний полученный апдейт
+
+        self._lock = threading.Lock()
+        self._ai_calls = {}          # id -> время начала
+        self._ai_seq = 0
+        self._queues = {}            # имя -> функция, возвращающая размер
+        self._checks = []            # функции, возвращающие текст проблемы или None
+
+    # ==================== СОБЫТИЯ ====================
+
+    def beat(self):
+        self.heartbeat_at = time.monotonic()
+
+    def update_received(self):
+        self.last_update_at = time.monotonic()
+
+    @contextmanager
+    def ai_call(self):
+        with self._lock:
+            self._ai_seq += 1
+            call_id = self._ai_seq
+            self._ai_calls[call_id] = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._ai_calls[call_id]
+
+    def register_queue(self, name, size):
+        self._queues[name] = size
+
+    def register_check(self, check):
+        self._checks.append(check)
+
+    # ==================== СНИМОК ====================
+
+    def snapshot_queues(self):
+        queues = {}
+        for name, size in self._queues.items():
+            try:
+                queues[name] = size()
+            except Exception:
+                queues[name] = None
+        return queues
+
+    def snapshot(self):
+        now = time.monotonic()
+
+        def age(moment):
+            return None if moment is None else round(now - moment, 3)
+
+        with self._lock:
+            inflight = len(self._ai_calls)
+            oldest = min(self._ai_calls.values(), default=None)
+
+        queues = self.snapshot_queues()
+
+        db_latency = None
+        db_error = None
+        started = time.perf_counter()
+        try:
+            with get_db() as conn:
+                conn.execute("SELECT 1").fetchone()
+            db_latency = round((time.perf_counter() - started) * 1000, 3)
+        except Exception as e:
+            db_error = str(e)
+
+        problems = []
+        heartbeat_age = age(self.heartbeat_at)
+        # до первого оборота даём время на запуск
+        if heartbeat_age is None:
+            if now - self.started_at > self.max_heartbeat_age:
+                problems.append("no heartbeat")
+        elif heartbeat_age > self.max_heartbeat_age:
+            problems.append("heartbeat stale")
+        if oldest is not None and now - oldest > self.max_ai_call_age:
+            problems.append("ai call stuck")
+        if db_error is not None:
+            problems.append("db: " + db_error)
+        for check in self._checks:
+            problem = check()
+            if problem:
+                problems.append(problem)
+
+        return {
+            "status": "fail" if problems else "ok",
+            "problems": problems,
+            "uptime": round(now - self.started_at, 3),
+            "heartbeat_age": heartbeat_age,
+            "last_update_age": age(self.last_update_at),
+            "ai_inflight": inflight,
+            "ai_oldest_age": age(oldest),
+            "queues": queues,
+            "db_latency_ms": db_latency,
+        }
+
+
+state = HealthState(HEALTH_MAX_HEARTBEAT_AGE, HEALTH_MAX_AI_CALL_AGE)
+
+metrics.Callback(
+    "bot_queue_size", "Глубина внутренних очередей", "gauge", "queue",
+    lambda: state.snapshot_queues(),
+)
+metrics.Callback(
+    "bot_ai_inflight", "Запросы к AI в полёте", "gauge", "kind",
+    lambda: {"all": len(state._ai_calls)},
+)
+
+# ==================== HTTP ====================
+
+
+class HealthServer:
+    def __init__(self, host, port, health=state):
+        self._health = health
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+
+    def start(self):
+        threading.Thread(
+            target=self._httpd.serve_forever, name="health-server", daemon=True
+        ).start()
+        print(f"🩺 Health: http://{self._httpd.server_address[0]}:{self._httpd.server_address[1]}/health")
+
+    def shutdown(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _handler_class(self):
+        health = self._health
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = metrics.render().encode()
+                    return self._reply(200, "text/plain; version=0.0.4", body)
+
+                if self.path != "/health":
+                    return self._reply(404, "text/plain", b"")
+
+                snapshot = health.snapshot()
+                body = json.dumps(snapshot, ensure_ascii=False).encode()
+                code = 200 if snapshot["status"] == "ok" else 503
+                self._reply(code, "application/json", body)
+
+            def _reply(self, code, content_type, body):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def start_server():
+    """
+    Поднимает /health в фоне. HEALTH_PORT=0 — выключено.
+    """
+    if not HEALTH_PORT:
+        return None
+    server = HealthServer(HEALTH_HOST, HEALTH_PORT)
+    server.start()
+    return server
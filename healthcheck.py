@@ -1,20 +1,39 @@
-import sqlite3
 import os
 import sys
+import urllib.request
 
-DB_NAME = os.getenv("DB_NAME")
-if not DB_NAME:
-    print("DB_NAME not set")
-    sys.exit(1)
-
-DB_PATH = f"{DB_NAME}.db"
-
-try:
-    conn = sqlite3.connect(DB_PATH, timeout=5)
-    cursor = conn.cursor()
-    cursor.execute("SELECT 1")
-    conn.close()
-    sys.exit(0)
-except Exception as e:
-    print("DB healthcheck failed:", e)
-    sys.exit(1)
+# Дешёвая проверка: бот сам отдаёт своё состояние на /health (health.py),
+# здесь только HTTP-запрос — без SQLite и тяжёлых импортов.
+
+HEALTH_HOST = os.getenv("HEALTH_HOST", "127.0.0.1")
+HEALTH_PORT = os.getenv("HEALTH_PORT", "8080")
+
+# бот слушает на всех интерфейсах — стучимся локально
+if HEALTH_HOST in ("", "0.0.0.0", "::"):
+    HEALTH_HOST = "127.0.0.1"
+
+HEALTH_URL = f"http://{HEALTH_HOST}:{HEALTH_PORT}/health"
+
+
+def probe(timeout=5):
+    """
+    True, если бот ответил 200 на /health. Причину отказа печатает.
+    """
+    try:
+        with urllib.request.urlopen(HEALTH_URL, timeout=timeout) as response:
+            return response.status == 200
+    except urllib.error.HTTPError as e:
+        # 503: тело содержит список проблем
+        print("Healthcheck failed:", e.code, e.read().decode(errors="replace"))
+    except Exception as e:
+        print("Healthcheck failed:", e)
+    return False
+
+
+if __name__ == "__main__":
+    # те же проверки, что при запуске бота: с ошибкой в .env бот не
+    # работает, и healthcheck сразу показывает причину (docker inspect)
+    import config
+    config.check()
+
+    sys.exit(0 if probe() else 1)
@@ -0,0 +1,112 @@
+import json
+import re
+
+# ==================== ПАМЯТЬ ДИАЛОГА ====================
+# История чата хранится одной строкой в SQLite (chat_memory): краткое
+# содержание старой части разговора + последние реплики в JSON.
+# Размер истории ограничен бюджетом токенов: когда реплики не влезают,
+# самые старые пары «вопрос — ответ» сворачиваются в строку summary
+# (первое предложение вопроса и ответа), а summary, в свою очередь,
+# теряет самые старые строки. Поэтому входные токены на запрос
+# не растут вместе с длиной разговора. После idle_ttl секунд тишины
+# история считается законченной и новый разговор начинается с нуля.
+
+_SENTENCE_RE = re.compile(r"(.+?[.!?…])(?:\s|$)", re.S)
+_MARKUP_RE = re.compile(r"[*_`#>]+")
+
+
+def estimate_tokens(text):
+    # грубо: ~4 символа на токен (как и в gemini_pool)
+    return len(text) // 4 + 1
+
+
+def _gist(text, limit=160):
+    """
+    Первое предложение без разметки, не длиннее limit символов.
+    """
+    text = _MARKUP_RE.sub("", text).strip()
+    match = _SENTENCE_RE.match(text)
+    if match:
+        text = match.group(1)
+    text = " ".join(text.split())
+    if len(text) > limit:
+        text = text[:limit - 1].rstrip() + "…"
+    return text
+
+
+class ChatMemory:
+    def __init__(self, store, budget_tokens=2000, summary_tokens=400, idle_ttl=0):
+        """
+        store — объект с get_memory / has_memory / save_memory /
+        clear_memory (db_manager). idle_ttl — секунды тишины, после
+        которых история забывается (0 — никогда).
+        """
+        self.store = store
+        self.budget_tokens = budget_tokens
+        self.summary_tokens = summary_tokens
+        self.idle_ttl = idle_ttl
+
+    def load(self, tg_id):
+        row = self.store.get_memory(tg_id, self.idle_ttl)
+        if row is None:
+            return "", []
+        summary, turns = row
+        return summary, json.loads(turns)
+
+    def has_history(self, tg_id):
+        # пустой истории в таблице не бывает: remember всегда пишет реплики
+        return self.store.has_memory(tg_id, self.idle_ttl)
+
+    def contents(self, tg_id, message):
+        """
+        Список сообщений для Gemini: краткое содержание, последние реплики
+        и новый вопрос. Второе значение — была ли история.
+        """
+        summary, turns = self.load(tg_id)
+        contents = []
+
+        if summary:
+            contents.append({
+                "role": "user",
+                "parts": ["Кратко о чём мы говорили раньше:\n" + summary],
+            })
+            contents.append({"role": "model", "parts": ["Понял, учту."]})
+
+        for role, text in turns:
+            contents.append({"role": role, "parts": [text]})
+
+        contents.append({"role": "user", "parts": [message]})
+        return contents, bool(summary or turns)
+
+    def remember(self, tg_id, message, answer):
+        summary, turns = self.load(tg_id)
+        turns.append(["user", message])
+        turns.append(["model", answer])
+
+        summary, turns = self._compact(summary, turns)
+        self.store.save_memory(
+            tg_id, summary, json.dumps(turns, ensure_ascii=False, separators=(",", ":"))
+        )
+
+    def clear(self, tg_id):
+        self.store.clear_memory(tg_id)
+
+    # ==================== СЖАТИЕ ====================
+
+    def _compact(self, summary, turns):
+        used = sum(estimate_tokens(text) for _, text in turns)
+
+        # старые пары уходят в summary, пока история не влезет в бюджет;
+        # последнюю пару оставляем всегда, даже если она одна больше бюджета
+        lines = summary.splitlines() if summary else []
+        while used > self.budget_tokens and len(turns) > 2:
+            (_, question), (_, answer) = turns[0], turns[1]
+            del turns[:2]
+            used -= estimate_tokens(question) + estimate_tokens(answer)
+            lines.append(f"• {_gist(question)} → {_gist(answer)}")
+
+        # summary тоже ограничен: забываем самые старые строки
+        while lines and estimate_tokens("\n".join(lines)) > self.summary_tokens:
+            lines.pop(0)
+
+        return "\n".join(lines), turns
@@ -0,0 +1,308 @@
+import contextvars
+import functools
+import inspect
+import json
+import threading
+import time
+import uuid
+from bisect import bisect_left
+
+from config import METRICS, TRACE_LOG
+
+# ==================== МЕТРИКИ ====================
+# Счётчики и гистограммы с фиксированными бакетами, экспорт в текстовом
+# формате Prometheus (GET /metrics на health-сервере). Наблюдение — это
+# bisect и пара сложений под блокировкой, так что метрики можно держать
+# включёнными в проде.
+#
+#   with metrics.stage("ai.generate"):
+#       ...
+#
+#   @metrics.timed("db.use_request")
+#   def use_request(...): ...
+
+# секунды: от быстрых запросов в SQLite до долгих ответов Gemini
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)
+
+_registry = []
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = list(zip(labelnames, key))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not METRICS:
+            return
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [счётчики по бакетам (последний — +Inf), сумма, количество]
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        if not METRICS:
+            return
+        key = _label_key(self.labelnames, labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def totals(self):
+        """
+        {значения меток: (сумма, количество)} — для отчётов без Prometheus.
+        """
+        with self._lock:
+            return {key: (total, count) for key, (_, total, count) in self._values.items()}
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+
+        bounds = self.buckets + (float("inf"),)
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(float(bound))))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class Callback:
+    """
+    Значения, которые уже считает кто-то другой (кэш, очереди):
+    fn() возвращает {значение метки: число}, читается при экспорте.
+    """
+
+    def __init__(self, name, help, type, labelname, fn):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelname = labelname
+        self.fn = fn
+        _registry.append(self)
+
+    def collect(self):
+        try:
+            values = self.fn()
+        except Exception:
+            return
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for label, value in values.items():
+            if value is None:
+                continue
+            labels = _format_labels((self.labelname,), (label,))
+            yield f"{self.name}{labels} {_format_value(value)}"
+
+
+def render():
+    """
+    Все метрики в текстовом формате Prometheus.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+# ==================== МЕТРИКИ БОТА ====================
+
+STAGE_SECONDS = Histogram(
+    "bot_stage_seconds", "Длительность этапов обработки сообщения", ("stage",)
+)
+REQUESTS = Counter("bot_requests_total", "Текстовые сообщения, дошедшие до обработки")
+QUOTA_DENIED = Counter("bot_quota_denied_total", "Отказы из-за исчерпанного дневного лимита")
+AI_ERRORS = Counter("bot_ai_errors_total", "Ошибки при запросе к Gemini")
+# сбой обработки сообщения целиком (AI, БД, отправка) — запрос возвращён
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Сообщения, на которые ответили ошибкой", ("handler",)
+)
+TELEGRAM_ERRORS = Counter(
+    "bot_telegram_errors_total", "Ошибки вызовов Telegram API", ("method",)
+)
+
+# ==================== ТРАССИРОВКА ====================
+# trace id живёт в contextvars: в синхронном боте — в потоке обработчика,
+# в async — в задаче. При TRACE_LOG=1 этапы пишутся JSON-строками.
+
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+
+
+def new_trace():
+    trace_id = uuid.uuid4().hex[:12]
+    _trace_id.set(trace_id)
+    return trace_id
+
+
+def current_trace():
+    return _trace_id.get()
+
+
+def log(event, **fields):
+    if not TRACE_LOG:
+        return
+    record = {"ts": round(time.time(), 3), "trace": _trace_id.get(), "event": event}
+    record.update(fields)
+    print(json.dumps(record, ensure_ascii=False, default=str))
+
+
+# ==================== ТАЙМЕРЫ ====================
+
+
+class stage:
+    """
+    Контекстный менеджер: время блока уходит в bot_stage_seconds{stage=name}.
+    """
+
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        STAGE_SECONDS.observe(elapsed, stage=self.name)
+        if TRACE_LOG:
+            log(
+                "stage", stage=self.name, ms=round(elapsed * 1000, 3),
+                error=exc_type.__name__ if exc_type else None,
+            )
+        return False
+
+
+def timed(name, trace=False):
+    """
+    Декоратор для функций, корутин и генераторов. trace=True — начать
+    новый trace id (точка входа: обработчик сообщения).
+    """
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if trace:
+                    new_trace()
+                with stage(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                # вызов только создаёт генератор — замеряем сам обход: время
+                # внутри генератора без пауз потребителя, одно наблюдение
+                if trace:
+                    new_trace()
+                elapsed = 0.0
+                items = func(*args, **kwargs)
+                try:
+                    while True:
+                        started = time.perf_counter()
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            return
+                        finally:
+                            elapsed += time.perf_counter() - started
+                        yield item
+                finally:
+                    items.close()
+                    STAGE_SECONDS.observe(elapsed, stage=name)
+                    if TRACE_LOG:
+                        log("stage", stage=name, ms=round(elapsed * 1000, 3))
+
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if trace:
+                new_trace()
+            with stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_methods(prefix):
+    """
+    Декоратор класса: все публичные методы замеряются как prefix.имя.
+    """
+
+    def decorator(cls):
+        for attr, value in list(vars(cls).items()):
+            if attr.startswith("_") or not inspect.isfunction(value):
+                continue
+            setattr(cls, attr, timed(f"{prefix}.{attr}")(value))
+        return cls
+
+    return decorator
@@ -0,0 +1,426 @@
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+from ratelimit import TokenBucket
+import metrics
+
+# ==================== ИСХОДЯЩИЕ СООБЩЕНИЯ ====================
+# Все отправки в Telegram идут через одну очередь:
+# - глобальный token bucket (~30 сообщений/с на бота)
+# - token bucket на чат (~1 сообщение/с, короткие всплески допустимы)
+# - приоритеты: ответы пользователям > chat actions > уведомления админу
+# - 429 → чат ждёт retry_after (весь бот — только для вызовов без чата),
+#   сообщение уходит повторно
+# - повторные «typing» для одного чата склеиваются
+# Внутри чата сообщения уходят строго по одному и по порядку.
+
+PRIORITY_REPLY = 0
+PRIORITY_ACTION = 1
+PRIORITY_ADMIN = 2
+PRIORITY_BROADCAST = 3
+
+
+class _Job:
+    __slots__ = (
+        "priority", "seq", "chat_id", "func", "args", "kwargs",
+        "future", "per_chat", "retries", "action", "context",
+    )
+
+    def __init__(self, priority, seq, chat_id, func, args, kwargs, per_chat, retries, action):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.per_chat = per_chat
+        self.retries = retries
+        self.action = action
+        # trace id обработчика, который поставил отправку
+        self.context = contextvars.copy_context()
+
+
+def _log_failure(future):
+    error = future.exception()
+    if error is not None:
+        print("❌ Не удалось отправить сообщение:", error)
+
+
+def retry_after(error):
+    """
+    Секунды из ответа 429 или None, если ошибка другая.
+    Понимает ApiTelegramException и sync-, и async-клиента.
+    """
+    if getattr(error, "error_code", None) != 429:
+        return None
+    parameters = (error.result_json or {}).get("parameters") or {}
+    return parameters.get("retry_after", 1)
+
+
+class Outbox:
+    # раз в сколько секунд чистить bucket'ы неактивных чатов
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, workers=8, max_retries=3):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._chats = {}     # chat_id -> deque[_Job] (ещё не отправленные)
+        self._buckets = {}   # chat_id -> TokenBucket
+        self._busy = set()   # чаты, у которых сообщение сейчас в полёте
+        self._ready = []     # heap (priority, seq, chat_id) — головы очередей чатов
+        self._sleeping = []  # heap (ready_at, seq, chat_id) — чаты, ждущие токен
+        self._pending = 0
+
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="outbox")
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+
+    # ==================== ПУБЛИЧНОЕ API ====================
+
+    def submit(self, priority, chat_id, func, *args, per_chat=True, retries=None, **kwargs):
+        """
+        Ставит func(*args, **kwargs) в очередь, возвращает Future.
+        per_chat=False — вызов не расходует лимит чата (chat actions,
+        answer_callback_query), только глобальный.
+        """
+        retries = self._max_retries if retries is None else retries
+
+        with self._cond:
+            return self._enqueue(
+                _Job(priority, next(self._seq), chat_id, func, args, kwargs, per_chat, retries, None)
+            )
+
+    def post(self, priority, chat_id, func, *args, **kwargs):
+        """
+        Отправка «выстрелил и забыл»: ошибка только пишется в лог.
+        """
+        future = self.submit(priority, chat_id, func, *args, **kwargs)
+        future.add_done_callback(_log_failure)
+        return future
+
+    def call(self, priority, chat_id, func, *args, **kwargs):
+        """
+        То же, что submit, но ждёт отправки и возвращает результат
+        (или пробрасывает ошибку Telegram).
+        """
+        return self.submit(priority, chat_id, func, *args, **kwargs).result()
+
+    def chat_action(self, bot, chat_id, action="typing"):
+        """
+        Chat action без лимита чата; одинаковые ещё не отправленные склеиваются.
+        """
+        with self._cond:
+            for job in self._chats.get(chat_id, ()):
+                if job.action == action:
+                    return job.future
+
+            future = self._enqueue(
+                _Job(
+                    PRIORITY_ACTION, next(self._seq), chat_id,
+                    bot.send_chat_action, (chat_id, action), {},
+                    False, 0, action,
+                )
+            )
+        future.add_done_callback(_log_failure)
+        return future
+
+    def qsize(self):
+        return self._pending
+
+    def stop(self, timeout=10):
+        """
+        Дожидается отправки очереди (не дольше timeout) и останавливает потоки.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self._stopped = True
+            self._cond.notify_all()
+            # неотправленное не повиснет: ждущие call() получат ошибку
+            left = [job for queue in self._chats.values() for job in queue]
+            self._chats.clear()
+            self._ready.clear()
+            self._sleeping.clear()
+            self._pending -= len(left)
+        self._executor.shutdown(wait=False)
+
+        if left:
+            print(f"⚠️ Outbox: {len(left)} сообщений не отправлено")
+        for job in left:
+            job.future.set_exception(RuntimeError("outbox остановлен"))
+
+    # ==================== ПЛАНИРОВЩИК ====================
+
+    def _enqueue(self, job):
+        # вызывается под self._cond
+        if self._stopped:
+            job.future.set_exception(RuntimeError("outbox остановлен"))
+            return job.future
+
+        queue = self._chats.get(job.chat_id)
+        if queue is None:
+            queue = self._chats[job.chat_id] = deque()
+
+        queue.append(job)
+        self._pending += 1
+
+        if len(queue) == 1 and job.chat_id not in self._busy:
+            heapq.heappush(self._ready, (job.priority, job.seq, job.chat_id))
+            self._cond.notify()
+
+        return job.future
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    def _wake_sleeping(self, now):
+        while self._sleeping and self._sleeping[0][0] <= now:
+            _, _, chat_id = heapq.heappop(self._sleeping)
+            queue = self._chats.get(chat_id)
+            if queue and chat_id not in self._busy:
+                head = queue[0]
+                heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+
+    def _next_job(self, now):
+        """
+        Самая приоритетная голова очереди, для которой есть токены.
+        Возвращает (job, None) или (None, сколько ждать).
+        """
+        self._wake_sleeping(now)
+
+        while self._ready:
+            _, seq, chat_id = self._ready[0]
+            queue = self._chats.get(chat_id)
+            if not queue or queue[0].seq != seq or chat_id in self._busy:
+                heapq.heappop(self._ready)
+                continue
+
+            job = queue[0]
+
+            if job.per_chat:
+                wait = self._bucket(chat_id).wait_time(1, now)
+            else:
+                # лимит чата не расходуем, но пауза после 429 действует
+                bucket = self._buckets.get(chat_id)
+                wait = bucket.blocked_until - now if bucket else 0
+            if wait > 0:
+                # этот чат подождёт, остальные идут дальше
+                heapq.heappop(self._ready)
+                heapq.heappush(self._sleeping, (now + wait, seq, chat_id))
+                continue
+
+            wait = self._global.wait_time(1, now)
+            if wait > 0:
+                return None, wait
+
+            heapq.heappop(self._ready)
+            self._global.take(1, now)
+            if job.per_chat:
+                self._bucket(chat_id).take(1, now)
+
+            queue.popleft()
+            self._busy.add(chat_id)
+            return job, None
+
+        if self._sleeping:
+            return None, self._sleeping[0][0] - now
+        return None, None
+
+    def _sweep_buckets(self, now):
+        # полный bucket без очереди ничем не отличается от нового — выкидываем
+        for chat_id in [
+            chat_id for chat_id, bucket in self._buckets.items()
+            if chat_id not in self._chats and bucket.fill_ratio(now) >= 1
+        ]:
+            del self._buckets[chat_id]
+
+    def _run(self):
+        next_sweep = time.monotonic() + self.SWEEP_INTERVAL
+
+        with self._cond:
+            while not self._stopped:
+                now = time.monotonic()
+                if now >= next_sweep:
+                    self._sweep_buckets(now)
+                    next_sweep = now + self.SWEEP_INTERVAL
+
+                job, wait = self._next_job(now)
+                if job is None:
+                    self._cond.wait(min(wait, self.SWEEP_INTERVAL) if wait else self.SWEEP_INTERVAL)
+                    continue
+                self._executor.submit(self._send, job)
+
+    @staticmethod
+    def _call(job):
+        method = getattr(job.func, "__name__", "call")
+        try:
+            with metrics.stage("telegram." + method):
+                return job.func(*job.args, **job.kwargs)
+        except Exception:
+            metrics.TELEGRAM_ERRORS.inc(method=method)
+            raise
+
+    def _send(self, job):
+        error = None
+        result = None
+        try:
+            result = job.context.run(self._call, job)
+        except Exception as e:
+            error = e
+
+        with self._cond:
+            self._busy.discard(job.chat_id)
+            delay = retry_after(error)
+
+            if delay is not None and job.retries > 0 and not self._stopped:
+                # повторяем первым в очереди чата после паузы. Ждёт только
+                # этот чат, даже если вызов не тратит его лимит (например,
+                # answer_callback_query): весь бот — лишь для вызовов без чата
+                job.retries -= 1
+                bucket = self._bucket(job.chat_id) if job.chat_id is not None else self._global
+                bucket.block(delay)
+                self._chats.setdefault(job.chat_id, deque()).appendleft(job)
+                heapq.heappush(
+                    self._sleeping, (time.monotonic() + delay, job.seq, job.chat_id)
+                )
+                self._cond.notify()
+                return
+
+            self._pending -= 1
+            queue = self._chats.get(job.chat_id)
+            if queue:
+                head = queue[0]
+                heapq.heappush(self._ready, (head.priority, head.seq, job.chat_id))
+            else:
+                self._chats.pop(job.chat_id, None)
+            self._cond.notify_all()
+
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+# ==================== ASYNC ====================
+
+
+class AsyncOutbox:
+    """
+    Те же лимиты для async_bot: глобальный token bucket, bucket на чат,
+    внутри чата — по одному сообщению и по порядку, 429 → пауза
+    retry_after и повтор. Работает в одном event loop, поэтому без
+    блокировок потоков; приоритетов нет — отправитель сам ждёт свой вызов.
+    """
+
+    SWEEP_INTERVAL = Outbox.SWEEP_INTERVAL
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, max_retries=3):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+
+        self._locks = {}     # chat_id -> asyncio.Lock (пока есть отправки)
+        self._waiters = {}   # chat_id -> сколько вызовов держат/ждут lock
+        self._buckets = {}   # chat_id -> TokenBucket
+        self._next_sweep = time.monotonic() + self.SWEEP_INTERVAL
+
+    async def call(self, chat_id, func, *args, per_chat=True, retries=None, **kwargs):
+        """
+        await func(*args, **kwargs) в пределах лимитов; возвращает результат
+        или пробрасывает ошибку Telegram. per_chat=False — не расходует
+        лимит чата (chat actions), только глобальный.
+        """
+        import asyncio
+
+        retries = self._max_retries if retries is None else retries
+        method = getattr(func, "__name__", "call")
+
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        self._waiters[chat_id] = self._waiters.get(chat_id, 0) + 1
+
+        try:
+            async with lock:
+                while True:
+                    await self._acquire(chat_id, per_chat)
+                    try:
+                        with metrics.stage("telegram." + method):
+                            return await func(*args, **kwargs)
+                    except Exception as e:
+                        metrics.TELEGRAM_ERRORS.inc(method=method)
+                        delay = retry_after(e)
+                        if delay is None or retries <= 0:
+                            raise
+                        retries -= 1
+                        # см. Outbox._send: ждёт только этот чат
+                        self._block_for(chat_id, delay)
+        finally:
+            left = self._waiters[chat_id] - 1
+            if left:
+                self._waiters[chat_id] = left
+            else:
+                del self._waiters[chat_id]
+                del self._locks[chat_id]
+
+    def qsize(self):
+        return sum(self._waiters.values())
+
+    async def _acquire(self, chat_id, per_chat):
+        import asyncio
+
+        while True:
+            now = time.monotonic()
+            if now >= self._next_sweep:
+                self._sweep_buckets(now)
+                self._next_sweep = now + self.SWEEP_INTERVAL
+
+            bucket = self._bucket(chat_id) if chat_id is not None else None
+            # блокировка после 429 действует и на вызовы без лимита чата
+            wait = max(0.0, bucket.blocked_until - now) if bucket else 0.0
+            if per_chat and bucket:
+                wait = bucket.wait_time(1, now)
+            wait = max(wait, self._global.wait_time(1, now))
+
+            if wait <= 0:
+                self._global.take(1, now)
+                if per_chat and bucket:
+                    bucket.take(1, now)
+                return
+            await asyncio.sleep(wait)
+
+    def _block_for(self, chat_id, delay):
+        if chat_id is None:
+            self._global.block(delay)
+        else:
+            self._bucket(chat_id).block(delay)
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    def _sweep_buckets(self, now):
+        for chat_id in [
+            chat_id for chat_id, bucket in self._buckets.items()
+            if chat_id not in self._locks and bucket.fill_ratio(now) >= 1
+        ]:
+            del self._buckets[chat_id]
@@ -0,0 +1,68 @@
+import time
+
+# ==================== TOKEN BUCKET ====================
+
+
+class TokenBucket:
+    """
+    Классический token bucket: rate токенов в секунду, не больше capacity.
+    Не потокобезопасен — вызывающий код держит свою блокировку.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        # например, retry_after от Telegram или cooldown ключа
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, amount=1, now=None):
+        """
+        Через сколько секунд можно будет взять amount токенов (0 — сейчас).
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < amount:
+            wait = max(wait, (amount - self.tokens) / self.rate)
+        return wait
+
+    def take(self, amount=1, now=None):
+        now = time.monotonic() if now is None else now
+        if self.wait_time(amount, now) > 0:
+            return False
+        self.tokens -= amount
+        return True
+
+    def give_back(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def charge(self, amount):
+        """
+        Списать сверх взятого (фактический расход оказался больше оценки).
+        Баланс может уйти в минус — следующие запросы подождут.
+        """
+        self.tokens -= amount
+
+    def block(self, seconds, now=None):
+        now = time.monotonic() if now is None else now
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def fill_ratio(self, now=None):
+        """
+        Доля свободной ёмкости: 1.0 — пустая нагрузка, 0.0 — всё израсходовано.
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if now < self.blocked_until:
+            return 0.0
+        return self.tokens / self.capacity
@@ -0,0 +1,243 @@
+import html
+import re
+
+# ==================== MARKDOWN → TELEGRAM HTML ====================
+# Один проход по тексту одним заранее скомпилированным регулярным
+# выражением. Внутри кода разметка не разбирается, незакрытые * и **
+# остаются как есть, теги всегда правильно вложены. Незакрытый блок
+# кода (```) тянется до конца текста — поэтому недописанный при
+# стриминге ответ тоже даёт валидный HTML.
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+_TOKEN_RE = re.compile(
+    r"""
+      (?P<fence>^```(?P<lang>[\w+-]*)[^\n]*\n(?P<body>[\s\S]*?)(?:^```[ \t]*$|\Z))
+    | (?P<code>`[^`\n]+`)
+    | (?P<link>\[(?P<link_text>[^\]\n]+)\]\((?P<link_url>https?://[^)\s]+)\))
+    | (?P<heading>^\#+[ \t]*)
+    | (?P<bullet>^[ \t]*[*-][ \t]+)
+    | (?P<bold>\*\*)
+    | (?P<italic>\*)
+    """,
+    re.MULTILINE | re.VERBOSE,
+)
+
+
+def _escape(text):
+    return html.escape(text, quote=False)
+
+
+def md_to_html(md: str) -> str:
+    out = []
+    # открытые inline-маркеры текущей строки: [(tag, индекс в out)]
+    stack = []
+    heading = False
+    pos = 0
+
+    def close_line():
+        # незакрытые маркеры превращаются обратно в текст
+        for tag, index in stack:
+            out[index] = "**" if tag == "b" else "*"
+        stack.clear()
+
+    def text(segment):
+        nonlocal heading
+        # маркеры действуют в пределах строки: на переводе строки всё закрываем
+        newline = segment.find("\n")
+        if newline < 0:
+            out.append(_escape(segment))
+            return
+
+        close_line()
+        if heading:
+            out.append(_escape(segment[:newline]))
+            out.append("</b>")
+            segment = segment[newline:]
+            heading = False
+        out.append(_escape(segment))
+
+    for match in _TOKEN_RE.finditer(md):
+        start = match.start()
+        if start > pos:
+            text(md[pos:start])
+        pos = match.end()
+
+        kind = match.lastgroup
+
+        if kind == "fence":
+            close_line()
+            lang = match.group("lang")
+            body = _escape(match.group("body"))
+            if lang:
+                out.append(f'<pre><code class="language-{lang}">{body}</code></pre>')
+            else:
+                out.append(f"<pre><code>{body}</code></pre>")
+
+        elif kind == "code":
+            out.append(f"<code>{_escape(match.group()[1:-1])}</code>")
+
+        elif kind == "link":
+            url = html.escape(match.group("link_url"))
+            out.append(f'<a href="{url}">{_escape(match.group("link_text"))}</a>')
+
+        elif kind == "heading":
+            out.append("<b>")
+            heading = True
+
+        elif kind == "bullet":
+            out.append("• ")
+
+        else:
+            tag = "b" if kind == "bold" else "i"
+            if heading and tag == "b":
+                # заголовок и так жирный
+                continue
+
+            marker = match.group()
+            opened = next((i for i, (t, _) in enumerate(stack) if t == tag), None)
+            if opened is None:
+                # «2 * 3» — не курсив: открывающий маркер должен касаться слова
+                if md[pos:pos + 1].isspace() or pos == len(md):
+                    out.append(marker)
+                    continue
+                stack.append((tag, len(out)))
+                out.append(f"<{tag}>")
+                continue
+
+            if md[start - 1:start].isspace():
+                out.append(marker)
+                continue
+
+            # закрываем; всё, что открыто внутри и не закрыто, — обычный текст
+            for inner, index in stack[opened + 1:]:
+                out[index] = "**" if inner == "b" else "*"
+            del stack[opened:]
+            out.append(f"</{tag}>")
+
+    if pos < len(md):
+        text(md[pos:])
+
+    close_line()
+    if heading:
+        out.append("</b>")
+
+    return "".join(out)
+
+
+# ==================== РАЗБИЕНИЕ НА СООБЩЕНИЯ ====================
+
+_HTML_TOKEN_RE = re.compile(r"<(/?)([a-z]+)[^>]*>|&#?\w+;|[^<&]+|[<&]")
+
+
+def _tg_len(text):
+    # Telegram считает длину в UTF-16: эмодзи и прочие символы вне BMP — за два
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _cut(text, budget):
+    """
+    Сколько символов text помещается в budget. Предпочитаем резать
+    по переводу строки, затем по пробелу, но не раньше середины.
+    """
+    cut = min(len(text), budget)
+    if _tg_len(text[:cut]) > budget:
+        # есть символы вне BMP — ищем границу двоичным поиском
+        low, high = 0, cut
+        while low < high:
+            middle = (low + high + 1) // 2
+            if _tg_len(text[:middle]) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        cut = low
+    if cut >= len(text):
+        return cut
+
+    for sep in ("\n", " "):
+        at = text.rfind(sep, 0, cut)
+        if at >= cut // 2 and at > 0:
+            return at + 1
+    return cut
+
+
+def split_html(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """
+    Делит HTML из md_to_html на части не длиннее limit. На границе
+    открытые теги закрываются и заново открываются в следующей части.
+    """
+    if _tg_len(text) <= limit:
+        return [text]
+
+    parts = []
+    open_tags = []  # [(имя, открывающий тег)]
+    chunk = []
+    size = 0
+    closing_size = 0  # длина закрывающих тегов для open_tags
+    has_text = False
+
+    def closing():
+        return "".join(f"</{name}>" for name, _ in reversed(open_tags))
+
+    def flush():
+        nonlocal chunk, size, has_text
+        if has_text:
+            parts.append("".join(chunk) + closing())
+        chunk = [tag for _, tag in open_tags]
+        size = sum(_tg_len(tag) for tag in chunk)
+        has_text = False
+
+    for match in _HTML_TOKEN_RE.finditer(text):
+        token = match.group()
+        is_tag = match.group(2) is not None
+
+        if is_tag:
+            name = match.group(2)
+            if match.group(1):
+                # место под закрывающие теги уже зарезервировано
+                if open_tags and open_tags[-1][0] == name:
+                    open_tags.pop()
+                    closing_size -= len(name) + 3
+            else:
+                if size + _tg_len(token) + len(name) + 3 + closing_size > limit:
+                    flush()
+                open_tags.append((name, token))
+                closing_size += len(name) + 3
+            chunk.append(token)
+            size += _tg_len(token)
+            continue
+
+        # текст и сущности; сущность (&amp;) не разрываем
+        atomic = token.startswith("&") and len(token) > 1
+        while token:
+            budget = limit - size - closing_size
+            token_size = _tg_len(token)
+
+            if token_size <= budget:
+                chunk.append(token)
+                size += token_size
+                has_text = True
+                break
+
+            cut = 0 if atomic else _cut(token, budget)
+            if cut <= 0:
+                if not has_text:
+                    # даже пустая часть не вмещает токен — режем жёстко
+                    cut = max(1, budget)
+                else:
+                    flush()
+                    continue
+
+            chunk.append(token[:cut])
+            has_text = True
+            token = token[cut:]
+            flush()
+
+    if has_text:
+        parts.append("".join(chunk) + closing())
+
+    return parts
+
+
+def render_messages(md: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    return split_html(md_to_html(md), limit)
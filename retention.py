@@ -0,0 +1,312 @@
+import argparse
+import fcntl
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from config import (
+    RETENTION_DAYS,
+    RETENTION_INTERVAL,
+    RETENTION_BATCH,
+    ARCHIVE_DIR,
+    VACUUM_PAGES,
+)
+import metrics
+
+# ==================== ХРАНЕНИЕ RESULTS ====================
+# В results лежит каждый вопрос и полный ответ — без чистки база растёт
+# бесконечно. Строки старше RETENTION_DAYS переносятся в архив:
+#
+#   archive/results-2024-05.jsonl.gz — одна строка JSON на запись, файл на месяц
+#
+# - перенос идёт порциями: порция дописывается в файлы (отдельным
+#   gzip-членом, fsync), затем одной транзакцией удаляется из базы вместе
+#   со сдвигом отметки archived_results_id
+# - если процесс упал между записью и удалением, порция попадёт в архив
+#   дважды — iter_archive пропускает повторы по id
+# - освободившиеся страницы возвращаются файлу базы через
+#   PRAGMA incremental_vacuum небольшими шагами, без блокировки на весь VACUUM
+#
+# CLI:
+#   python retention.py run                      — один проход сейчас
+#   python retention.py export [--from 2024-01]  — всё (архив + база) в JSONL
+#   python retention.py vacuum [--full]          — вернуть место / включить auto_vacuum
+#   python retention.py status
+
+ARCHIVED = metrics.Counter(
+    "bot_results_archived_total", "Строки results, перенесённые в архив"
+)
+
+FIELDS = ("id", "tg_id", "prompt", "result", "created_at")
+
+
+def _cutoff(days):
+    # created_at пишется CURRENT_TIMESTAMP — UTC в формате 'YYYY-MM-DD HH:MM:SS'
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _archive_path(archive_dir, month):
+    return os.path.join(archive_dir, f"results-{month}.jsonl.gz")
+
+
+def archive_files(archive_dir=ARCHIVE_DIR):
+    """
+    [(месяц, путь)] по возрастанию месяца.
+    """
+    if not os.path.isdir(archive_dir):
+        return []
+
+    files = []
+    for name in os.listdir(archive_dir):
+        if name.startswith("results-") and name.endswith(".jsonl.gz"):
+            files.append((name[len("results-"):-len(".jsonl.gz")], os.path.join(archive_dir, name)))
+    return sorted(files)
+
+
+# ==================== ПЕРЕНОС В АРХИВ ====================
+
+class Retention:
+    def __init__(
+        self, store, archive_dir=ARCHIVE_DIR, days=RETENTION_DAYS,
+        batch=RETENTION_BATCH, vacuum_pages=VACUUM_PAGES,
+    ):
+        """
+        store — db_manager.
+        """
+        self.store = store
+        self.archive_dir = archive_dir
+        self.days = days
+        self.batch = batch
+        self.vacuum_pages = vacuum_pages
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        """
+        Переносит в архив всё старше days дней и возвращает место файлу базы.
+        Возвращает число перенесённых строк.
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+        # бот и ручной запуск из CLI не должны переносить одновременно
+        with open(os.path.join(self.archive_dir, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print("⚠️ Архивирование уже идёт в другом процессе")
+                return 0
+
+            moved = self._archive(_cutoff(self.days))
+            self._vacuum()
+            return moved
+
+    def _archive(self, cutoff):
+        moved = 0
+        after = self.store.get_archive_watermark()
+
+        while not self._stop.is_set():
+            rows = self.store.get_results_after(after, self.batch)
+            # id растёт вместе с created_at: берём только старый префикс,
+            # свежие строки дальше не просматриваем
+            old = []
+            for row in rows:
+                if row[4] >= cutoff:
+                    break
+                old.append(row)
+            if not old:
+                break
+
+            self._write(old)
+            self.store.delete_archived_results(old[0][0], old[-1][0])
+
+            after = old[-1][0]
+            moved += len(old)
+            ARCHIVED.inc(len(old))
+
+            if len(old) < len(rows):
+                break
+
+        if moved:
+            print(f"🗄 В архив перенесено строк: {moved}")
+        return moved
+
+    def _write(self, rows):
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(row[4][:7], []).append(row)
+
+        for month, month_rows in by_month.items():
+            data = "".join(
+                json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False) + "\n"
+                for row in month_rows
+            ).encode("utf-8")
+
+            # каждая порция — отдельный gzip-член; gzip читает их подряд
+            with open(_archive_path(self.archive_dir, month), "ab") as f:
+                f.write(gzip.compress(data, compresslevel=6))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _vacuum(self):
+        # небольшими шагами, чтобы запись из бота успевала между ними
+        _, free, _, auto_vacuum = self.store.get_db_size()
+        if auto_vacuum != 2:
+            # старая база: место вернёт только `python retention.py vacuum --full`
+            return
+
+        while free and not self._stop.is_set():
+            left = self.store.incremental_vacuum(self.vacuum_pages)
+            if left >= free:
+                return
+            free = left
+            time.sleep(0.05)
+
+    # ==================== ФОНОВЫЙ ПОТОК ====================
+
+    def start(self, interval=RETENTION_INTERVAL):
+        self._thread = threading.Thread(
+            target=self._run, args=(interval,), name="retention", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+
+    def _run(self, interval):
+        # первый проход — через минуту, чтобы не мешать старту бота
+        delay = min(interval, 60)
+        while not self._stop.wait(delay):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Ошибка при архивировании results: {e}")
+            delay = interval
+
+
+_retention = None
+
+
+def start(store):
+    """
+    Запускает фоновый перенос, если задан RETENTION_DAYS.
+    """
+    global _retention
+
+    if RETENTION_DAYS <= 0 or _retention is not None:
+        return None
+
+    _retention = Retention(store)
+    _retention.start()
+    print(f"🗄 Архивирование results старше {RETENTION_DAYS} дн. в {ARCHIVE_DIR}/")
+    return _retention
+
+
+def stop():
+    if _retention is not None:
+        _retention.stop()
+
+
+# ==================== ЧТЕНИЕ АРХИВА ====================
+
+def iter_archive(archive_dir=ARCHIVE_DIR, since=None, until=None, tg_id=None):
+    """
+    Записи архива по возрастанию id, по одной строке за раз — файлы
+    не распаковываются в память целиком. since / until — месяцы 'YYYY-MM'
+    включительно.
+    """
+    last_id = 0
+    for month, path in archive_files(archive_dir):
+        if (since and month < since) or (until and month > until):
+            continue
+
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                # повтор порции после падения между записью и удалением
+                if record["id"] <= last_id:
+                    continue
+                last_id = record["id"]
+                if tg_id is None or record["tg_id"] == tg_id:
+                    yield record
+
+
+def iter_all(store, archive_dir=ARCHIVE_DIR, since=None, tg_id=None):
+    """
+    Архив, затем то, что ещё лежит в базе.
+    """
+    last_id = 0
+    for record in iter_archive(archive_dir, since=since, tg_id=tg_id):
+        last_id = record["id"]
+        yield record
+
+    for row in store.iter_results(last_id, tg_id):
+        record = dict(zip(FIELDS, row))
+        if since and record["created_at"][:7] < since:
+            continue
+        yield record
+
+
+# ==================== CLI ====================
+
+def _status(store):
+    pages, free, page_size, auto_vacuum = store.get_db_size()
+    print(f"База: {pages * page_size / 2**20:.1f} МБ, свободно {free * page_size / 2**20:.1f} МБ")
+    print("auto_vacuum:", {0: "выключен (нужен vacuum --full)", 1: "full", 2: "incremental"}[auto_vacuum])
+    print("Перенесено до id:", store.get_archive_watermark())
+    for month, path in archive_files():
+        print(f"  {month}: {os.path.getsize(path) / 2**20:.2f} МБ")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Архив и хранение таблицы results")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="перенести старые строки в архив сейчас")
+    run.add_argument("--days", type=int, default=RETENTION_DAYS or None, required=not RETENTION_DAYS)
+
+    export = commands.add_parser("export", help="выгрузить results в JSONL (stdout)")
+    export.add_argument("--from", dest="since", help="с месяца YYYY-MM")
+    export.add_argument("--tg-id", type=int)
+    export.add_argument("--archive-only", action="store_true")
+
+    vacuum = commands.add_parser("vacuum", help="вернуть свободное место файлу базы")
+    vacuum.add_argument("--full", action="store_true", help="полный VACUUM (блокирует базу)")
+
+    commands.add_parser("status")
+
+    args = parser.parse_args(argv)
+
+    # до импорта db: с пустым DB_NAME база создалась бы как None.db
+    import config
+    config.check()
+
+    from db import db_manager
+
+    if args.command == "run":
+        Retention(db_manager, days=args.days).run_once()
+    elif args.command == "export":
+        if args.archive_only:
+            records = iter_archive(since=args.since, tg_id=args.tg_id)
+        else:
+            records = iter_all(db_manager, since=args.since, tg_id=args.tg_id)
+        for record in records:
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+    elif args.command == "vacuum":
+        if args.full:
+            db_manager.vacuum()
+        else:
+            Retention(db_manager)._vacuum()
+        _status(db_manager)
+    else:
+        _status(db_manager)
+
+
+if __name__ == "__main__":
+    main()
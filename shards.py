@@ -0,0 +1,358 @@
+import startup  # первым: от него считается время запуска
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+from config import (
+    BOT_TOKEN,
+    SHARDS,
+    SHARD_QUEUE_SIZE,
+    SHARD_PUT_TIMEOUT,
+    UPDATES_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_WORKERS,
+    AI_CONCURRENCY,
+    OUTBOX_GLOBAL_RATE,
+    GEMINI_RPM,
+    GEMINI_TPM,
+)
+import config
+
+# до импорта db (через health): с пустым DB_NAME база создалась бы как None.db
+config.check()
+startup.mark("config")
+
+import health
+import metrics
+startup.mark("db")
+
+# ==================== НЕСКОЛЬКО ПРОЦЕССОВ ====================
+# SHARDS=N > 1: один процесс-диспетчер и N рабочих процессов.
+#
+# - диспетчер один получает апдейты (polling или webhook) и раскладывает
+#   их по очередям: номер процесса — chat.id % N. Все апдейты чата
+#   попадают в один процесс, порядок внутри чата сохраняется
+# - рабочий процесс — обычный bot.py (sync-режим): process_new_updates,
+#   честная очередь к AI, outbox, кэши
+# - общее состояние — SQLite в WAL. Квоты в памяти (QUOTA_CACHE) тоже
+#   корректны: пользователь всегда обслуживается одним процессом
+# - лимиты на весь бот (OUTBOX_GLOBAL_RATE, GEMINI_RPM/TPM, AI_CONCURRENCY)
+#   делятся между процессами поровну
+# - упавший процесс перезапускается; его очередь ждёт в диспетчере
+# - health-сервер, архивирование results — только в диспетчере
+
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 30
+# столько секунд после отброшенного апдейта /health видит перегрузку
+OVERLOAD_WINDOW = 60
+
+DROPPED = metrics.Counter(
+    "bot_shard_dropped_total", "Апдейты, отброшенные из-за полной очереди процесса", ("shard",)
+)
+
+
+def shard_of(update, shards):
+    """
+    Номер процесса для апдейта (dict из JSON Telegram).
+    """
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in update:
+            return update[key]["chat"]["id"] % shards
+
+    callback = update.get("callback_query")
+    if callback is not None:
+        message = callback.get("message")
+        if message is not None:
+            return message["chat"]["id"] % shards
+        return callback["from"]["id"] % shards
+
+    # остальные типы апдейтов бот не обрабатывает — по отправителю, если есть
+    for value in update.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"] % shards
+    return 0
+
+
+def _worker_limits(shards):
+    # лимиты на весь бот — поровну на процесс
+    return {
+        "AI_CONCURRENCY": max(1, AI_CONCURRENCY // shards),
+        "OUTBOX_GLOBAL_RATE": OUTBOX_GLOBAL_RATE / shards,
+        "GEMINI_RPM": max(1, GEMINI_RPM // shards),
+        "GEMINI_TPM": max(1, GEMINI_TPM // shards),
+    }
+
+
+def run_worker(index, shards, updates, setup=None):
+    """
+    Точка входа рабочего процесса. setup() вызывается перед импортом
+    bot.py (bench/loadtest.py подменяет в нём Telegram и Gemini).
+    """
+    # остановку присылает диспетчер (None в очередь), сигналы не нужны:
+    # Ctrl+C приходит всей группе процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # bot.py и functions.py читают эти значения из config при импорте
+    for name, value in _worker_limits(shards).items():
+        setattr(config, name, value)
+
+    if setup is not None:
+        setup()
+
+    import bot as app
+    from telebot import types
+
+    # команды регистрирует один процесс из всех
+    app.warm_up(commands=index == 0)
+    print(f"🧩 Процесс {index + 1}/{shards} запущен (pid {os.getpid()})")
+    startup.ready()
+
+    parent = multiprocessing.parent_process()
+    try:
+        while True:
+            try:
+                update = updates.get(timeout=5)
+            except queue.Empty:
+                # диспетчер убит (kill -9) — сентинела не будет
+                if not parent.is_alive():
+                    break
+                continue
+            if update is None:
+                break
+            try:
+                app.bot.process_new_updates([types.Update.de_json(update)])
+            except Exception as e:
+                print(f"❌ Процесс {index + 1}: ошибка обработки апдейта: {e}")
+    finally:
+        app.ai_queue.stop()
+        app.broadcaster.stop()
+        app.outbox.stop()
+        app.db_manager.close()
+
+
+# ==================== ДИСПЕТЧЕР ====================
+
+class Dispatcher:
+    def __init__(self, shards, queue_size=SHARD_QUEUE_SIZE, worker=run_worker,
+                 put_timeout=SHARD_PUT_TIMEOUT):
+        # spawn: рабочий процесс импортирует bot.py с нуля, без копий
+        # потоков и соединений SQLite диспетчера
+        self._ctx = multiprocessing.get_context("spawn")
+        self._shards = shards
+        self._worker = worker
+        self._queues = [self._ctx.Queue(queue_size) for _ in range(shards)]
+        self._processes = [None] * shards
+        self._restarts = [0] * shards
+        self._put_timeout = put_timeout
+        self._overloaded = [0.0] * shards  # когда процесс последний раз не успел
+        self._stopping = threading.Event()
+        self._supervisor = None
+
+    def route(self, update):
+        """
+        Кладёт апдейт в очередь процесса. Если очередь полна дольше
+        put_timeout (процесс завис или не успевает), апдейт отбрасывается:
+        один застрявший процесс не останавливает остальные.
+        Возвращает False, если апдейт отброшен.
+        """
+        index = shard_of(update, self._shards)
+        process = self._processes[index]
+        # лежащий процесс свою очередь не разбирает — ждать места бессмысленно
+        alive = process is not None and process.is_alive()
+
+        try:
+            self._queues[index].put(update, timeout=self._put_timeout if alive else 0)
+            return True
+        except queue.Full:
+            DROPPED.inc(shard=str(index + 1))
+            self._overloaded[index] = time.monotonic()
+            print(f"⚠️ Очередь процесса {index + 1} полна, апдейт {update.get('update_id')} отброшен")
+            return False
+
+    def qsize(self, index):
+        try:
+            return self._queues[index].qsize()
+        except NotImplementedError:
+            # macOS: qsize() у multiprocessing.Queue нет
+            return None
+
+    def check(self):
+        """
+        Проблема для /health, если какой-то процесс сейчас не работает
+        или недавно не успевал разбирать очередь.
+        """
+        dead = [
+            str(i + 1) for i, process in enumerate(self._processes)
+            if process is None or not process.is_alive()
+        ]
+        since = time.monotonic() - OVERLOAD_WINDOW
+        overloaded = [
+            str(i + 1) for i, at in enumerate(self._overloaded) if at and at > since
+        ]
+
+        problems = []
+        if dead:
+            problems.append("shards down: " + ",".join(dead))
+        if overloaded:
+            problems.append("shards overloaded: " + ",".join(overloaded))
+        return "; ".join(problems) or None
+
+    # ==================== ПРОЦЕССЫ ====================
+
+    def start(self):
+        for i in range(self._shards):
+            self._spawn(i)
+
+        self._supervisor = threading.Thread(
+            target=self._supervise, name="shard-supervisor", daemon=True
+        )
+        self._supervisor.start()
+
+    def _spawn(self, index):
+        process = self._ctx.Process(
+            target=self._worker,
+            args=(index, self._shards, self._queues[index]),
+            name=f"bot-shard-{index + 1}",
+            daemon=False,
+        )
+        process.start()
+        self._processes[index] = process
+
+    def _supervise(self):
+        next_try = [0.0] * self._shards
+
+        while not self._stopping.wait(1):
+            now = time.monotonic()
+            for i, process in enumerate(self._processes):
+                if process.is_alive() or now < next_try[i]:
+                    continue
+
+                self._restarts[i] += 1
+                # частые падения — перезапуск всё реже
+                delay = min(RESTART_DELAY * 2 ** (self._restarts[i] - 1), MAX_RESTART_DELAY)
+                next_try[i] = now + delay
+                print(
+                    f"⚠️ Процесс {i + 1} завершился (код {process.exitcode}), "
+                    f"перезапуск #{self._restarts[i]}"
+                )
+                self._spawn(i)
+
+    def stop(self, timeout=60):
+        """
+        Просит процессы доделать свои очереди и дожидается их.
+        """
+        self._stopping.set()
+        if self._supervisor is not None:
+            self._supervisor.join()
+
+        for updates in self._queues:
+            updates.put(None)
+
+        deadline = time.monotonic() + timeout
+        for i, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                print(f"⚠️ Процесс {i + 1} не остановился, завершаем принудительно")
+                process.terminate()
+                process.join(5)
+
+
+# ==================== ПОЛУЧЕНИЕ АПДЕЙТОВ ====================
+
+def poll(dispatcher, timeout=20):
+    from telebot import apihelper
+
+    # если раньше был включён webhook, getUpdates вернёт 409
+    apihelper.delete_webhook(BOT_TOKEN)
+
+    offset = None
+    while True:
+        try:
+            updates = apihelper.get_updates(
+                BOT_TOKEN, offset=offset, timeout=timeout, long_polling_timeout=timeout
+            )
+        except Exception as e:
+            print("❌ getUpdates:", e)
+            time.sleep(3)
+            continue
+
+        health.state.beat()
+        if updates:
+            health.state.update_received()
+        for update in updates:
+            dispatcher.route(update)
+            offset = update["update_id"] + 1
+
+
+def serve_webhook(dispatcher):
+    from telebot import apihelper
+    from webhook import WebhookServer, webhook_secret
+
+    secret = webhook_secret(WEBHOOK_SECRET, WEBHOOK_URL)
+
+    def route(update):
+        health.state.update_received()
+        dispatcher.route(update)
+
+    server = WebhookServer(
+        route,
+        WEBHOOK_HOST,
+        WEBHOOK_PORT,
+        WEBHOOK_PATH,
+        secret,
+        WEBHOOK_QUEUE_SIZE,
+        WEBHOOK_WORKERS,
+        on_tick=health.state.beat,
+    )
+    health.state.register_queue("webhook", server.qsize)
+
+    if WEBHOOK_URL:
+        apihelper.set_webhook(BOT_TOKEN, url=WEBHOOK_URL, secret_token=secret or None)
+
+    server.serve_forever()
+
+
+def main(shards=SHARDS):
+    # таблицы и миграции уже созданы при импорте db (через health) —
+    # один раз до запуска процессов, а не наперегонки в каждом
+    from db import db_manager
+    import retention
+
+    dispatcher = Dispatcher(shards)
+    dispatcher.start()
+
+    health.start_server()
+    for i in range(shards):
+        health.state.register_queue(f"shard{i + 1}", lambda i=i: dispatcher.qsize(i))
+    health.state.register_check(dispatcher.check)
+    retention.start(db_manager)
+    print(f"🤖 Диспетчер запущен: {shards} процессов")
+    startup.ready()
+
+    try:
+        if UPDATES_MODE == "webhook":
+            serve_webhook(dispatcher)
+        else:
+            poll(dispatcher)
+    finally:
+        dispatcher.stop()
+        retention.stop()
+        db_manager.close()
+
+
+if __name__ == "__main__":
+    # docker stop шлёт SIGTERM — останавливаемся как по Ctrl+C (см. bot.py)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    main(max(SHARDS, 2))
@@ -0,0 +1,93 @@
+"""
+Сбой Gemini в обработчике: запрос возвращается в лимит, пользователь
+получает texts.AI_ERROR, в results ничего не пишется, а сбой виден
+в bot_ai_errors_total и bot_handler_errors_total.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.loadtest import BOT_TOKEN, FakeModel, FakeTelegram, make_update
+
+CHAT_ID = 42
+
+_db_dir = tempfile.TemporaryDirectory()
+# до первого импорта config: load_dotenv не перезаписывает заданные переменные
+os.environ.update({
+    "BOT_TOKEN": BOT_TOKEN,
+    "ADMIN_ID": "1",
+    "GEMINI_KEYS": "test",
+    "DB_NAME": os.path.join(_db_dir.name, "test"),
+    "BOT_MODE": "sync",
+    "AI_STREAMING": "0",
+    "RESPONSE_CACHE": "0",
+    "RESULTS_WRITE_BEHIND": "0",
+    "HEALTH_PORT": "0",
+    "METRICS": "1",
+})
+
+
+def setUpModule():
+    global bot, fake, functions, metrics, texts
+    from telebot import apihelper
+
+    fake = FakeTelegram()
+    fake.start()
+    apihelper.API_URL = fake.api_url
+
+    import bot
+    import functions
+    import metrics
+    import texts
+
+    functions._model = FakeModel(latency=0, jitter=0, error_rate=1.0)
+
+
+def tearDownModule():
+    bot.ai_queue.stop()
+    bot.outbox.stop()
+    bot.db_manager.close()
+    fake.shutdown()
+    _db_dir.cleanup()
+
+
+class HandlerErrorsTest(unittest.TestCase):
+    def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("не дождались ответа бота")
+            time.sleep(0.05)
+
+    def test_gemini_failure_refunds_request(self):
+        from telebot import types
+
+        db = bot.db_manager
+        db.add_user(CHAT_ID)
+        left = db.get_user_requests(CHAT_ID)
+        ai_errors = metrics.AI_ERRORS.value()
+        handler_errors = metrics.HANDLER_ERRORS.value(handler="answer")
+
+        update = make_update(1, CHAT_ID, "Объясни, как работает GIL")
+        bot.bot.process_new_updates([types.Update.de_json(update)])
+
+        self.wait_for(lambda: texts.AI_ERROR in fake.texts.get(CHAT_ID, ()))
+
+        self.assertEqual(metrics.AI_ERRORS.value(), ai_errors + 1)
+        self.assertEqual(metrics.HANDLER_ERRORS.value(handler="answer"), handler_errors + 1)
+        self.assertEqual(db.get_user_requests(CHAT_ID), left)
+        self.assertEqual(list(db.iter_results(tg_id=CHAT_ID)), [])
+        self.assertFalse(
+            any("Ошибка при обращении к AI" in text for text in fake.texts[CHAT_ID])
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
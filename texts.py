@@ -0,0 +1,128 @@
+# ==================== ТЕКСТЫ БОТА ====================
+# Общие тексты для синхронного (bot.py) и асинхронного (async_bot.py) режимов.
+
+GREETING = "👋 Привет. Я — ассистент с искусственным интеллектом.\n\n"
+
+GREETING_NEW_USER = (
+    "У вас есть 150 запросов в сутки. Лимит обновляется автоматически в полночь.\n"
+    "Чтобы начать диалог, просто напишите сообщение не менее 10 символов\n"
+    "Лимит обновляется автоматически каждый день.\n\n"
+)
+
+GREETING_OLD_USER = (
+    "Вы уже пользовались ботом ранее.\n\n"
+)
+
+GREETING_FOOTER = (
+    "Просто напишите сообщение (минимум 10 символов), "
+    "и я постараюсь помочь.\n\n"
+    "Используйте кнопки ниже 👇"
+)
+
+HELP_TEXT = (
+    "ℹ️ Помощь\n\n"
+    "Этот Ai-бот — простой и быстрый способ получать ответы.\n"
+    "Интерфейс минималистичен, ответы — мгновенны. За каждым диалогом стоит отлаженный код, написанный с принципами простоты и надёжности. Редкий инструмент, который делает свою работу хорошо: предоставляет информацию быстро и без лишних деталей.\n\n"
+    "• До 150 запросов в сутки\n"
+    "• 1 сообщение = 1 запрос\n"
+    "• Лимит обновляется автоматически\n\n"
+    "Просто напишите свой вопрос текстом."
+)
+
+ABOUT_TEXT = (
+    "👨‍💻 свежий Telegram AI-бот\n"
+    "✅ Абсолютно бесплатный доступ\n"
+    "🔹 Бот не сохраняет личную информацию, но быстро обучается и подстраивается под вас"
+    "🔹 Никакой рекламы, просто вставляешь запрос\n"
+)
+
+TOO_SHORT = "⚠️ Пожалуйста, напишите не менее 10 символов."
+TOO_LONG = "⚠️ Максимум 4000 символов."
+LIMIT_EXHAUSTED = "❌ Дневной лимит исчерпан.\nПопробуйте снова завтра."
+AI_ERROR = "❌ Произошла ошибка. Попробуйте позже."
+ONLY_TEXT = "❌ Бот принимает только текстовые сообщения."
+STREAM_PLACEHOLDER = "⏳ Думаю…"
+CACHE_DISABLED = (
+    "🔕 Кэш ответов отключён: каждый вопрос отправляется в AI заново.\n"
+    "Повторите /nocache, чтобы включить его обратно."
+)
+CACHE_ENABLED = "🔔 Кэш ответов снова включён."
+MEMORY_CLEARED = "🧹 Начинаем новый диалог: предыдущие сообщения я забыл."
+BROADCAST_USAGE = (
+    "📣 Рассылка всем пользователям:\n"
+    "/broadcast текст — начать\n"
+    "/broadcast pause — приостановить\n"
+    "/broadcast resume — продолжить\n"
+    "/broadcast cancel — отменить"
+)
+BROADCAST_RUNNING = "⚠️ Рассылка уже идёт. /broadcast pause — приостановить."
+BROADCAST_UNFINISHED = (
+    "⚠️ Есть незавершённая рассылка: /broadcast resume — продолжить, "
+    "/broadcast cancel — отменить."
+)
+BROADCAST_NONE = "Активной рассылки нет."
+BROADCAST_PAUSING = "⏸ Рассылка приостанавливается…"
+BROADCAST_CANCELLING = "⏹ Рассылка отменяется…"
+BROADCAST_CANCELLED = "⏹ Рассылка отменена."
+QUEUE_FULL = (
+    "🚦 Сейчас слишком много запросов. Попробуйте через минуту — "
+    "этот запрос не списан с лимита."
+)
+
+MIN_MESSAGE_LENGTH = 10
+MAX_MESSAGE_LENGTH = 4000
+
+
+def build_greeting(is_new_user):
+    greeting = GREETING
+    greeting += GREETING_NEW_USER if is_new_user else GREETING_OLD_USER
+    return greeting + GREETING_FOOTER
+
+
+def new_user_notice(tg_id, total_users):
+    return f"Новый пользователь: {tg_id}\nВсего пользователей: {total_users}"
+
+
+def queue_position(position):
+    return f"⏳ Вы в очереди: {position}. Ответ придёт автоматически."
+
+
+def stats_report(total_users, total_requests, days):
+    """
+    days — строки db_manager.get_daily_stats(), начиная с сегодняшней.
+    """
+    lines = [
+        "📊 Статистика\n",
+        f"Пользователей: {total_users}",
+        f"Запросов за всё время: {total_requests}\n",
+        "День: новые / запросы / активные / упёрлись в лимит",
+    ]
+    for day, new_users, requests, active_users, exhausted in days:
+        lines.append(f"{day}: {new_users} / {requests} / {active_users} / {exhausted}")
+
+    week = [sum(row[i] for row in days) for i in (1, 2, 4)]
+    lines.append(
+        f"\nЗа {len(days)} дн.: новых {week[0]}, запросов {week[1]}, "
+        f"упёрлись в лимит {week[2]}"
+    )
+    return "\n".join(lines)
+
+
+_BROADCAST_STATUS = {
+    "running": "📣 Рассылка идёт",
+    "paused": "⏸ Рассылка на паузе (/broadcast resume)",
+    "done": "✅ Рассылка завершена",
+    "cancelled": "⏹ Рассылка отменена",
+}
+
+
+def broadcast_progress(status, last_tg_id, sent, failed, blocked, rate=None):
+    lines = [
+        _BROADCAST_STATUS[status],
+        f"Отправлено: {sent}",
+        f"Заблокировали бота: {blocked}",
+        f"Ошибок: {failed}",
+    ]
+    if rate is not None:
+        lines.append(f"Скорость: {rate:.1f} сообщ/с")
+    return "\n".join(lines)
@@ -1,18 +1,23 @@
-import subprocess
 import time
 import sys
 
+from healthcheck import probe
+
 CHECK_INTERVAL = 30  # секунд
+# бот мог ещё не подняться или на секунду задуматься — падаем
+# только после нескольких неудачных проверок подряд
+MAX_FAILURES = 3
+
+failures = 0
 
 while True:
-    result = subprocess.run(
-        ["python", "healthcheck.py"],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL
-    )
+    time.sleep(CHECK_INTERVAL)
 
-    if result.returncode != 0:
+    if probe():
+        failures = 0
+        continue
+
+    failures += 1
+    if failures >= MAX_FAILURES:
         print("❌ Healthcheck failed. Restarting container...")
         sys.exit(1)  # контейнер упадёт
-
-    time.sleep(CHECK_INTERVAL)
@@ -0,0 +1,130 @@
+import hmac
+import json
+import queue
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ==================== WEBHOOK ====================
+# Лёгкий HTTP-сервер на стандартной библиотеке: принимает апдейты от
+# Telegram, проверяет секрет, сразу отвечает 200 и кладёт апдейт в
+# ограниченную очередь. Обработчики бота вызываются из отдельных потоков.
+#
+# Проверка локально (без Telegram):
+#   curl -X POST localhost:8443/webhook \
+#        -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        -H "Content-Type: application/json" -d @update.json
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+MAX_BODY_SIZE = 1024 * 1024
+
+
+def webhook_secret(secret, url):
+    """
+    Если секрет не задан, а webhook регистрируется в Telegram, генерируем
+    случайный на время работы процесса — проверка заголовка всё равно будет.
+    """
+    if secret or not url:
+        return secret
+    return secrets.token_urlsafe(32)
+
+
+class WebhookServer:
+    def __init__(self, dispatch, host, port, path, secret, queue_size=1000, workers=1, on_tick=None):
+        """
+        dispatch(update: dict) вызывается в рабочих потоках для каждого апдейта.
+        on_tick() — на каждом обороте цикла сервера (~раз в 0.5 с), для health.
+        """
+        if not secret:
+            # иначе апдейт от имени любого пользователя (и админа) может
+            # прислать каждый, кто достучится до порта
+            raise ValueError("webhook без секрета: задайте WEBHOOK_SECRET или WEBHOOK_URL")
+
+        self._dispatch = dispatch
+        self._path = path
+        self._secret = secret.encode()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._workers = [
+            threading.Thread(target=self._work, name=f"webhook-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        if on_tick is not None:
+            self._httpd.service_actions = on_tick
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def serve_forever(self):
+        for worker in self._workers:
+            worker.start()
+
+        print(f"🌐 Webhook слушает {self._httpd.server_address}{self._path}")
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+    def start(self):
+        """
+        Запуск в фоновом потоке (для async-режима).
+        """
+        threading.Thread(
+            target=self.serve_forever, name="webhook-server", daemon=True
+        ).start()
+
+    def shutdown(self):
+        self._httpd.shutdown()
+
+    # ==================== ОЧЕРЕДЬ ====================
+
+    def _work(self):
+        while True:
+            update = self._queue.get()
+            try:
+                self._dispatch(update)
+            except Exception as e:
+                print("❌ Ошибка обработки апдейта:", e)
+
+    # ==================== HTTP ====================
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server._path:
+                    return self._reply(404)
+
+                token = (self.headers.get(SECRET_HEADER) or "").encode()
+                if not hmac.compare_digest(token, server._secret):
+                    return self._reply(403)
+
+                length = int(self.headers.get("Content-Length") or 0)
+                if length <= 0 or length > MAX_BODY_SIZE:
+                    return self._reply(413 if length else 400)
+
+                try:
+                    update = json.loads(self.rfile.read(length))
+                except ValueError:
+                    return self._reply(400)
+
+                try:
+                    server._queue.put_nowait(update)
+                except queue.Full:
+                    # Telegram повторит доставку позже
+                    return self._reply(503)
+
+                self._reply(200)
+
+            def _reply(self, code):
+                self.send_response(code)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                # без строки в лог на каждый апдейт
+                pass
+
+        return Handler